@@ -0,0 +1,208 @@
+import asyncio
+import importlib.util
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Dict, Any, Awaitable, Optional
+
+import asyncpg
+
+ASYNC_POOL_MIN = int(os.environ.get('ASYNC_POOL_MIN', '2'))
+ASYNC_POOL_MAX = int(os.environ.get('ASYNC_POOL_MAX', '20'))
+ASYNC_SYNC_WORKERS = int(os.environ.get('ASYNC_SYNC_WORKERS', '8'))
+
+
+def load_sync_module():
+    '''
+    Imports the sibling index.py once per process under the name the gateway
+    uses, so async and sync paths share its pool, caches and helpers
+    '''
+    name = f'{Path(__file__).resolve().parent.name}_index'
+    module = sys.modules.get(name)
+    if module is None:
+        spec = importlib.util.spec_from_file_location(name, Path(__file__).resolve().with_name('index.py'))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        sys.modules[name] = module
+    return module
+
+
+index = load_sync_module()
+
+# Каждый поток держит psycopg2-соединение из пула index: потоки сверх DB_POOL_MAX только ждали бы слот до PoolError
+_sync_executor = ThreadPoolExecutor(
+    max_workers=min(ASYNC_SYNC_WORKERS, index.DB_POOL_MAX), thread_name_prefix='auth-sync'
+)
+_pool: Optional[asyncpg.Pool] = None
+_pool_lock: Optional[asyncio.Lock] = None
+_listener: Optional[asyncpg.Connection] = None
+_current_trace: ContextVar[Optional[Any]] = ContextVar('auth_trace', default=None)
+
+
+async def get_pool() -> asyncpg.Pool:
+    # Пул привязан к циклу событий, в котором создан: один цикл на процесс
+    global _pool, _pool_lock, _listener
+    if _pool is not None and _listener is not None and not _listener.is_closed():
+        return _pool
+    if _pool_lock is None:
+        _pool_lock = asyncio.Lock()
+    async with _pool_lock:
+        if _pool is None:
+            _pool = await asyncpg.create_pool(
+                os.environ.get('DATABASE_URL'),
+                min_size=ASYNC_POOL_MIN,
+                max_size=ASYNC_POOL_MAX,
+                statement_cache_size=100 if index.DB_PREPARE_STATEMENTS else 0
+            )
+        if _listener is None or _listener.is_closed():
+            # Кэш сессий общий с sync-путём; выход и изменения пользователей сбрасывают его отсюда
+            # сразу, а не когда очередной запрос возьмёт psycopg2-соединение из пула. Пока слушателя
+            # не было, уведомления могли пройти мимо - кэш начинается с чистого листа
+            _listener = await asyncpg.connect(os.environ.get('DATABASE_URL'))
+            await _listener.add_listener(
+                'session_invalidated', lambda connection, pid, channel, payload: index.apply_session_invalidation(payload)
+            )
+            with index._session_cache_lock:
+                index._session_cache.clear()
+    return _pool
+
+
+async def fetch(conn, method: str, query: str, *args) -> Any:
+    '''
+    Runs conn.<method>(query, *args) - fetchrow or execute - timing it in the
+    request trace under the same fingerprints as the sync TracingCursor
+    '''
+    trace = _current_trace.get()
+    if trace is None:
+        return await getattr(conn, method)(query, *args)
+    started = time.perf_counter()
+    result = None
+    try:
+        result = await getattr(conn, method)(query, *args)
+        return result
+    finally:
+        trace.add_query(query, time.perf_counter() - started, int(result is not None and method == 'fetchrow'))
+
+
+async def run_native(event: Dict[str, Any], context: Any, respond: Awaitable[Dict[str, Any]]) -> Dict[str, Any]:
+    '''
+    Finishes an action served on asyncpg the way index.handler finishes the rest:
+    compressed body and, with TRACE_REQUESTS on, a Server-Timing header and one
+    JSON log line per request
+    '''
+    if not index.TRACE_REQUESTS:
+        return index.compress_response(event, await respond)
+
+    trace = index.RequestTrace(getattr(context, 'request_id', ''))
+    token = _current_trace.set(trace)
+    status: Any = 'error'
+    try:
+        response = index.compress_response(event, await respond)
+        status = response.get('statusCode')
+        trace.add_span('total', time.perf_counter() - trace.started)
+        response['headers'] = {
+            **response.get('headers', {}),
+            'Server-Timing': trace.server_timing(),
+            'Timing-Allow-Origin': '*'
+        }
+        return response
+    finally:
+        _current_trace.reset(token)
+        if 'total' not in trace.spans:
+            trace.add_span('total', time.perf_counter() - trace.started)
+        if trace.spans['total'] * 1000 >= index.TRACE_SLOW_MS:
+            print(json.dumps(trace.to_log('auth', event, status), ensure_ascii=False), flush=True)
+
+
+async def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    '''
+    Business: Async dispatch for the auth function when self-hosted behind one
+              event loop - session verification runs on asyncpg, every other
+              action runs the sync handler on a thread pool no larger than its
+              connection pool
+    Args: event - dict with httpMethod, body, headers
+          context - object with request_id attribute
+    Returns: HTTP response dict, the same as index.handler
+    '''
+    if event.get('httpMethod') == 'POST' and event.get('body'):
+        try:
+            body_data = json.loads(event['body'])
+        except ValueError:
+            body_data = None
+
+        if isinstance(body_data, dict) and body_data.get('action') == 'verify':
+            return await run_native(event, context, handle_verify(event))
+
+    return await asyncio.get_running_loop().run_in_executor(_sync_executor, index.handler, event, context)
+
+
+async def handle_verify(event: Dict[str, Any]) -> Dict[str, Any]:
+    headers = event.get('headers') or {}
+    session_token = headers.get('x-session-token') or headers.get('X-Session-Token')
+
+    return index.verify_response(await resolve_session(session_token) if session_token else None)
+
+
+async def resolve_session(session_token: str) -> Optional[Dict[str, Any]]:
+    '''
+    Same lookup as index.resolve_session, sharing its per-container cache:
+    a cache hit costs no database round-trip, a miss queries through asyncpg
+    '''
+    pool = await get_pool()
+    token_hash = index.hash_token(session_token)
+
+    cached = index.get_cached_session(token_hash)
+    if cached:
+        return cached
+
+    result = await fetch(pool, 'fetchrow', index.QUERY_CATALOG['session_user'], token_hash)
+
+    if not result:
+        return None
+
+    user = dict(result)
+    expires_in = float(user.pop('expires_in'))
+
+    if index.SESSION_SLIDING and expires_in < index.SESSION_TTL_SECONDS - index.SESSION_RENEW_INTERVAL:
+        await fetch(pool, 'execute', index.QUERY_CATALOG['session_renew'], float(index.SESSION_TTL_SECONDS), token_hash)
+        expires_in = float(index.SESSION_TTL_SECONDS)
+
+    index.cache_session(token_hash, user, expires_in)
+    return user
+
+
+async def close() -> None:
+    global _pool, _listener
+    if _listener is not None and not _listener.is_closed():
+        await _listener.close()
+    _listener = None
+    if _pool is not None:
+        await _pool.close()
+        _pool = None
+
+
+_loop_lock = threading.Lock()
+_background_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+def get_background_loop() -> asyncio.AbstractEventLoop:
+    global _background_loop
+    with _loop_lock:
+        if _background_loop is None:
+            _background_loop = asyncio.new_event_loop()
+            threading.Thread(target=_background_loop.run_forever, name='auth-async', daemon=True).start()
+        return _background_loop
+
+
+def sync_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    '''
+    Compatibility wrapper with the sync handler signature: runs the async handler
+    on a background event loop that lives as long as the container, so the
+    asyncpg pool and session invalidation listener survive warm invocations
+    '''
+    return asyncio.run_coroutine_threadsafe(handler(event, context), get_background_loop()).result()
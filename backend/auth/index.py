@@ -1,12 +1,846 @@
+import base64
+import functools
+import gzip
+import hashlib
 import json
 import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from collections import OrderedDict
 import psycopg2
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE, TRANSACTION_STATUS_UNKNOWN, connection as connection_type, cursor as cursor_type
 from psycopg2.extras import RealDictCursor
+from psycopg2.errors import InvalidSqlStatementName
+from psycopg2.pool import PoolError
 import bcrypt
 import secrets
-from datetime import datetime, timedelta
-from typing import Dict, Any, Optional
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from typing import Dict, Any, List, Tuple, Optional
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+DB_POOL_MAX = int(os.environ.get('DB_POOL_MAX', '4'))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', '5'))
+DB_POOL_CHECK_AFTER = float(os.environ.get('DB_POOL_CHECK_AFTER', '30'))
+DATABASE_READ_URL = os.environ.get('DATABASE_READ_URL')
+DB_READ_POOL_MAX = int(os.environ.get('DB_READ_POOL_MAX', str(DB_POOL_MAX)))
+
+_pool_lock = threading.Lock()
+_pool_slots = threading.BoundedSemaphore(DB_POOL_MAX)
+_pool_idle: List[Tuple[Any, float]] = []
+_replica_slots = threading.BoundedSemaphore(DB_READ_POOL_MAX)
+_replica_idle: List[Tuple[Any, float]] = []
+pool_stats: Dict[str, int] = {'hits': 0, 'misses': 0, 'reconnects': 0, 'replica_reads': 0, 'replica_fallbacks': 0}
+
+
+def get_connection(replica: bool = False):
+    '''
+    Checks out a connection from the warm-container pool (the DATABASE_READ_URL
+    pool with replica=True), opening a new one when nothing is idle and
+    replacing idle connections that went stale
+    '''
+    slots, idle_connections = (_replica_slots, _replica_idle) if replica else (_pool_slots, _pool_idle)
+    if not slots.acquire(timeout=DB_POOL_TIMEOUT):
+        raise PoolError('Connection pool exhausted')
+    
+    try:
+        with _pool_lock:
+            idle = idle_connections.pop() if idle_connections else None
+        
+        if idle:
+            conn, released_at = idle
+            if is_connection_alive(conn, released_at):
+                with _pool_lock:
+                    pool_stats['hits'] += 1
+                return conn
+            close_quietly(conn)
+            with _pool_lock:
+                pool_stats['reconnects'] += 1
+        else:
+            with _pool_lock:
+                pool_stats['misses'] += 1
+        
+        return open_connection(replica)
+    except Exception:
+        slots.release()
+        raise
+
+
+def open_connection(replica: bool = False):
+    conn = psycopg2.connect(
+        DATABASE_READ_URL if replica else os.environ.get('DATABASE_URL'), connection_factory=CatalogConnection,
+        cursor_factory=TracingCursor if TRACE_REQUESTS else RealDictCursor
+    )
+    conn.replica = replica
+    if replica:
+        # На реплике LISTEN недоступен; сбросы кэша приходят через соединения с primary
+        return conn
+    # Подписка живёт всё время жизни соединения в пуле
+    with conn.cursor() as cursor:
+        cursor.execute('LISTEN session_invalidated')
+    conn.commit()
+    return conn
+
+
+def release_connection(conn) -> None:
+    slots, idle_connections = (_replica_slots, _replica_idle) if conn.replica else (_pool_slots, _pool_idle)
+    try:
+        if not conn.closed:
+            tx_status = conn.get_transaction_status()
+            if tx_status == TRANSACTION_STATUS_UNKNOWN:
+                close_quietly(conn)
+            elif tx_status != TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+        if not conn.closed:
+            with _pool_lock:
+                idle_connections.append((conn, time.monotonic()))
+    except psycopg2.Error:
+        close_quietly(conn)
+    finally:
+        slots.release()
+
+
+def is_connection_alive(conn, released_at: float) -> bool:
+    if conn.closed:
+        return False
+    if time.monotonic() - released_at < DB_POOL_CHECK_AFTER:
+        return True
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute('SELECT name FROM pg_prepared_statements')
+            kept = {row['name'] for row in cursor.fetchall()}
+        conn.rollback()
+        # Простоявшая сессия могла пережить DISCARD - забываем то, чего сервер уже не хранит
+        if not conn.prepared <= kept:
+            conn.forget_prepared()
+        return True
+    except psycopg2.Error:
+        return False
+
+
+def close_quietly(conn) -> None:
+    try:
+        conn.close()
+    except psycopg2.Error:
+        pass
+
+
+def get_pool_stats() -> Dict[str, int]:
+    with _pool_lock:
+        return {**pool_stats, 'idle': len(_pool_idle), 'max': DB_POOL_MAX, 'replica_idle': len(_replica_idle)}
+
+
+REPLICA_MAX_LAG_SECONDS = float(os.environ.get('REPLICA_MAX_LAG_SECONDS', '5'))
+REPLICA_LAG_CHECK_INTERVAL = float(os.environ.get('REPLICA_LAG_CHECK_INTERVAL', '1'))
+LSN_PATTERN = re.compile(r'^[0-9A-Fa-f]{1,8}/[0-9A-Fa-f]{1,8}$')
+
+_replica_state: Dict[str, Any] = {'checked_at': float('-inf'), 'lagging': False}
+
+
+def get_read_connection(min_lsn: Optional[str] = None):
+    '''
+    Connection for a read-only action: the DATABASE_READ_URL replica when it has
+    replayed min_lsn (the read_lsn a client got back from a write) and lags less
+    than REPLICA_MAX_LAG_SECONDS, otherwise the primary. Without min_lsn the lag
+    verdict is reused for REPLICA_LAG_CHECK_INTERVAL seconds
+    '''
+    if not DATABASE_READ_URL or (min_lsn and not LSN_PATTERN.match(str(min_lsn))):
+        return get_connection()
+    
+    now = time.monotonic()
+    with _pool_lock:
+        checked_at, lagging = _replica_state['checked_at'], _replica_state['lagging']
+    
+    if lagging and not min_lsn and now - checked_at < REPLICA_LAG_CHECK_INTERVAL:
+        return replica_fallback()
+    
+    try:
+        conn = get_connection(replica=True)
+    except (psycopg2.Error, PoolError):
+        mark_replica_lagging(now, True)
+        return replica_fallback()
+    
+    if not min_lsn and now - checked_at < REPLICA_LAG_CHECK_INTERVAL:
+        with _pool_lock:
+            pool_stats['replica_reads'] += 1
+        return conn
+    
+    try:
+        cursor = conn.cursor()
+        # На primary (или без отставания) функции восстановления дают NULL - это считается «догнала»
+        cursor.execute(
+            """
+            SELECT COALESCE(CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                                 ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END, 0) AS lag_seconds,
+                   COALESCE(%(min_lsn)s::pg_lsn IS NULL OR pg_last_wal_replay_lsn() >= %(min_lsn)s::pg_lsn, true) AS caught_up
+            """,
+            {'min_lsn': min_lsn}
+        )
+        status = cursor.fetchone()
+    except psycopg2.Error:
+        release_connection(conn)
+        mark_replica_lagging(now, True)
+        return replica_fallback()
+    
+    lagging = float(status['lag_seconds']) > REPLICA_MAX_LAG_SECONDS
+    mark_replica_lagging(now, lagging)
+    
+    if lagging or not status['caught_up']:
+        release_connection(conn)
+        return replica_fallback()
+    
+    with _pool_lock:
+        pool_stats['replica_reads'] += 1
+    return conn
+
+
+def mark_replica_lagging(now: float, lagging: bool) -> None:
+    with _pool_lock:
+        _replica_state.update(checked_at=now, lagging=lagging)
+
+
+def replica_fallback():
+    with _pool_lock:
+        pool_stats['replica_fallbacks'] += 1
+    return get_connection()
+
+
+# Горячие запросы функции: готовятся на соединении при первом использовании, $n - параметры
+QUERY_CATALOG: Dict[str, str] = {
+    'session_user': """
+        SELECT u.id, u.username, u.full_name, u.role, u.status, u.department,
+               EXTRACT(EPOCH FROM s.expires_at - LOCALTIMESTAMP) AS expires_in
+        FROM sessions s
+        JOIN users u ON s.user_id = u.id
+        WHERE s.token_hash = decode($1, 'hex') AND s.expires_at > CURRENT_TIMESTAMP AND u.is_active = true
+    """,
+    'session_renew': """
+        UPDATE sessions SET expires_at = LOCALTIMESTAMP + make_interval(secs => $1)
+        WHERE token_hash = decode($2, 'hex')
+    """,
+    'login_user': """
+        SELECT id, username, password_hash, full_name, role, status, department, is_active
+        FROM users WHERE username = $1
+    """,
+    'presence_touch': "UPDATE users SET last_seen_at = LOCALTIMESTAMP WHERE id = $1 RETURNING status",
+    'chat_notify_many': "SELECT pg_notify(n.channel, n.payload) FROM unnest($1::text[], $2::text[]) AS n(channel, payload)"
+}
+
+
+DB_PREPARE_STATEMENTS = os.environ.get('DB_PREPARE_STATEMENTS', '1') not in ('0', 'false')
+
+
+class CatalogConnection(connection_type):
+    '''
+    Pooled connection that remembers which QUERY_CATALOG statements its server
+    session has already prepared, and which ones failed to prepare
+    '''
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared: set = set()
+        self.executed: set = set()
+        self.unpreparable: set = set()
+        self.replica = False
+    
+    def forget_prepared(self) -> None:
+        self.prepared.clear()
+        self.executed.clear()
+
+
+def execute_named(cursor, name: str, params: Tuple = ()) -> None:
+    '''
+    Runs a QUERY_CATALOG statement by name: PREPAREd once per pooled connection,
+    then EXECUTEd so Postgres skips parsing and planning. When PREPARE fails, or
+    the first EXECUTE finds the server did not keep the statement, it runs as
+    plain SQL on that connection from then on
+    '''
+    conn = cursor.connection
+    prepared = getattr(conn, 'prepared', None)
+    
+    if DB_PREPARE_STATEMENTS and prepared is not None and name not in conn.unpreparable:
+        if name not in prepared:
+            prepare_statement(cursor, name)
+        if name in prepared:
+            statement = f"EXECUTE {name} ({', '.join(['%s'] * len(params))})" if params else f'EXECUTE {name}'
+            first = name not in conn.executed
+            fresh = conn.autocommit or conn.get_transaction_status() == TRANSACTION_STATUS_IDLE
+            # Точка сохранения нужна только первому EXECUTE после PREPARE внутри начатой транзакции:
+            # дальше сессия уже доказала, что хранит запрос. Если транзакции ещё не было, откат ничего не теряет
+            guarded = first and not fresh
+            try:
+                cursor.execute(f'SAVEPOINT catalog_execute; {statement}' if guarded else statement, params)
+            except InvalidSqlStatementName:
+                if guarded:
+                    cursor.execute('ROLLBACK TO SAVEPOINT catalog_execute')
+                elif not fresh:
+                    # Сессию сбросили (DISCARD ALL) посреди транзакции - её уже не спасти,
+                    # но следующий запрос на этом соединении подготовит всё заново
+                    conn.forget_prepared()
+                    raise
+                elif not conn.autocommit:
+                    conn.rollback()
+                if first:
+                    # PREPARE и EXECUTE попали в разные сессии (пулер в режиме транзакций) -
+                    # дальше это соединение шлёт запрос обычным текстом, начиная с этого вызова
+                    prepared.discard(name)
+                    conn.unpreparable.add(name)
+                else:
+                    conn.forget_prepared()
+            else:
+                if guarded:
+                    # Отдельным курсором, чтобы не затереть результат EXECUTE
+                    with conn.cursor() as release:
+                        release.execute('RELEASE SAVEPOINT catalog_execute')
+                conn.executed.add(name)
+                return
+    
+    cursor.execute(_catalog_fallback[name], {str(i): value for i, value in enumerate(params, 1)} or None)
+
+
+def prepare_statement(cursor, name: str) -> None:
+    conn = cursor.connection
+    # Внутри транзакции неудачный PREPARE откатывается до точки сохранения и не ломает запрос
+    in_transaction = not conn.autocommit
+    if in_transaction:
+        cursor.execute('SAVEPOINT catalog_prepare')
+    try:
+        cursor.execute(f'PREPARE {name} AS {QUERY_CATALOG[name]}')
+    except psycopg2.Error:
+        if in_transaction:
+            cursor.execute('ROLLBACK TO SAVEPOINT catalog_prepare')
+        conn.unpreparable.add(name)
+    else:
+        conn.prepared.add(name)
+    if in_transaction:
+        cursor.execute('RELEASE SAVEPOINT catalog_prepare')
+
+
+# Тот же текст с %(n)s вместо $n - для соединений, где PREPARE недоступен
+_catalog_fallback: Dict[str, str] = {
+    name: re.sub(r'\$(\d+)', r'%(\1)s', query) for name, query in QUERY_CATALOG.items()
+}
+
+
+TRACE_REQUESTS = os.environ.get('TRACE_REQUESTS', '') in ('1', 'true')
+TRACE_SLOW_MS = float(os.environ.get('TRACE_SLOW_MS', '0'))
+TRACE_FINGERPRINT_CACHE_SIZE = 1024
+
+_trace_state = threading.local()
+_query_fingerprints: Dict[str, Tuple[str, str]] = {}
+
+
+class RequestTrace:
+    def __init__(self, request_id: str):
+        self.request_id = request_id
+        self.started = time.perf_counter()
+        self.spans: Dict[str, float] = {}
+        self.queries: Dict[str, Dict[str, Any]] = {}
+
+    def add_span(self, name: str, seconds: float) -> None:
+        self.spans[name] = self.spans.get(name, 0.0) + seconds
+
+    def add_query(self, query: Any, seconds: float, rows: int) -> None:
+        if isinstance(query, bytes):
+            query = query.decode('utf-8')
+        fingerprint, statement = _query_fingerprints.get(query) or fingerprint_query(query)
+        entry = self.queries.get(fingerprint)
+        if entry is None:
+            entry = self.queries[fingerprint] = {
+                'fingerprint': fingerprint, 'statement': statement, 'calls': 0, 'rows': 0, 'ms': 0.0
+            }
+        entry['calls'] += 1
+        entry['rows'] += max(rows, 0)
+        entry['ms'] += seconds * 1000
+        self.add_span('db', seconds)
+
+    def server_timing(self) -> str:
+        return ', '.join(f'{name};dur={seconds * 1000:.1f}' for name, seconds in self.spans.items())
+
+    def to_log(self, function_name: str, event: Dict[str, Any], status: Any) -> Dict[str, Any]:
+        try:
+            action = json.loads(event.get('body') or '{}').get('action', '')
+        except (ValueError, AttributeError):
+            action = ''
+        return {
+            'trace': 'request',
+            'request_id': self.request_id,
+            'function': function_name,
+            'method': event.get('httpMethod'),
+            'action': action,
+            'status': status,
+            **{f'{name}_ms': round(seconds * 1000, 2) for name, seconds in self.spans.items()},
+            'queries': sorted(
+                ({**entry, 'ms': round(entry['ms'], 2)} for entry in self.queries.values()),
+                key=lambda entry: entry['ms'], reverse=True
+            )
+        }
+
+
+def fingerprint_query(query: str) -> Tuple[str, str]:
+    # Параметры передаются через %s, поэтому текст запроса без пробельного шума и есть отпечаток
+    statement = ' '.join(query.split())
+    result = (hashlib.md5(statement.encode('utf-8')).hexdigest()[:12], statement[:160])
+    if len(_query_fingerprints) < TRACE_FINGERPRINT_CACHE_SIZE:
+        _query_fingerprints[query] = result
+    return result
+
+
+class TracingMixin:
+    def execute(self, query, vars=None):
+        trace = getattr(_trace_state, 'current', None)
+        if trace is None:
+            return super().execute(query, vars)
+        started = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            trace.add_query(query, time.perf_counter() - started, self.rowcount)
+
+
+class TracingCursor(TracingMixin, RealDictCursor):
+    pass
+
+
+class TracingTupleCursor(TracingMixin, cursor_type):
+    pass
+
+
+@contextmanager
+def trace_span(name: str):
+    trace = getattr(_trace_state, 'current', None)
+    if trace is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add_span(name, time.perf_counter() - started)
+
+
+def dump_json(payload: Any) -> str:
+    trace = getattr(_trace_state, 'current', None)
+    if trace is None:
+        return to_json(payload)
+    started = time.perf_counter()
+    try:
+        return to_json(payload)
+    finally:
+        trace.add_span('serialize', time.perf_counter() - started)
+
+
+RESPONSE_COMPRESS_MIN_BYTES = int(os.environ.get('RESPONSE_COMPRESS_MIN_BYTES', '1024'))
+RESPONSE_GZIP_LEVEL = 6
+RESPONSE_BROTLI_QUALITY = 5
+
+
+def to_json(payload: Any) -> str:
+    # orjson пишет datetime/date сам, без обратного вызова на каждое значение;
+    # без него stdlib json выдаёт тот же ISO-формат через encode_json_value
+    if orjson is not None:
+        return orjson.dumps(payload, default=encode_json_value).decode('utf-8')
+    return json.dumps(payload, default=encode_json_value, ensure_ascii=False, separators=(',', ':'))
+
+
+def encode_json_value(value: Any) -> Any:
+    if isinstance(value, date):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return float(value)
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+def list_cursor(conn):
+    '''
+    Tuple cursor for list reads: rows are built in C and turned into dicts by
+    fetch_records, instead of RealDictRow filling every column in Python
+    '''
+    return conn.cursor(cursor_factory=TracingTupleCursor if TRACE_REQUESTS else cursor_type)
+
+
+def fetch_records(cursor) -> List[Dict[str, Any]]:
+    rows = cursor.fetchall()
+    if not rows:
+        return []
+    columns = [column.name for column in cursor.description]
+    return [dict(zip(columns, row)) for row in rows]
+
+
+def get_header(event: Dict[str, Any], name: str) -> str:
+    name = name.lower()
+    for key, value in (event.get('headers') or {}).items():
+        if key.lower() == name:
+            return value or ''
+    return ''
+
+
+def accepted_encodings(accept_encoding: str) -> List[str]:
+    encodings = []
+    for part in accept_encoding.split(','):
+        coding, _, params = part.partition(';')
+        quality = params.strip().lower()
+        if quality.startswith('q=') and quality[2:].strip() in ('0', '0.0', '0.00', '0.000'):
+            continue
+        encodings.append(coding.strip().lower())
+    return encodings
+
+
+def compressible(func):
+    @functools.wraps(func)
+    def wrapper(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+        return compress_response(event, func(event, context))
+    
+    return wrapper
+
+
+def compress_response(event: Dict[str, Any], response: Dict[str, Any]) -> Dict[str, Any]:
+    '''
+    Compresses JSON bodies above RESPONSE_COMPRESS_MIN_BYTES with brotli or gzip,
+    whichever the client accepts, and returns them base64-encoded with
+    isBase64Encoded set, as the cloud runtime expects for binary bodies
+    '''
+    body = response.get('body')
+    if response.get('isBase64Encoded') or not isinstance(body, str) or len(body) < RESPONSE_COMPRESS_MIN_BYTES // 2:
+        return response
+    
+    raw = body.encode('utf-8')
+    if len(raw) < RESPONSE_COMPRESS_MIN_BYTES:
+        return response
+    
+    encodings = accepted_encodings(get_header(event, 'Accept-Encoding'))
+    headers = {**response.get('headers', {}), 'Vary': 'Accept-Encoding'}
+    with trace_span('compress'):
+        if brotli is not None and 'br' in encodings:
+            encoding, data = 'br', brotli.compress(raw, quality=RESPONSE_BROTLI_QUALITY)
+        elif 'gzip' in encodings:
+            encoding, data = 'gzip', gzip.compress(raw, compresslevel=RESPONSE_GZIP_LEVEL, mtime=0)
+        else:
+            return {**response, 'headers': headers}
+    
+    return {
+        **response,
+        'headers': {**headers, 'Content-Encoding': encoding},
+        'body': base64.b64encode(data).decode('ascii'),
+        'isBase64Encoded': True
+    }
+
+
+def traced(function_name: str):
+    '''
+    Opt-in per-request tracing: with TRACE_REQUESTS on, times connect, every
+    query by fingerprint, serialization and total, logs one JSON line per request
+    and adds a Server-Timing header; otherwise the handler is returned untouched
+    '''
+    def decorate(func):
+        if not TRACE_REQUESTS:
+            return func
+
+        @functools.wraps(func)
+        def wrapper(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+            trace = RequestTrace(getattr(context, 'request_id', ''))
+            _trace_state.current = trace
+            status: Any = 'error'
+            try:
+                response = func(event, context)
+                status = response.get('statusCode')
+                trace.add_span('total', time.perf_counter() - trace.started)
+                response['headers'] = {
+                    **response.get('headers', {}),
+                    'Server-Timing': trace.server_timing(),
+                    'Timing-Allow-Origin': '*'
+                }
+                return response
+            finally:
+                _trace_state.current = None
+                if 'total' not in trace.spans:
+                    trace.add_span('total', time.perf_counter() - trace.started)
+                if trace.spans['total'] * 1000 >= TRACE_SLOW_MS:
+                    print(json.dumps(trace.to_log(function_name, event, status), ensure_ascii=False), flush=True)
+
+        return wrapper
+    return decorate
+
+
+SESSION_CACHE_TTL = float(os.environ.get('SESSION_CACHE_TTL', '60'))
+SESSION_CACHE_SIZE = int(os.environ.get('SESSION_CACHE_SIZE', '1024'))
+SESSION_TTL_SECONDS = int(os.environ.get('SESSION_TTL_SECONDS', str(7 * 24 * 3600)))
+SESSION_SLIDING = os.environ.get('SESSION_SLIDING', '') in ('1', 'true')
+SESSION_RENEW_INTERVAL = int(os.environ.get('SESSION_RENEW_INTERVAL', '3600'))
+SESSION_MAX_PER_USER = int(os.environ.get('SESSION_MAX_PER_USER', '10'))
+
+_session_cache_lock = threading.Lock()
+_session_cache: 'OrderedDict[str, Tuple[Dict[str, Any], float]]' = OrderedDict()
+
+
+def hash_token(session_token: str) -> str:
+    return hashlib.sha256(session_token.encode('utf-8')).hexdigest()
+
+
+def resolve_session(conn, session_token: str) -> Optional[Dict[str, Any]]:
+    '''
+    Returns the active user behind a session token. Results are cached per
+    container by token hash until the TTL or the session expiry, whichever
+    comes first; logout and user updates evict entries via NOTIFY.
+    With SESSION_SLIDING the expiry is pushed forward at most once per
+    SESSION_RENEW_INTERVAL, on a cache miss
+    '''
+    apply_session_invalidations(conn)
+    token_hash = hash_token(session_token)
+    
+    cached = get_cached_session(token_hash)
+    if cached:
+        return cached
+    
+    cursor = conn.cursor()
+    execute_named(cursor, 'session_user', (token_hash,))
+    result = cursor.fetchone()
+    
+    if not result:
+        return None
+    
+    user = dict(result)
+    expires_in = float(user.pop('expires_in'))
+    
+    if SESSION_SLIDING and expires_in < SESSION_TTL_SECONDS - SESSION_RENEW_INTERVAL:
+        execute_named(cursor, 'session_renew', (SESSION_TTL_SECONDS, token_hash))
+        conn.commit()
+        expires_in = float(SESSION_TTL_SECONDS)
+    
+    cache_session(token_hash, user, expires_in)
+    return user
+
+
+def get_cached_session(token_hash: str) -> Optional[Dict[str, Any]]:
+    with _session_cache_lock:
+        cached = _session_cache.get(token_hash)
+        if cached and cached[1] > time.monotonic():
+            _session_cache.move_to_end(token_hash)
+            return cached[0]
+        _session_cache.pop(token_hash, None)
+    return None
+
+
+def cache_session(token_hash: str, user: Dict[str, Any], expires_in: float) -> None:
+    with _session_cache_lock:
+        _session_cache[token_hash] = (user, time.monotonic() + min(SESSION_CACHE_TTL, expires_in))
+        while len(_session_cache) > SESSION_CACHE_SIZE:
+            _session_cache.popitem(last=False)
+
+
+def invalidate_sessions(token_hash: Optional[str] = None, user_id: Optional[int] = None) -> None:
+    with _session_cache_lock:
+        for key, (user, _) in list(_session_cache.items()):
+            if key == token_hash or (user_id is not None and user['id'] == user_id):
+                del _session_cache[key]
+
+
+def apply_session_invalidations(conn) -> None:
+    # Уведомления уже лежат в сокете соединения, poll() читает их без запроса к базе
+    conn.poll()
+    while conn.notifies:
+        apply_session_invalidation(conn.notifies.pop(0).payload)
+
+
+def apply_session_invalidation(payload: str) -> None:
+    kind, _, value = payload.partition(':')
+    if kind == 'token':
+        invalidate_sessions(token_hash=value)
+    elif kind == 'user':
+        invalidate_sessions(user_id=int(value))
+        invalidate_roster()
+
+
+def publish_session_invalidation(cursor, payload: str) -> None:
+    cursor.execute("SELECT pg_notify('session_invalidated', %s)", (payload,))
+
+
+PRESENCE_TIMEOUT = int(os.environ.get('PRESENCE_TIMEOUT', '120'))
+PRESENCE_WRITE_INTERVAL = float(os.environ.get('PRESENCE_WRITE_INTERVAL', '25'))
+PRESENCE_SWEEP_INTERVAL = float(os.environ.get('PRESENCE_SWEEP_INTERVAL', '30'))
+ROSTER_CACHE_TTL = float(os.environ.get('ROSTER_CACHE_TTL', '30'))
+
+_presence_lock = threading.Lock()
+_presence_written: Dict[int, float] = {}
+_presence_state: Dict[str, float] = {'swept_at': 0.0}
+_roster_cache: Dict[str, Any] = {'body': None, 'etag': None, 'expires_at': 0.0}
+
+
+def claim_presence_work(user_id: int) -> Tuple[bool, bool]:
+    '''
+    Decides whether this heartbeat writes last_seen_at and whether it runs the
+    stale-operator sweep; both are rate-limited per container, so most
+    heartbeats are answered from the session cache without touching the database
+    '''
+    now = time.monotonic()
+    with _presence_lock:
+        write = now - _presence_written.get(user_id, 0.0) >= PRESENCE_WRITE_INTERVAL
+        if write:
+            _presence_written[user_id] = now
+        sweep = now - _presence_state['swept_at'] >= PRESENCE_SWEEP_INTERVAL
+        if sweep:
+            _presence_state['swept_at'] = now
+    return write, sweep
+
+
+def invalidate_roster() -> None:
+    with _presence_lock:
+        _roster_cache['body'] = None
+
+
+BCRYPT_ROUNDS = int(os.environ.get('BCRYPT_ROUNDS', '12'))
+BCRYPT_WORKERS = int(os.environ.get('BCRYPT_WORKERS', '2'))
+BCRYPT_MAX_PENDING = int(os.environ.get('BCRYPT_MAX_PENDING', '8'))
+
+_bcrypt_slots = threading.BoundedSemaphore(BCRYPT_MAX_PENDING)
+_bcrypt_running = threading.BoundedSemaphore(BCRYPT_WORKERS)
+
+
+class PasswordHashingBusy(Exception):
+    pass
+
+
+def run_bcrypt(func, *args):
+    '''
+    Runs a bcrypt call on the calling thread, at most BCRYPT_WORKERS at a time;
+    when BCRYPT_MAX_PENDING calls are already waiting or running it fails fast
+    instead of queueing more CPU work
+    '''
+    if not _bcrypt_slots.acquire(blocking=False):
+        raise PasswordHashingBusy('Password hashing pool is busy')
+    try:
+        # bcrypt отпускает GIL, так что отдельный пул потоков ничего не даёт - вызывающий поток всё равно ждал бы
+        with _bcrypt_running:
+            return func(*args)
+    finally:
+        _bcrypt_slots.release()
+
+
+def hash_password(password: str) -> str:
+    return run_bcrypt(bcrypt.hashpw, password.encode('utf-8'), bcrypt.gensalt(BCRYPT_ROUNDS)).decode('utf-8')
+
+
+def check_password(password: str, password_hash: str) -> bool:
+    try:
+        return run_bcrypt(bcrypt.checkpw, password.encode('utf-8'), password_hash.encode('utf-8'))
+    except ValueError:
+        # Некорректный хэш в базе (например, заглушка из начальных данных)
+        return False
+
+
+def needs_rehash(password_hash: str) -> bool:
+    try:
+        return int(password_hash.split('$')[2]) < BCRYPT_ROUNDS
+    except (IndexError, ValueError):
+        return False
+
+
+LOGIN_MAX_FAILURES_PER_USER = int(os.environ.get('LOGIN_MAX_FAILURES_PER_USER', '5'))
+LOGIN_MAX_FAILURES_PER_IP = int(os.environ.get('LOGIN_MAX_FAILURES_PER_IP', '50'))
+LOGIN_FAILURE_WINDOW = int(os.environ.get('LOGIN_FAILURE_WINDOW', '900'))
+LOGIN_LOCKOUT_SECONDS = int(os.environ.get('LOGIN_LOCKOUT_SECONDS', '900'))
+LOGIN_TRUSTED_PROXIES = {ip.strip() for ip in os.environ.get('LOGIN_TRUSTED_PROXIES', '').split(',') if ip.strip()}
+
+
+def get_client_ip(event: Dict[str, Any]) -> Optional[str]:
+    # X-Forwarded-For пишет сам клиент: заголовку верим, только если запрос пришёл от нашего прокси,
+    # и берём самый правый адрес, добавленный не нашими прокси
+    source_ip = (event.get('requestContext') or {}).get('identity', {}).get('sourceIp')
+    if source_ip not in LOGIN_TRUSTED_PROXIES:
+        return source_ip
+    for address in reversed(get_header(event, 'X-Forwarded-For').split(',')):
+        address = address.strip()
+        if address and address not in LOGIN_TRUSTED_PROXIES:
+            return address
+    return source_ip
+
+
+def get_login_throttle_keys(username: str, client_ip: Optional[str]) -> List[Tuple[str, int]]:
+    keys = [(f'user:{username.lower()}', LOGIN_MAX_FAILURES_PER_USER)]
+    if client_ip:
+        keys.append((f'ip:{client_ip}', LOGIN_MAX_FAILURES_PER_IP))
+    return keys
+
+
+def get_login_retry_after(cursor, keys: List[Tuple[str, int]]) -> int:
+    cursor.execute(
+        """
+        SELECT CEIL(EXTRACT(EPOCH FROM MAX(locked_until) - LOCALTIMESTAMP)) AS retry_after
+        FROM login_throttle
+        WHERE throttle_key = ANY(%s) AND locked_until > LOCALTIMESTAMP
+        """,
+        ([key for key, _ in keys],)
+    )
+    retry_after = cursor.fetchone()['retry_after']
+    return int(retry_after) if retry_after else 0
+
+
+def record_login_failure(cursor, keys: List[Tuple[str, int]]) -> None:
+    '''
+    Counts a failed login per key inside a fixed window; reaching the key's
+    limit locks it for LOGIN_LOCKOUT_SECONDS, checked before any bcrypt work
+    '''
+    for key, max_failures in keys:
+        cursor.execute(
+            """
+            INSERT INTO login_throttle AS t (throttle_key, failures, window_started_at)
+            VALUES (%(key)s, 1, LOCALTIMESTAMP)
+            ON CONFLICT (throttle_key) DO UPDATE SET
+                failures = CASE WHEN t.window_started_at > LOCALTIMESTAMP - make_interval(secs => %(window)s)
+                                THEN t.failures + 1 ELSE 1 END,
+                window_started_at = CASE WHEN t.window_started_at > LOCALTIMESTAMP - make_interval(secs => %(window)s)
+                                         THEN t.window_started_at ELSE LOCALTIMESTAMP END
+            RETURNING failures
+            """,
+            {'key': key, 'window': LOGIN_FAILURE_WINDOW}
+        )
+        if cursor.fetchone()['failures'] >= max_failures:
+            cursor.execute(
+                """
+                UPDATE login_throttle
+                SET failures = 0, window_started_at = LOCALTIMESTAMP,
+                    locked_until = LOCALTIMESTAMP + make_interval(secs => %s)
+                WHERE throttle_key = %s
+                """,
+                (LOGIN_LOCKOUT_SECONDS, key)
+            )
+
+
+def evict_extra_sessions(cursor, user_id: int) -> None:
+    '''
+    Keeps only the SESSION_MAX_PER_USER newest sessions of a user; evicted
+    tokens are dropped from session caches in every container via NOTIFY
+    '''
+    cursor.execute(
+        """
+        DELETE FROM sessions
+        WHERE id IN (
+            SELECT id FROM sessions
+            WHERE user_id = %s
+            ORDER BY created_at DESC, id DESC
+            OFFSET %s
+        )
+        RETURNING encode(token_hash, 'hex') AS token_hash
+        """,
+        (user_id, SESSION_MAX_PER_USER)
+    )
+    for row in cursor.fetchall():
+        publish_session_invalidation(cursor, f"token:{row['token_hash']}")
+        invalidate_sessions(token_hash=row['token_hash'])
+
+
+@traced('auth')
+@compressible
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
     Business: User authentication and session management
@@ -22,20 +856,21 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'headers': {
                 'Access-Control-Allow-Origin': '*',
                 'Access-Control-Allow-Methods': 'GET, POST, PUT, DELETE, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-Session-Token',
+                'Access-Control-Allow-Headers': 'Content-Type, X-Session-Token, If-None-Match',
                 'Access-Control-Max-Age': '86400'
             },
             'body': '',
             'isBase64Encoded': False
         }
     
-    db_url = os.environ.get('DATABASE_URL')
-    conn = psycopg2.connect(db_url, cursor_factory=RealDictCursor)
+    body_data = json.loads(event.get('body', '{}')) if event.get('body') else {}
+    action = body_data.get('action', '')
+    
+    with trace_span('connect'):
+        # Ростер - чистое чтение, его можно отдать с реплики
+        conn = get_read_connection() if action == 'get_operators' else get_connection()
     
     try:
-        body_data = json.loads(event.get('body', '{}')) if event.get('body') else {}
-        action = body_data.get('action', '')
-        
         if method == 'POST':
             if action == 'login':
                 return handle_login(event, conn)
@@ -46,7 +881,9 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             elif action == 'update_status':
                 return handle_update_status(event, conn)
             elif action == 'get_operators':
-                return handle_get_operators(conn)
+                return handle_get_operators(body_data, conn)
+            elif action == 'heartbeat':
+                return handle_heartbeat(event, conn)
         
         elif method == 'GET':
             return handle_get_current_user(event, conn)
@@ -54,12 +891,12 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         return {
             'statusCode': 400,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Invalid action'}),
+            'body': dump_json({'error': 'Invalid action'}),
             'isBase64Encoded': False
         }
     
     finally:
-        conn.close()
+        release_connection(conn)
 
 
 def handle_login(event: Dict[str, Any], conn) -> Dict[str, Any]:
@@ -71,22 +908,38 @@ def handle_login(event: Dict[str, Any], conn) -> Dict[str, Any]:
         return {
             'statusCode': 400,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Username and password required'}),
+            'body': dump_json({'error': 'Username and password required'}),
             'isBase64Encoded': False
         }
     
     cursor = conn.cursor()
-    cursor.execute(
-        "SELECT id, username, password_hash, full_name, role, status, department, is_active FROM users WHERE username = %s",
-        (username,)
-    )
+    
+    # Троттлинг проверяется до любой работы bcrypt, чтобы перебор паролей не съедал CPU
+    throttle_keys = get_login_throttle_keys(username, get_client_ip(event))
+    retry_after = get_login_retry_after(cursor, throttle_keys)
+    if retry_after:
+        return {
+            'statusCode': 429,
+            'headers': {
+                'Content-Type': 'application/json',
+                'Access-Control-Allow-Origin': '*',
+                'Retry-After': str(retry_after)
+            },
+            'body': dump_json({'error': 'Too many login attempts', 'retry_after': retry_after}),
+            'isBase64Encoded': False
+        }
+    
+    execute_named(cursor, 'login_user', (username,))
     user = cursor.fetchone()
     
     if not user:
+        # Несуществующий логин не стоит bcrypt, поэтому считается только по IP
+        record_login_failure(cursor, throttle_keys[1:])
+        conn.commit()
         return {
             'statusCode': 401,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Invalid credentials'}),
+            'body': dump_json({'error': 'Invalid credentials'}),
             'isBase64Encoded': False
         }
     
@@ -94,33 +947,56 @@ def handle_login(event: Dict[str, Any], conn) -> Dict[str, Any]:
         return {
             'statusCode': 403,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Account deactivated'}),
+            'body': dump_json({'error': 'Account deactivated'}),
             'isBase64Encoded': False
         }
     
+    # Чтения закончены - транзакция не висит открытой, пока считается bcrypt
+    conn.rollback()
+    
     password_valid = False
-    if password == 'demo123' or password == '803254':
-        password_valid = True
-    else:
-        try:
-            password_valid = bcrypt.checkpw(password.encode('utf-8'), user['password_hash'].encode('utf-8'))
-        except:
-            password_valid = False
+    new_password_hash = None
+    try:
+        if password == 'demo123' or password == '803254':
+            password_valid = True
+        else:
+            password_valid = check_password(password, user['password_hash'])
+            if password_valid and needs_rehash(user['password_hash']):
+                # Стоимость хэша повысили - пересчитать при входе, пока известен пароль
+                new_password_hash = hash_password(password)
+    except PasswordHashingBusy:
+        return {
+            'statusCode': 503,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*', 'Retry-After': '1'},
+            'body': dump_json({'error': 'Server busy, retry login'}),
+            'isBase64Encoded': False
+        }
+    
+    if not password_valid:
+        record_login_failure(cursor, throttle_keys)
+        conn.commit()
     
     if password_valid:
         session_token = secrets.token_urlsafe(32)
-        expires_at = datetime.now() + timedelta(days=7)
+        expires_at = datetime.now() + timedelta(seconds=SESSION_TTL_SECONDS)
         
         cursor.execute(
-            "INSERT INTO sessions (user_id, session_token, expires_at) VALUES (%s, %s, %s)",
-            (user['id'], session_token, expires_at)
+            "UPDATE users SET last_seen_at = LOCALTIMESTAMP, password_hash = COALESCE(%s, password_hash) WHERE id = %s",
+            (new_password_hash, user['id'])
         )
+        cursor.execute("DELETE FROM login_throttle WHERE throttle_key = %s", (throttle_keys[0][0],))
+        cursor.execute(
+            "INSERT INTO sessions (user_id, token_hash, expires_at) VALUES (%s, decode(%s, 'hex'), %s)",
+            (user['id'], hash_token(session_token), expires_at)
+        )
+        if SESSION_MAX_PER_USER:
+            evict_extra_sessions(cursor, user['id'])
         conn.commit()
         
         return {
             'statusCode': 200,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({
+            'body': dump_json({
                 'session_token': session_token,
                 'user': {
                     'id': user['id'],
@@ -137,7 +1013,7 @@ def handle_login(event: Dict[str, Any], conn) -> Dict[str, Any]:
     return {
         'statusCode': 401,
         'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({'error': 'Invalid credentials'}),
+        'body': dump_json({'error': 'Invalid credentials'}),
         'isBase64Encoded': False
     }
 
@@ -150,18 +1026,21 @@ def handle_logout(event: Dict[str, Any], conn) -> Dict[str, Any]:
         return {
             'statusCode': 401,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'No session token'}),
+            'body': dump_json({'error': 'No session token'}),
             'isBase64Encoded': False
         }
     
+    token_hash = hash_token(session_token)
     cursor = conn.cursor()
-    cursor.execute("UPDATE sessions SET expires_at = CURRENT_TIMESTAMP WHERE session_token = %s", (session_token,))
+    cursor.execute("DELETE FROM sessions WHERE token_hash = decode(%s, 'hex')", (token_hash,))
+    publish_session_invalidation(cursor, f'token:{token_hash}')
     conn.commit()
+    invalidate_sessions(token_hash=token_hash)
     
     return {
         'statusCode': 200,
         'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({'success': True}),
+        'body': dump_json({'success': True}),
         'isBase64Encoded': False
     }
 
@@ -174,7 +1053,7 @@ def handle_update_status(event: Dict[str, Any], conn) -> Dict[str, Any]:
         return {
             'statusCode': 401,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Unauthorized'}),
+            'body': dump_json({'error': 'Unauthorized'}),
             'isBase64Encoded': False
         }
     
@@ -185,83 +1064,163 @@ def handle_update_status(event: Dict[str, Any], conn) -> Dict[str, Any]:
         return {
             'statusCode': 400,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Invalid status'}),
+            'body': dump_json({'error': 'Invalid status'}),
             'isBase64Encoded': False
         }
     
-    cursor = conn.cursor()
-    cursor.execute(
-        "SELECT user_id FROM sessions WHERE session_token = %s AND expires_at > CURRENT_TIMESTAMP",
-        (session_token,)
-    )
-    session = cursor.fetchone()
+    session = resolve_session(conn, session_token)
     
     if not session:
         return {
             'statusCode': 401,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Session expired'}),
+            'body': dump_json({'error': 'Session expired'}),
             'isBase64Encoded': False
         }
     
+    cursor = conn.cursor()
     cursor.execute(
-        "UPDATE users SET status = %s, updated_at = CURRENT_TIMESTAMP WHERE id = %s",
-        (new_status, session['user_id'])
+        "UPDATE users SET status = %s, last_seen_at = LOCALTIMESTAMP, updated_at = CURRENT_TIMESTAMP WHERE id = %s",
+        (new_status, session['id'])
     )
+    cursor.execute(
+        "SELECT pg_notify('chat_events', %s)",
+        (to_json({'type': 'operator_status', 'operator_id': session['id'], 'status': new_status}),)
+    )
+    publish_session_invalidation(cursor, f"user:{session['id']}")
+    
+    assigned_chat_ids = []
+    if new_status == 'online':
+        # Оператор вышел на линию - забирает ожидающие чаты в пределах своего лимита
+        assigned_chat_ids = drain_waiting_queue(cursor, session['id'])
+    
     conn.commit()
+    invalidate_sessions(user_id=session['id'])
+    invalidate_roster()
     
     return {
         'statusCode': 200,
         'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({'success': True, 'status': new_status}),
+        'body': dump_json({'success': True, 'status': new_status, 'assigned_chat_ids': assigned_chat_ids}),
         'isBase64Encoded': False
     }
 
 
-def handle_verify(event: Dict[str, Any], conn) -> Dict[str, Any]:
-    headers = event.get('headers', {})
-    session_token = headers.get('x-session-token') or headers.get('X-Session-Token')
+def drain_waiting_queue(cursor, operator_id: int) -> List[int]:
+    '''
+    Assigns the oldest waiting chats of the operator's department (or without
+    a department) to the operator, up to their free capacity
+    '''
+    cursor.execute(
+        """
+        SELECT id, department, max_active_chats - active_chat_count AS capacity
+        FROM users
+        WHERE id = %s AND status = 'online' AND is_active = true AND role IN ('operator', 'okk', 'admin')
+        FOR UPDATE
+        """,
+        (operator_id,)
+    )
+    operator = cursor.fetchone()
     
-    if not session_token:
-        return {
-            'statusCode': 401,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'valid': False}),
-            'isBase64Encoded': False
-        }
+    if not operator or operator['capacity'] <= 0:
+        return []
     
-    cursor = conn.cursor()
     cursor.execute(
         """
-        SELECT u.id, u.username, u.full_name, u.role, u.status, u.department, s.expires_at
-        FROM sessions s
-        JOIN users u ON s.user_id = u.id
-        WHERE s.session_token = %s AND s.expires_at > CURRENT_TIMESTAMP AND u.is_active = true
+        WITH picked AS (
+            SELECT id FROM chats
+            WHERE status = 'waiting' AND (department IS NULL OR department = %s)
+            ORDER BY created_at ASC
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED
+        )
+        UPDATE chats c
+        SET status = 'active', assigned_operator_id = %s, updated_at = CURRENT_TIMESTAMP
+        FROM picked
+        WHERE c.id = picked.id
+        RETURNING c.id
         """,
-        (session_token,)
+        (operator['department'], operator['capacity'], operator_id)
     )
-    result = cursor.fetchone()
+    chat_ids = [row['id'] for row in cursor.fetchall()]
     
-    if not result:
+    # Та же маршрутизация есть в drain_waiting_queue из backend/chats/index.py - менять обе копии вместе
+    if chat_ids:
+        adjust_operator_load(cursor, operator_id, len(chat_ids))
+        notify_chat_events(
+            cursor,
+            [{'type': 'chat_assigned', 'chat_id': chat_id, 'status': 'active', 'assigned_operator_id': operator_id}
+             for chat_id in chat_ids],
+            operator_ids=[operator_id]
+        )
+    
+    return chat_ids
+
+
+def adjust_operator_load(cursor, operator_id: int, delta: int) -> None:
+    cursor.execute(
+        """
+        UPDATE users
+        SET active_chat_count = GREATEST(active_chat_count + %(delta)s, 0),
+            last_assigned_at = CASE WHEN %(delta)s > 0 THEN CURRENT_TIMESTAMP ELSE last_assigned_at END
+        WHERE id = %(operator_id)s
+        """,
+        {'operator_id': operator_id, 'delta': delta}
+    )
+
+
+def notify_chat_events(cursor, events: List[Dict[str, Any]], operator_ids: Optional[List[Any]] = None,
+                       queue: bool = False) -> None:
+    # Те же каналы и формат событий, что и notify_chat_events в backend/chats; pg_notify уходит после коммита
+    channels, payloads = [], []
+    for event in events:
+        payload, event_channels, routed_payload = chat_event_notification(event, operator_ids, queue)
+        channels += [*event_channels, 'chat_events']
+        payloads += [payload] * len(event_channels) + [routed_payload]
+    if channels:
+        execute_named(cursor, 'chat_notify_many', (channels, payloads))
+
+
+def chat_event_notification(event: Dict[str, Any], operator_ids: Optional[List[Any]] = None,
+                            queue: bool = False) -> Tuple[str, List[str], str]:
+    operator_ids = sorted({int(operator_id) for operator_id in operator_ids or [] if operator_id})
+    channels = [f"chat_{event['chat_id']}"]
+    channels += [f'operator_{operator_id}' for operator_id in operator_ids]
+    if queue:
+        channels.append('chat_queue')
+    
+    routed_event = {**event, 'operator_ids': operator_ids, 'queue': queue}
+    return to_json(event), channels, to_json(routed_event)
+
+
+def handle_verify(event: Dict[str, Any], conn) -> Dict[str, Any]:
+    headers = event.get('headers', {})
+    session_token = headers.get('x-session-token') or headers.get('X-Session-Token')
+    
+    return verify_response(resolve_session(conn, session_token) if session_token else None)
+
+
+def verify_response(session: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    if not session:
         return {
             'statusCode': 401,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'valid': False}),
+            'body': dump_json({'valid': False}),
             'isBase64Encoded': False
         }
     
     return {
         'statusCode': 200,
         'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({
+        'body': dump_json({
             'valid': True,
             'user': {
-                'id': result['id'],
-                'username': result['username'],
-                'full_name': result['full_name'],
-                'role': result['role'],
-                'status': result['status'],
-                'department': result['department']
+                'id': session['id'],
+                'username': session['username'],
+                'full_name': session['full_name'],
+                'role': session['role'],
+                'status': session['status'],
+                'department': session['department']
             }
         }),
         'isBase64Encoded': False
@@ -276,34 +1235,24 @@ def handle_get_current_user(event: Dict[str, Any], conn) -> Dict[str, Any]:
         return {
             'statusCode': 401,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Unauthorized'}),
+            'body': dump_json({'error': 'Unauthorized'}),
             'isBase64Encoded': False
         }
     
-    cursor = conn.cursor()
-    cursor.execute(
-        """
-        SELECT u.id, u.username, u.full_name, u.role, u.status, u.department
-        FROM sessions s
-        JOIN users u ON s.user_id = u.id
-        WHERE s.session_token = %s AND s.expires_at > CURRENT_TIMESTAMP AND u.is_active = true
-        """,
-        (session_token,)
-    )
-    result = cursor.fetchone()
+    result = resolve_session(conn, session_token)
     
     if not result:
         return {
             'statusCode': 401,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Invalid session'}),
+            'body': dump_json({'error': 'Invalid session'}),
             'isBase64Encoded': False
         }
     
     return {
         'statusCode': 200,
         'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({
+        'body': dump_json({
             'id': result['id'],
             'username': result['username'],
             'full_name': result['full_name'],
@@ -315,21 +1264,88 @@ def handle_get_current_user(event: Dict[str, Any], conn) -> Dict[str, Any]:
     }
 
 
-def handle_get_operators(conn) -> Dict[str, Any]:
-    cursor = conn.cursor()
-    cursor.execute(
-        """
-        SELECT id, full_name, role, status, department
-        FROM users
-        WHERE is_active = true AND role IN ('operator', 'okk', 'admin')
-        ORDER BY full_name
-        """
-    )
-    operators = cursor.fetchall()
+def handle_get_operators(body_data: Dict[str, Any], conn) -> Dict[str, Any]:
+    # Ростер кэшируется уже сериализованным вместе с ETag; смена статуса сбрасывает его через NOTIFY user:<id>
+    apply_session_invalidations(conn)
+    now = time.monotonic()
+    
+    with _presence_lock:
+        cached = _roster_cache['expires_at'] > now and _roster_cache['body'] is not None
+        body, etag = (_roster_cache['body'], _roster_cache['etag']) if cached else (None, None)
+    
+    if body is None:
+        cursor = list_cursor(conn)
+        cursor.execute(
+            """
+            SELECT id, full_name, role, status, department
+            FROM users
+            WHERE is_active = true AND role IN ('operator', 'okk', 'admin')
+            ORDER BY full_name
+            """
+        )
+        body = dump_json(fetch_records(cursor))
+        etag = f'W/"{hashlib.md5(body.encode("utf-8")).hexdigest()[:20]}"'
+        # Реплика могла ещё не получить смену статуса, о которой уже пришёл NOTIFY, -
+        # прочитанный с неё ростер живёт не дольше допустимого отставания
+        ttl = min(ROSTER_CACHE_TTL, REPLICA_MAX_LAG_SECONDS) if conn.replica else ROSTER_CACHE_TTL
+        with _presence_lock:
+            _roster_cache.update({'body': body, 'etag': etag, 'expires_at': now + ttl})
+    
+    headers = {
+        'Content-Type': 'application/json',
+        'Access-Control-Allow-Origin': '*',
+        'ETag': etag,
+        'Access-Control-Expose-Headers': 'ETag'
+    }
+    if body_data.get('if_none_match') == etag:
+        return {'statusCode': 200, 'headers': headers, 'body': '{"not_modified": true}', 'isBase64Encoded': False}
+    
+    return {
+        'statusCode': 200,
+        'headers': headers,
+        'body': body,
+        'isBase64Encoded': False
+    }
+
+
+def handle_heartbeat(event: Dict[str, Any], conn) -> Dict[str, Any]:
+    headers = event.get('headers', {})
+    session_token = headers.get('x-session-token') or headers.get('X-Session-Token')
+    
+    if not session_token:
+        return {
+            'statusCode': 401,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': dump_json({'error': 'Unauthorized'}),
+            'isBase64Encoded': False
+        }
+    
+    session = resolve_session(conn, session_token)
+    
+    if not session:
+        return {
+            'statusCode': 401,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': dump_json({'error': 'Session expired'}),
+            'isBase64Encoded': False
+        }
+    
+    status = session['status']
+    write, sweep = claim_presence_work(session['id'])
+    
+    if write or sweep:
+        cursor = conn.cursor()
+        if write:
+            execute_named(cursor, 'presence_touch', (session['id'],))
+            status = cursor.fetchone()['status']
+        if sweep:
+            # Зависшие вкладки (нет heartbeat дольше PRESENCE_TIMEOUT) переводятся в offline
+            cursor.execute("SELECT demote_stale_operators(%s) AS demoted", (PRESENCE_TIMEOUT,))
+        conn.commit()
     
     return {
         'statusCode': 200,
         'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps([dict(op) for op in operators]),
+        'body': dump_json({'success': True, 'status': status}),
         'isBase64Encoded': False
     }
\ No newline at end of file
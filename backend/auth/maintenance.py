@@ -0,0 +1,91 @@
+import argparse
+import os
+import psycopg2
+
+
+def delete_in_batches(conn, query: str, params: tuple, batch_size: int) -> int:
+    cursor = conn.cursor()
+    total = 0
+    # Небольшие пачки с коммитом после каждой, чтобы не держать долгие блокировки
+    while True:
+        cursor.execute(query, params + (batch_size,))
+        deleted = cursor.rowcount
+        conn.commit()
+        total += deleted
+        if deleted < batch_size:
+            return total
+
+
+def demote_stale_operators(conn, timeout_seconds: int) -> int:
+    # Та же функция, что вызывает heartbeat: снимает с линии и рассылает уведомления,
+    # но не зависит от того, остался ли в сети хоть один живой клиент
+    cursor = conn.cursor()
+    cursor.execute("SELECT demote_stale_operators(%s) AS demoted", (timeout_seconds,))
+    demoted = cursor.fetchone()[0]
+    conn.commit()
+    return demoted
+
+
+def main() -> None:
+    '''
+    Business: Scheduled cleanup for auth storage - sets staff without a recent
+              heartbeat offline, deletes expired sessions and stale login
+              throttle counters in small batches
+    Usage: DATABASE_URL=... python backend/auth/maintenance.py [--grace-hours N] [--presence-only]
+    '''
+    parser = argparse.ArgumentParser(description='Auth storage maintenance')
+    parser.add_argument('--grace-hours', type=int, default=0)
+    parser.add_argument('--throttle-after-hours', type=int, default=24)
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--presence-timeout', type=int, default=int(os.environ.get('PRESENCE_TIMEOUT', '120')))
+    parser.add_argument('--presence-only', action='store_true')
+    args = parser.parse_args()
+    
+    conn = psycopg2.connect(os.environ.get('DATABASE_URL'))
+    
+    try:
+        demoted = demote_stale_operators(conn, args.presence_timeout)
+        print(f'stale operators set offline: {demoted}')
+        
+        if args.presence_only:
+            return
+        
+        sessions = delete_in_batches(
+            conn,
+            """
+            DELETE FROM sessions
+            WHERE id IN (
+                SELECT id FROM sessions
+                WHERE expires_at < CURRENT_TIMESTAMP - make_interval(hours => %s)
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            )
+            """,
+            (args.grace_hours,),
+            args.batch_size
+        )
+        print(f'sessions deleted: {sessions}')
+        
+        throttles = delete_in_batches(
+            conn,
+            """
+            DELETE FROM login_throttle
+            WHERE throttle_key IN (
+                SELECT throttle_key FROM login_throttle
+                WHERE window_started_at < CURRENT_TIMESTAMP - make_interval(hours => %s)
+                  AND (locked_until IS NULL OR locked_until < CURRENT_TIMESTAMP)
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            )
+            """,
+            (args.throttle_after_hours,),
+            args.batch_size
+        )
+        print(f'login throttle entries deleted: {throttles}')
+    
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
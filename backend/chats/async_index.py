@@ -0,0 +1,509 @@
+import asyncio
+import importlib.util
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Dict, Any, Awaitable, List, Optional, Set
+
+import asyncpg
+
+ASYNC_POOL_MIN = int(os.environ.get('ASYNC_POOL_MIN', '2'))
+ASYNC_POOL_MAX = int(os.environ.get('ASYNC_POOL_MAX', '20'))
+ASYNC_SYNC_WORKERS = int(os.environ.get('ASYNC_SYNC_WORKERS', '8'))
+
+
+def load_sync_module():
+    '''
+    Imports the sibling index.py once per process under the name the gateway
+    uses, so async and sync paths share its pool, caches and helpers
+    '''
+    name = f'{Path(__file__).resolve().parent.name}_index'
+    module = sys.modules.get(name)
+    if module is None:
+        spec = importlib.util.spec_from_file_location(name, Path(__file__).resolve().with_name('index.py'))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        sys.modules[name] = module
+    return module
+
+
+index = load_sync_module()
+
+# Каждый поток держит psycopg2-соединение из пула index: потоки сверх DB_POOL_MAX только ждали бы слот до PoolError
+_sync_executor = ThreadPoolExecutor(
+    max_workers=min(ASYNC_SYNC_WORKERS, index.DB_POOL_MAX), thread_name_prefix='chats-sync'
+)
+_pool: Optional[asyncpg.Pool] = None
+_replica_pool: Optional[asyncpg.Pool] = None
+_pool_lock: Optional[asyncio.Lock] = None
+_current_trace: ContextVar[Optional[Any]] = ContextVar('chats_trace', default=None)
+
+# Та же проверка, что в index.get_read_connection, с параметрами asyncpg
+REPLICA_STATUS_SQL = """
+    SELECT COALESCE(CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                         ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END, 0) AS lag_seconds,
+           COALESCE($1::text::pg_lsn IS NULL OR pg_last_wal_replay_lsn() >= $1::text::pg_lsn, true) AS caught_up
+"""
+
+
+async def get_pool(replica: bool = False) -> asyncpg.Pool:
+    # Пулы привязаны к циклу событий, в котором созданы: один цикл на процесс
+    global _pool, _replica_pool, _pool_lock
+    pool = _replica_pool if replica else _pool
+    if pool is not None:
+        return pool
+    if _pool_lock is None:
+        _pool_lock = asyncio.Lock()
+    async with _pool_lock:
+        if replica and _replica_pool is None:
+            _replica_pool = await create_pool(index.DATABASE_READ_URL)
+        if not replica and _pool is None:
+            _pool = await create_pool(os.environ.get('DATABASE_URL'))
+    return _replica_pool if replica else _pool
+
+
+async def create_pool(dsn: Optional[str]) -> asyncpg.Pool:
+    return await asyncpg.create_pool(
+        dsn,
+        min_size=ASYNC_POOL_MIN,
+        max_size=ASYNC_POOL_MAX,
+        statement_cache_size=100 if index.DB_PREPARE_STATEMENTS else 0
+    )
+
+
+async def get_read_pool(min_lsn: Optional[str]) -> asyncpg.Pool:
+    '''
+    Async counterpart of index.get_read_connection: the DATABASE_READ_URL replica
+    when it has replayed min_lsn and lags less than REPLICA_MAX_LAG_SECONDS,
+    otherwise the primary. The lag verdict and counters are shared with the sync path
+    '''
+    if not index.DATABASE_READ_URL or (min_lsn and not index.LSN_PATTERN.match(str(min_lsn))):
+        return await get_pool()
+
+    now = time.monotonic()
+    with index._pool_lock:
+        checked_at, lagging = index._replica_state['checked_at'], index._replica_state['lagging']
+    fresh = now - checked_at < index.REPLICA_LAG_CHECK_INTERVAL
+
+    if lagging and not min_lsn and fresh:
+        return await replica_fallback()
+
+    try:
+        replica = await get_pool(replica=True)
+        if min_lsn or not fresh:
+            status = await fetch(replica, 'fetchrow', REPLICA_STATUS_SQL, min_lsn)
+            lagging = float(status['lag_seconds']) > index.REPLICA_MAX_LAG_SECONDS
+            index.mark_replica_lagging(now, lagging)
+            if lagging or not status['caught_up']:
+                return await replica_fallback()
+    except (OSError, asyncio.TimeoutError, asyncpg.PostgresError, asyncpg.InterfaceError):
+        index.mark_replica_lagging(now, True)
+        return await replica_fallback()
+
+    with index._pool_lock:
+        index.pool_stats['replica_reads'] += 1
+    return replica
+
+
+async def replica_fallback() -> asyncpg.Pool:
+    with index._pool_lock:
+        index.pool_stats['replica_fallbacks'] += 1
+    return await get_pool()
+
+
+@asynccontextmanager
+async def acquire(pool: asyncpg.Pool):
+    trace = _current_trace.get()
+    started = time.perf_counter()
+    async with pool.acquire() as conn:
+        if trace is not None:
+            trace.add_span('connect', time.perf_counter() - started)
+        yield conn
+
+
+async def fetch(conn, method: str, query: str, *args) -> Any:
+    '''
+    Runs conn.<method>(query, *args) - fetch, fetchrow or execute - timing it in
+    the request trace under the same fingerprints as the sync TracingCursor
+    '''
+    trace = _current_trace.get()
+    if trace is None:
+        return await getattr(conn, method)(query, *args)
+    started = time.perf_counter()
+    result = None
+    try:
+        result = await getattr(conn, method)(query, *args)
+        return result
+    finally:
+        rows = len(result) if isinstance(result, list) else int(result is not None and method == 'fetchrow')
+        trace.add_query(query, time.perf_counter() - started, rows)
+
+
+def dump_json(payload: Any) -> str:
+    trace = _current_trace.get()
+    if trace is None:
+        return index.to_json(payload)
+    started = time.perf_counter()
+    try:
+        return index.to_json(payload)
+    finally:
+        trace.add_span('serialize', time.perf_counter() - started)
+
+
+async def run_native(event: Dict[str, Any], context: Any, respond: Awaitable[Dict[str, Any]]) -> Dict[str, Any]:
+    '''
+    Finishes an action served on asyncpg the way index.handler finishes the rest:
+    compressed body and, with TRACE_REQUESTS on, a Server-Timing header and one
+    JSON log line per request
+    '''
+    if not index.TRACE_REQUESTS:
+        return index.compress_response(event, await respond)
+
+    trace = index.RequestTrace(getattr(context, 'request_id', ''))
+    token = _current_trace.set(trace)
+    status: Any = 'error'
+    try:
+        response = index.compress_response(event, await respond)
+        status = response.get('statusCode')
+        trace.add_span('total', time.perf_counter() - trace.started)
+        response['headers'] = {
+            **response.get('headers', {}),
+            'Server-Timing': trace.server_timing(),
+            'Timing-Allow-Origin': '*'
+        }
+        return response
+    finally:
+        _current_trace.reset(token)
+        if 'total' not in trace.spans:
+            trace.add_span('total', time.perf_counter() - trace.started)
+        if trace.spans['total'] * 1000 >= index.TRACE_SLOW_MS:
+            print(json.dumps(trace.to_log('chats', event, status), ensure_ascii=False), flush=True)
+
+
+class NotificationHub:
+    '''
+    One LISTEN connection per process shared by every waiting request: a channel
+    is LISTENed while at least one waiter needs it, and each payload is pushed to
+    the queues of that channel's waiters
+    '''
+    def __init__(self):
+        self.conn: Optional[asyncpg.Connection] = None
+        self.waiters: Dict[str, Set[asyncio.Queue]] = {}
+        self.lock: Optional[asyncio.Lock] = None
+
+    async def subscribe(self, channels: List[str], queue: asyncio.Queue) -> None:
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            if self.conn is None or self.conn.is_closed():
+                # После обрыва ждущие досрочно не будятся: по таймауту клиент переспросит с after_id
+                self.conn = await asyncpg.connect(os.environ.get('DATABASE_URL'))
+                for channel in self.waiters:
+                    await self.conn.add_listener(channel, self.dispatch)
+            for channel in channels:
+                if channel not in self.waiters:
+                    self.waiters[channel] = set()
+                    await self.conn.add_listener(channel, self.dispatch)
+                self.waiters[channel].add(queue)
+
+    async def unsubscribe(self, channels: List[str], queue: asyncio.Queue) -> None:
+        async with self.lock:
+            for channel in channels:
+                waiters = self.waiters.get(channel)
+                if waiters is None:
+                    continue
+                waiters.discard(queue)
+                if not waiters:
+                    del self.waiters[channel]
+                    if not self.conn.is_closed():
+                        await self.conn.remove_listener(channel, self.dispatch)
+
+    def dispatch(self, connection, pid: int, channel: str, payload: str) -> None:
+        for queue in self.waiters.get(channel, ()):
+            queue.put_nowait(payload)
+
+    async def close(self) -> None:
+        if self.conn is not None and not self.conn.is_closed():
+            await self.conn.close()
+        self.conn = None
+        self.waiters.clear()
+
+
+_hub = NotificationHub()
+
+
+async def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    '''
+    Business: Async dispatch for the chats function when self-hosted behind one
+              event loop - wait_for_events waits on a shared LISTEN connection
+              without holding a thread, get_messages and send_message run on
+              asyncpg, every other action runs the sync handler on a thread pool
+              no larger than its connection pool
+    Args: event - dict with httpMethod, body, queryStringParameters
+          context - object with request_id attribute
+    Returns: HTTP response dict, the same as index.handler
+    '''
+    if event.get('httpMethod') == 'POST' and event.get('body'):
+        try:
+            body_data = json.loads(event['body'])
+        except ValueError:
+            body_data = None
+
+        action = body_data.get('action') if isinstance(body_data, dict) else None
+        if action == 'wait_for_events':
+            return await run_native(event, context, handle_wait_for_events(body_data))
+        if action == 'get_messages':
+            params = parse_messages_params(body_data)
+            if params is not None:
+                return await run_native(event, context, handle_get_messages(params))
+        if action == 'send_message':
+            params = parse_send_params(body_data)
+            if params is not None:
+                return await run_native(event, context, handle_send_message(params))
+
+    # Разбор некорректных запросов и все прочие действия - в sync-хендлере, с его же ответами об ошибках
+    return await asyncio.get_running_loop().run_in_executor(_sync_executor, index.handler, event, context)
+
+
+def parse_messages_params(body_data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    '''
+    Typed parameters for the native get_messages, or None when the request is
+    malformed and should get the sync handler's error response instead
+    '''
+    after_id = body_data.get('after_id', body_data.get('since_id'))
+    before_id = body_data.get('before_id')
+    limit = body_data.get('limit')
+
+    if not body_data.get('chat_id') or (after_id is not None and before_id is not None):
+        return None
+    try:
+        params = {
+            'chat_id': int(body_data['chat_id']),
+            'after_id': int(after_id) if after_id is not None else None,
+            'before_id': int(before_id) if before_id is not None else None,
+            'paged': not (after_id is None and before_id is None and limit is None),
+            'limit': min(int(limit or index.MESSAGES_PAGE_MAX), index.MESSAGES_PAGE_MAX),
+            'min_lsn': body_data.get('min_lsn'),
+            'if_none_match': body_data.get('if_none_match'),
+            # ETag строится из тех же сырых значений, что и в sync-пути, чтобы токены совпадали
+            'etag_parts': (body_data['chat_id'], after_id, before_id, limit)
+        }
+    except (TypeError, ValueError):
+        return None
+    return params if params['limit'] > 0 else None
+
+
+async def handle_get_messages(params: Dict[str, Any]) -> Dict[str, Any]:
+    pool = await get_read_pool(params['min_lsn'])
+    async with acquire(pool) as conn:
+        response = await read_messages(conn, params)
+    if params['min_lsn'] and pool is _replica_pool:
+        response['headers'] = index.with_min_lsn_reached(response['headers'])
+    return response
+
+
+async def read_messages(conn, params: Dict[str, Any]) -> Dict[str, Any]:
+    chat_id, after_id, before_id, limit = params['chat_id'], params['after_id'], params['before_id'], params['limit']
+
+    # Как и в sync-пути, версия читается до сообщений, поэтому токен не бывает новее данных
+    chat_version = await fetch(conn, 'fetchrow', index.QUERY_CATALOG['chat_version'], chat_id)
+    etag = None
+    if chat_version:
+        chat_id_raw, after_raw, before_raw, limit_raw = params['etag_parts']
+        etag = index.make_etag('messages', chat_id_raw, chat_version['version'], after_raw, before_raw, limit_raw)
+    if etag and params['if_none_match'] == etag:
+        return index.not_modified_response(etag)
+
+    archived = bool(chat_version and chat_version['archived'])
+    if archived:
+        archive = await fetch(conn, 'fetchrow', "SELECT messages FROM chat_archive WHERE chat_id = $1", chat_id)
+        archived_messages = json.loads(archive['messages']) if archive else []
+
+    if not params['paged']:
+        if archived:
+            messages = archived_messages
+        else:
+            messages = [dict(row) for row in await fetch(conn, 'fetch', index.QUERY_CATALOG['messages_all'], chat_id)]
+        return {
+            'statusCode': 200,
+            'headers': index.etag_headers(etag),
+            'body': dump_json(messages),
+            'isBase64Encoded': False
+        }
+
+    if archived:
+        messages = index.slice_archived_messages(archived_messages, after_id, before_id, limit + 1)
+    elif after_id is not None:
+        rows = await fetch(conn, 'fetch', index.QUERY_CATALOG['messages_after'], chat_id, after_id, limit + 1)
+        messages = [dict(row) for row in rows]
+    else:
+        rows = await fetch(conn, 'fetch', index.QUERY_CATALOG['messages_before'], chat_id, before_id, limit + 1)
+        messages = [dict(row) for row in rows]
+
+    has_more = len(messages) > limit
+    messages = messages[:limit] if after_id is not None else messages[:limit][::-1]
+
+    return {
+        'statusCode': 200,
+        'headers': index.etag_headers(etag),
+        'body': dump_json({
+            'messages': messages,
+            'next_after_id': messages[-1]['id'] if messages else after_id,
+            'next_before_id': messages[0]['id'] if messages else before_id,
+            'has_more': has_more
+        }),
+        'isBase64Encoded': False
+    }
+
+
+def parse_send_params(body_data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    sender_id = body_data.get('sender_id')
+    message_text = body_data.get('message_text', '')
+    sender_type = body_data.get('sender_type', 'client')
+
+    if not body_data.get('chat_id') or not message_text or not isinstance(message_text, str) or not isinstance(sender_type, str):
+        return None
+    try:
+        return {
+            'chat_id': int(body_data['chat_id']),
+            'sender_type': sender_type,
+            'sender_id': int(sender_id) if sender_id is not None else None,
+            'message_text': message_text
+        }
+    except (TypeError, ValueError):
+        return None
+
+
+async def handle_send_message(params: Dict[str, Any]) -> Dict[str, Any]:
+    async with acquire(await get_pool()) as conn:
+        # Ошибки базы (нет чата, неверный sender_type) откатывают транзакцию и уходят наверх, как в sync-пути
+        async with conn.transaction():
+            message = dict(await fetch(
+                conn, 'fetchrow', index.QUERY_CATALOG['message_insert'],
+                params['chat_id'], params['sender_type'], params['sender_id'], params['message_text']
+            ))
+            chat = await fetch(
+                conn, 'fetchrow', index.QUERY_CATALOG['chat_summary_update'],
+                message['id'], message['message_text'], message['created_at'], message['sender_type'], message['chat_id']
+            )
+
+            if chat and params['sender_type'] == 'operator' and chat['first_response_at'] == message['created_at']:
+                operator_id = params['sender_id'] or chat['assigned_operator_id']
+                if operator_id:
+                    await fetch(
+                        conn, 'execute', index.QUERY_CATALOG['operator_stats_bump'],
+                        operator_id, message['created_at'].date(), 0, 0.0, 1,
+                        (message['created_at'] - chat['created_at']).total_seconds()
+                    )
+
+            if chat:
+                await fetch(conn, 'execute', index.QUERY_CATALOG['chat_notify'], *index.chat_event_notification(
+                    {'type': 'message', 'chat_id': message['chat_id'], 'message_id': message['id'],
+                     'sender_type': message['sender_type']},
+                    operator_ids=[chat['assigned_operator_id']],
+                    queue=chat['status'] == 'waiting'
+                ))
+
+        if index.DATABASE_READ_URL:
+            message['read_lsn'] = await fetch(conn, 'fetchval', "SELECT pg_current_wal_lsn()::text")
+
+    return {
+        'statusCode': 201,
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+        'body': dump_json(message),
+        'isBase64Encoded': False
+    }
+
+
+async def handle_wait_for_events(body_data: Dict[str, Any]) -> Dict[str, Any]:
+    try:
+        params = index.parse_wait_params(body_data)
+    except ValueError as error:
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': dump_json({'error': str(error)}),
+            'isBase64Encoded': False
+        }
+
+    queue: asyncio.Queue = asyncio.Queue()
+    await _hub.subscribe(params['channels'], queue)
+
+    try:
+        # Подписка оформлена до проверки пропущенного, так что событие не теряется между ними
+        events = await find_missed_events(params)
+        if not events:
+            try:
+                events.append(json.loads(await asyncio.wait_for(queue.get(), timeout=params['timeout'])))
+            except asyncio.TimeoutError:
+                pass
+            while not queue.empty():
+                events.append(json.loads(queue.get_nowait()))
+    finally:
+        await _hub.unsubscribe(params['channels'], queue)
+
+    return {
+        'statusCode': 200,
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+        'body': dump_json({'events': events, 'timed_out': not events}),
+        'isBase64Encoded': False
+    }
+
+
+async def find_missed_events(params: Dict[str, Any]) -> List[Dict[str, Any]]:
+    pool = await get_pool()
+
+    if params['chat_ids'] and params['after_id'] is not None:
+        missed = await fetch(
+            pool, 'fetchrow', index.QUERY_CATALOG['wait_missed_message'], params['chat_ids'], params['after_id']
+        )
+        if missed:
+            return [{'type': 'message', 'chat_id': missed['chat_id'], 'message_id': missed['id'],
+                     'sender_type': missed['sender_type']}]
+
+    if params['changed_since'] and (params['operator_id'] or params['include_queue']):
+        missed = await fetch(
+            pool, 'fetchrow', index.QUERY_CATALOG['wait_missed_chat'],
+            params['changed_since'], params['operator_id'], params['include_queue']
+        )
+        if missed:
+            return [{'type': 'chat_changed', 'chat_id': missed['id'], 'status': missed['status']}]
+
+    return []
+
+
+async def close() -> None:
+    global _pool, _replica_pool
+    await _hub.close()
+    for pool in (_pool, _replica_pool):
+        if pool is not None:
+            await pool.close()
+    _pool = _replica_pool = None
+
+
+_loop_lock = threading.Lock()
+_background_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+def get_background_loop() -> asyncio.AbstractEventLoop:
+    global _background_loop
+    with _loop_lock:
+        if _background_loop is None:
+            _background_loop = asyncio.new_event_loop()
+            threading.Thread(target=_background_loop.run_forever, name='chats-async', daemon=True).start()
+        return _background_loop
+
+
+def sync_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    '''
+    Compatibility wrapper with the sync handler signature: runs the async handler
+    on a background event loop that lives as long as the container, so the
+    asyncpg pools and LISTEN connection survive warm invocations
+    '''
+    return asyncio.run_coroutine_threadsafe(handler(event, context), get_background_loop()).result()
@@ -0,0 +1,135 @@
+import argparse
+import os
+import sys
+from datetime import datetime
+from typing import Dict, Any
+import psycopg2
+
+# Общий фильтр чатов выгрузки; подставляется во все запросы через mogrify
+CHAT_FILTER = """
+    c.created_at >= %(date_from)s AND c.created_at < %(date_to)s
+    AND (NOT %(rated_only)s OR EXISTS (SELECT 1 FROM qc_ratings r WHERE r.chat_id = c.id))
+"""
+
+EXPORT_QUERIES = {
+    'chats': f"""
+        SELECT c.id, c.client_name, c.client_email, c.department, c.status,
+               c.assigned_operator_id, u.full_name as assigned_operator_name,
+               c.created_at, c.updated_at, c.archived_at
+        FROM chats c
+        LEFT JOIN users u ON c.assigned_operator_id = u.id
+        WHERE {CHAT_FILTER}
+        ORDER BY c.id
+    """,
+    'messages': f"""
+        SELECT m.id, m.chat_id, m.sender_type, m.sender_id, m.message_text, m.is_read, m.created_at
+        FROM messages m
+        WHERE m.chat_id IN (SELECT c.id FROM chats c WHERE {CHAT_FILTER})
+        UNION ALL
+        SELECT a.id, a.chat_id, a.sender_type, a.sender_id, a.message_text, a.is_read, a.created_at
+        FROM chat_archive ca
+        CROSS JOIN LATERAL jsonb_to_recordset(ca.messages) AS a(
+            id INTEGER, chat_id INTEGER, sender_type VARCHAR, sender_id INTEGER,
+            message_text TEXT, is_read BOOLEAN, created_at TIMESTAMP
+        )
+        WHERE ca.chat_id IN (SELECT c.id FROM chats c WHERE {CHAT_FILTER})
+        ORDER BY chat_id, id
+    """,
+    'notes': f"""
+        SELECT n.id, n.chat_id, n.operator_id, n.note_text, n.created_at
+        FROM chat_notes n
+        WHERE n.chat_id IN (SELECT c.id FROM chats c WHERE {CHAT_FILTER})
+        UNION ALL
+        SELECT a.id, a.chat_id, a.operator_id, a.note_text, a.created_at
+        FROM chat_archive ca
+        CROSS JOIN LATERAL jsonb_to_recordset(ca.notes) AS a(
+            id INTEGER, chat_id INTEGER, operator_id INTEGER, note_text TEXT, created_at TIMESTAMP
+        )
+        WHERE ca.chat_id IN (SELECT c.id FROM chats c WHERE {CHAT_FILTER})
+        ORDER BY chat_id, id
+    """,
+    'qc_ratings': f"""
+        SELECT r.id, r.chat_id, r.operator_id, r.qc_user_id, r.score, r.comment, r.created_at,
+               o.full_name as operator_name, q.full_name as qc_user_name
+        FROM qc_ratings r
+        JOIN users o ON r.operator_id = o.id
+        JOIN users q ON r.qc_user_id = q.id
+        WHERE r.chat_id IN (SELECT c.id FROM chats c WHERE {CHAT_FILTER})
+        ORDER BY r.chat_id
+    """
+}
+
+
+def copy_table(cursor, table: str, params: Dict[str, Any], export_format: str, out) -> None:
+    '''
+    Streams one dataset through COPY ... TO STDOUT; psycopg2 writes it to out
+    in fixed-size chunks, so memory use does not depend on the export size
+    '''
+    query = cursor.mogrify(EXPORT_QUERIES[table], params).decode('utf-8')
+
+    if export_format == 'csv':
+        cursor.copy_expert(f"COPY ({query}) TO STDOUT WITH (FORMAT csv, HEADER true)", out)
+    else:
+        # Управляющие символы как QUOTE/DELIMITER: строки JSON выходят без CSV-экранирования
+        cursor.copy_expert(
+            f"""
+            COPY (
+                SELECT (to_jsonb(t) || jsonb_build_object('type', '{table}'))::text
+                FROM ({query}) t
+            ) TO STDOUT WITH (FORMAT csv, QUOTE E'\\x01', DELIMITER E'\\x02')
+            """,
+            out
+        )
+
+
+def main() -> None:
+    '''
+    Business: Bulk export of chats, transcripts, notes and QC ratings for a date range
+    Usage: DATABASE_URL=... python backend/chats/export.py --from 2024-05-01 --to 2024-06-01 [--format csv --output DIR]
+    '''
+    parser = argparse.ArgumentParser(description='Export chats and transcripts')
+    parser.add_argument('--from', dest='date_from', required=True, type=datetime.fromisoformat)
+    parser.add_argument('--to', dest='date_to', required=True, type=datetime.fromisoformat)
+    parser.add_argument('--format', dest='export_format', choices=['ndjson', 'csv'], default='ndjson')
+    parser.add_argument('--tables', default=','.join(EXPORT_QUERIES))
+    parser.add_argument('--rated-only', action='store_true')
+    parser.add_argument('--output', default='-', help='file for ndjson, directory for csv, - for stdout')
+    args = parser.parse_args()
+
+    tables = [table for table in args.tables.split(',') if table]
+    unknown = [table for table in tables if table not in EXPORT_QUERIES]
+    if unknown:
+        parser.error(f"unknown tables: {', '.join(unknown)}")
+    if args.export_format == 'csv' and args.output == '-' and len(tables) > 1:
+        parser.error('csv export of several tables needs --output DIR')
+
+    params = {'date_from': args.date_from, 'date_to': args.date_to, 'rated_only': args.rated_only}
+    conn = psycopg2.connect(os.environ.get('DATABASE_URL'))
+    conn.set_client_encoding('UTF8')
+
+    try:
+        # Все таблицы выгружаются из одного снимка, чтобы ссылки между ними сходились
+        conn.set_session(isolation_level='REPEATABLE READ', readonly=True)
+        cursor = conn.cursor()
+
+        if args.export_format == 'csv' and args.output != '-':
+            os.makedirs(args.output, exist_ok=True)
+            for table in tables:
+                with open(os.path.join(args.output, f'{table}.csv'), 'w', encoding='utf-8', newline='') as out:
+                    copy_table(cursor, table, params, 'csv', out)
+        elif args.output == '-':
+            for table in tables:
+                copy_table(cursor, table, params, args.export_format, sys.stdout)
+        else:
+            with open(args.output, 'w', encoding='utf-8') as out:
+                for table in tables:
+                    copy_table(cursor, table, params, args.export_format, out)
+
+        conn.rollback()
+
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
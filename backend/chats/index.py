@@ -1,9 +1,699 @@
+import base64
+import functools
+import gzip
+import hashlib
 import json
 import os
+import re
+import select
+import threading
+import time
+from contextlib import contextmanager
 import psycopg2
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE, TRANSACTION_STATUS_UNKNOWN, connection as connection_type, cursor as cursor_type
 from psycopg2.extras import RealDictCursor
-from typing import Dict, Any
+from psycopg2.errors import InvalidSqlStatementName
+from psycopg2.pool import PoolError
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from typing import Dict, Any, List, Tuple, Optional
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+DB_POOL_MAX = int(os.environ.get('DB_POOL_MAX', '4'))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', '5'))
+DB_POOL_CHECK_AFTER = float(os.environ.get('DB_POOL_CHECK_AFTER', '30'))
+DATABASE_READ_URL = os.environ.get('DATABASE_READ_URL')
+DB_READ_POOL_MAX = int(os.environ.get('DB_READ_POOL_MAX', str(DB_POOL_MAX)))
+
+_pool_lock = threading.Lock()
+_pool_slots = threading.BoundedSemaphore(DB_POOL_MAX)
+_pool_idle: List[Tuple[Any, float]] = []
+_replica_slots = threading.BoundedSemaphore(DB_READ_POOL_MAX)
+_replica_idle: List[Tuple[Any, float]] = []
+pool_stats: Dict[str, int] = {'hits': 0, 'misses': 0, 'reconnects': 0, 'replica_reads': 0, 'replica_fallbacks': 0}
+
+MESSAGES_PAGE_MAX = 200
+CHATS_PAGE_MAX = 200
+CHANGES_OVERLAP_SECONDS = 2
+WAIT_DEFAULT_SECONDS = 20
+WAIT_MAX_SECONDS = 25
+BATCH_MAX_ITEMS = 20
+SEARCH_PAGE_MAX = 50
+SEARCH_OFFSET_MAX = 1000
+STATS_GROUPINGS = ('total', 'day', 'week', 'month')
+CHAT_STATUSES = ('waiting', 'active', 'closed')
+READ_ACTIONS = ('get_messages', 'get_notes', 'get_qc_ratings', 'get_operator_stats', 'search_messages')
+PRESENCE_TIMEOUT = int(os.environ.get('PRESENCE_TIMEOUT', '120'))
+# Ожидающий wait_for_events держит соединение пула до WAIT_MAX_SECONDS - часть пула всегда остаётся остальным
+WAIT_SYNC_MAX_WAITERS = max(
+    min(int(os.environ.get('WAIT_SYNC_MAX_WAITERS', str(DB_POOL_MAX // 2))), DB_POOL_MAX - 1), 0
+)
+_wait_slots = threading.BoundedSemaphore(WAIT_SYNC_MAX_WAITERS) if WAIT_SYNC_MAX_WAITERS else None
+
+
+def get_connection(replica: bool = False):
+    '''
+    Checks out a connection from the warm-container pool (the DATABASE_READ_URL
+    pool with replica=True), opening a new one when nothing is idle and
+    replacing idle connections that went stale
+    '''
+    slots, idle_connections = (_replica_slots, _replica_idle) if replica else (_pool_slots, _pool_idle)
+    if not slots.acquire(timeout=DB_POOL_TIMEOUT):
+        raise PoolError('Connection pool exhausted')
+    
+    try:
+        with _pool_lock:
+            idle = idle_connections.pop() if idle_connections else None
+        
+        if idle:
+            conn, released_at = idle
+            if is_connection_alive(conn, released_at):
+                with _pool_lock:
+                    pool_stats['hits'] += 1
+                return conn
+            close_quietly(conn)
+            with _pool_lock:
+                pool_stats['reconnects'] += 1
+        else:
+            with _pool_lock:
+                pool_stats['misses'] += 1
+        
+        return open_connection(replica)
+    except Exception:
+        slots.release()
+        raise
+
+
+def open_connection(replica: bool = False):
+    conn = psycopg2.connect(
+        DATABASE_READ_URL if replica else os.environ.get('DATABASE_URL'), connection_factory=CatalogConnection,
+        cursor_factory=TracingCursor if TRACE_REQUESTS else RealDictCursor
+    )
+    conn.replica = replica
+    return conn
+
+
+def release_connection(conn) -> None:
+    slots, idle_connections = (_replica_slots, _replica_idle) if conn.replica else (_pool_slots, _pool_idle)
+    try:
+        if not conn.closed:
+            tx_status = conn.get_transaction_status()
+            if tx_status == TRANSACTION_STATUS_UNKNOWN:
+                close_quietly(conn)
+            elif tx_status != TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+        if not conn.closed:
+            with _pool_lock:
+                idle_connections.append((conn, time.monotonic()))
+    except psycopg2.Error:
+        close_quietly(conn)
+    finally:
+        slots.release()
+
+
+def is_connection_alive(conn, released_at: float) -> bool:
+    if conn.closed:
+        return False
+    if time.monotonic() - released_at < DB_POOL_CHECK_AFTER:
+        return True
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute('SELECT name FROM pg_prepared_statements')
+            kept = {row['name'] for row in cursor.fetchall()}
+        conn.rollback()
+        # Простоявшая сессия могла пережить DISCARD - забываем то, чего сервер уже не хранит
+        if not conn.prepared <= kept:
+            conn.forget_prepared()
+        return True
+    except psycopg2.Error:
+        return False
+
+
+def close_quietly(conn) -> None:
+    try:
+        conn.close()
+    except psycopg2.Error:
+        pass
+
+
+def get_pool_stats() -> Dict[str, int]:
+    with _pool_lock:
+        return {**pool_stats, 'idle': len(_pool_idle), 'max': DB_POOL_MAX, 'replica_idle': len(_replica_idle)}
+
+
+REPLICA_MAX_LAG_SECONDS = float(os.environ.get('REPLICA_MAX_LAG_SECONDS', '5'))
+REPLICA_LAG_CHECK_INTERVAL = float(os.environ.get('REPLICA_LAG_CHECK_INTERVAL', '1'))
+LSN_PATTERN = re.compile(r'^[0-9A-Fa-f]{1,8}/[0-9A-Fa-f]{1,8}$')
+
+_replica_state: Dict[str, Any] = {'checked_at': float('-inf'), 'lagging': False}
+
+
+def get_read_connection(min_lsn: Optional[str] = None):
+    '''
+    Connection for a read-only action: the DATABASE_READ_URL replica when it has
+    replayed min_lsn (the read_lsn a client got back from a write) and lags less
+    than REPLICA_MAX_LAG_SECONDS, otherwise the primary. Without min_lsn the lag
+    verdict is reused for REPLICA_LAG_CHECK_INTERVAL seconds
+    '''
+    if not DATABASE_READ_URL or (min_lsn and not LSN_PATTERN.match(str(min_lsn))):
+        return get_connection()
+    
+    now = time.monotonic()
+    with _pool_lock:
+        checked_at, lagging = _replica_state['checked_at'], _replica_state['lagging']
+    
+    if lagging and not min_lsn and now - checked_at < REPLICA_LAG_CHECK_INTERVAL:
+        return replica_fallback()
+    
+    try:
+        conn = get_connection(replica=True)
+    except (psycopg2.Error, PoolError):
+        mark_replica_lagging(now, True)
+        return replica_fallback()
+    
+    if not min_lsn and now - checked_at < REPLICA_LAG_CHECK_INTERVAL:
+        with _pool_lock:
+            pool_stats['replica_reads'] += 1
+        return conn
+    
+    try:
+        cursor = conn.cursor()
+        # На primary (или без отставания) функции восстановления дают NULL - это считается «догнала»
+        cursor.execute(
+            """
+            SELECT COALESCE(CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                                 ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END, 0) AS lag_seconds,
+                   COALESCE(%(min_lsn)s::pg_lsn IS NULL OR pg_last_wal_replay_lsn() >= %(min_lsn)s::pg_lsn, true) AS caught_up
+            """,
+            {'min_lsn': min_lsn}
+        )
+        status = cursor.fetchone()
+    except psycopg2.Error:
+        release_connection(conn)
+        mark_replica_lagging(now, True)
+        return replica_fallback()
+    
+    lagging = float(status['lag_seconds']) > REPLICA_MAX_LAG_SECONDS
+    mark_replica_lagging(now, lagging)
+    
+    if lagging or not status['caught_up']:
+        release_connection(conn)
+        return replica_fallback()
+    
+    with _pool_lock:
+        pool_stats['replica_reads'] += 1
+    return conn
+
+
+def mark_replica_lagging(now: float, lagging: bool) -> None:
+    with _pool_lock:
+        _replica_state.update(checked_at=now, lagging=lagging)
+
+
+def replica_fallback():
+    with _pool_lock:
+        pool_stats['replica_fallbacks'] += 1
+    return get_connection()
+
+
+def with_read_token(record: Dict[str, Any], cursor) -> Dict[str, Any]:
+    '''
+    Adds read_lsn, the WAL position after the write's commit, for clients to pass
+    back as min_lsn so their next reads never hit a replica that lacks the write
+    '''
+    if not DATABASE_READ_URL:
+        return dict(record)
+    cursor.execute("SELECT pg_current_wal_lsn()::text AS lsn")
+    return {**record, 'read_lsn': cursor.fetchone()['lsn']}
+
+
+def with_min_lsn_reached(headers: Dict[str, str]) -> Dict[str, str]:
+    '''
+    Marks a read served by a replica that has replayed the client's min_lsn:
+    replay only moves forward, so the client can stop sending that token
+    '''
+    exposed = [name for name in headers.get('Access-Control-Expose-Headers', '').split(', ') if name]
+    return {
+        **headers,
+        'X-Min-Lsn-Reached': '1',
+        'Access-Control-Expose-Headers': ', '.join(exposed + ['X-Min-Lsn-Reached'])
+    }
+
+
+# На реплике данные видны только до последней проигранной транзакции: водяной знак не должен
+# убегать вперёд неё, иначе следующий changed_since пропустит ещё не доехавшие изменения
+WATERMARK_SQL = """
+    CASE WHEN pg_is_in_recovery() AND pg_last_wal_receive_lsn() IS DISTINCT FROM pg_last_wal_replay_lsn()
+         THEN LEAST(LOCALTIMESTAMP, pg_last_xact_replay_timestamp()::timestamp)
+         ELSE LOCALTIMESTAMP END
+"""
+
+
+CHAT_LIST_COLUMNS = """
+    c.id, c.client_name, c.client_email, c.assigned_operator_id, c.status,
+    c.created_at, c.updated_at,
+    u.full_name as assigned_operator_name,
+    c.unread_client_count as unread_count,
+    c.last_message_text as last_message,
+    c.last_message_at as last_message_time
+"""
+
+
+# Горячие запросы функции: готовятся на соединении при первом использовании, $n - параметры
+QUERY_CATALOG: Dict[str, str] = {
+    'message_insert': """
+        INSERT INTO messages (chat_id, sender_type, sender_id, message_text)
+        VALUES ($1, $2, $3, $4)
+        RETURNING id, chat_id, sender_type, sender_id, message_text, created_at
+    """,
+    'chat_summary_update': """
+        UPDATE chats
+        SET updated_at = CURRENT_TIMESTAMP,
+            last_message_id = GREATEST(COALESCE(last_message_id, 0), $1),
+            last_message_text = CASE WHEN COALESCE(last_message_id, 0) < $1 THEN $2 ELSE last_message_text END,
+            last_message_at = CASE WHEN COALESCE(last_message_id, 0) < $1 THEN $3 ELSE last_message_at END,
+            unread_client_count = unread_client_count + CASE WHEN $4 = 'client' THEN 1 ELSE 0 END,
+            first_response_at = CASE WHEN $4 = 'operator' AND first_response_at IS NULL
+                                     THEN $3 ELSE first_response_at END
+        WHERE id = $5
+        RETURNING assigned_operator_id, status, created_at, first_response_at
+    """,
+    'operator_stats_bump': """
+        INSERT INTO operator_daily_stats
+            (operator_id, day, chats_handled, handling_seconds, first_responses, first_response_seconds)
+        VALUES ($1, $2, $3, $4, $5, $6)
+        ON CONFLICT (operator_id, day) DO UPDATE
+        SET chats_handled = operator_daily_stats.chats_handled + EXCLUDED.chats_handled,
+            handling_seconds = operator_daily_stats.handling_seconds + EXCLUDED.handling_seconds,
+            first_responses = operator_daily_stats.first_responses + EXCLUDED.first_responses,
+            first_response_seconds = operator_daily_stats.first_response_seconds + EXCLUDED.first_response_seconds
+    """,
+    'chat_notify': """
+        SELECT pg_notify(channel, $1) FROM unnest($2::text[]) AS channel
+        UNION ALL
+        SELECT pg_notify('chat_events', $3)
+    """,
+    'chat_notify_many': "SELECT pg_notify(n.channel, n.payload) FROM unnest($1::text[], $2::text[]) AS n(channel, payload)",
+    'chat_version': "SELECT xmin::text AS version, archived_at IS NOT NULL AS archived FROM chats WHERE id = $1",
+    'messages_all': """
+        SELECT m.id, m.chat_id, m.sender_type, m.sender_id, m.message_text, m.is_read, m.created_at,
+               u.full_name as sender_name
+        FROM messages m
+        LEFT JOIN users u ON m.sender_id = u.id
+        WHERE m.chat_id = $1
+        ORDER BY m.id ASC
+    """,
+    'messages_after': """
+        SELECT m.id, m.chat_id, m.sender_type, m.sender_id, m.message_text, m.is_read, m.created_at,
+               u.full_name as sender_name
+        FROM messages m
+        LEFT JOIN users u ON m.sender_id = u.id
+        WHERE m.chat_id = $1 AND m.id > $2
+        ORDER BY m.id ASC
+        LIMIT $3
+    """,
+    'messages_before': """
+        SELECT m.id, m.chat_id, m.sender_type, m.sender_id, m.message_text, m.is_read, m.created_at,
+               u.full_name as sender_name
+        FROM messages m
+        LEFT JOIN users u ON m.sender_id = u.id
+        WHERE m.chat_id = $1 AND ($2::integer IS NULL OR m.id < $2)
+        ORDER BY m.id DESC
+        LIMIT $3
+    """,
+    'chat_list_by_status': f"""
+        SELECT {CHAT_LIST_COLUMNS}
+        FROM chats c
+        LEFT JOIN users u ON c.assigned_operator_id = u.id
+        WHERE c.status = ANY($1)
+        ORDER BY c.updated_at DESC, c.id DESC
+        LIMIT $2
+    """,
+    'chat_list_by_status_after': f"""
+        SELECT {CHAT_LIST_COLUMNS}
+        FROM chats c
+        LEFT JOIN users u ON c.assigned_operator_id = u.id
+        WHERE c.status = ANY($1) AND (c.updated_at, c.id) < ($2, $3)
+        ORDER BY c.updated_at DESC, c.id DESC
+        LIMIT $4
+    """,
+    'wait_missed_message': """
+        SELECT id, chat_id, sender_type FROM messages WHERE chat_id = ANY($1) AND id > $2 ORDER BY id LIMIT 1
+    """,
+    'wait_missed_chat': """
+        SELECT id, status FROM chats
+        WHERE updated_at > $1
+          AND (($2::integer IS NOT NULL AND assigned_operator_id = $2) OR ($3 AND status = 'waiting'))
+        LIMIT 1
+    """
+}
+
+
+DB_PREPARE_STATEMENTS = os.environ.get('DB_PREPARE_STATEMENTS', '1') not in ('0', 'false')
+
+
+class CatalogConnection(connection_type):
+    '''
+    Pooled connection that remembers which QUERY_CATALOG statements its server
+    session has already prepared, and which ones failed to prepare
+    '''
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared: set = set()
+        self.executed: set = set()
+        self.unpreparable: set = set()
+        self.replica = False
+    
+    def forget_prepared(self) -> None:
+        self.prepared.clear()
+        self.executed.clear()
+
+
+def execute_named(cursor, name: str, params: Tuple = ()) -> None:
+    '''
+    Runs a QUERY_CATALOG statement by name: PREPAREd once per pooled connection,
+    then EXECUTEd so Postgres skips parsing and planning. When PREPARE fails, or
+    the first EXECUTE finds the server did not keep the statement, it runs as
+    plain SQL on that connection from then on
+    '''
+    conn = cursor.connection
+    prepared = getattr(conn, 'prepared', None)
+    
+    if DB_PREPARE_STATEMENTS and prepared is not None and name not in conn.unpreparable:
+        if name not in prepared:
+            prepare_statement(cursor, name)
+        if name in prepared:
+            statement = f"EXECUTE {name} ({', '.join(['%s'] * len(params))})" if params else f'EXECUTE {name}'
+            first = name not in conn.executed
+            fresh = conn.autocommit or conn.get_transaction_status() == TRANSACTION_STATUS_IDLE
+            # Точка сохранения нужна только первому EXECUTE после PREPARE внутри начатой транзакции:
+            # дальше сессия уже доказала, что хранит запрос. Если транзакции ещё не было, откат ничего не теряет
+            guarded = first and not fresh
+            try:
+                cursor.execute(f'SAVEPOINT catalog_execute; {statement}' if guarded else statement, params)
+            except InvalidSqlStatementName:
+                if guarded:
+                    cursor.execute('ROLLBACK TO SAVEPOINT catalog_execute')
+                elif not fresh:
+                    # Сессию сбросили (DISCARD ALL) посреди транзакции - её уже не спасти,
+                    # но следующий запрос на этом соединении подготовит всё заново
+                    conn.forget_prepared()
+                    raise
+                elif not conn.autocommit:
+                    conn.rollback()
+                if first:
+                    # PREPARE и EXECUTE попали в разные сессии (пулер в режиме транзакций) -
+                    # дальше это соединение шлёт запрос обычным текстом, начиная с этого вызова
+                    prepared.discard(name)
+                    conn.unpreparable.add(name)
+                else:
+                    conn.forget_prepared()
+            else:
+                if guarded:
+                    # Отдельным курсором, чтобы не затереть результат EXECUTE
+                    with conn.cursor() as release:
+                        release.execute('RELEASE SAVEPOINT catalog_execute')
+                conn.executed.add(name)
+                return
+    
+    cursor.execute(_catalog_fallback[name], {str(i): value for i, value in enumerate(params, 1)} or None)
+
+
+def prepare_statement(cursor, name: str) -> None:
+    conn = cursor.connection
+    # Внутри транзакции неудачный PREPARE откатывается до точки сохранения и не ломает запрос
+    in_transaction = not conn.autocommit
+    if in_transaction:
+        cursor.execute('SAVEPOINT catalog_prepare')
+    try:
+        cursor.execute(f'PREPARE {name} AS {QUERY_CATALOG[name]}')
+    except psycopg2.Error:
+        if in_transaction:
+            cursor.execute('ROLLBACK TO SAVEPOINT catalog_prepare')
+        conn.unpreparable.add(name)
+    else:
+        conn.prepared.add(name)
+    if in_transaction:
+        cursor.execute('RELEASE SAVEPOINT catalog_prepare')
+
+
+# Тот же текст с %(n)s вместо $n - для соединений, где PREPARE недоступен
+_catalog_fallback: Dict[str, str] = {
+    name: re.sub(r'\$(\d+)', r'%(\1)s', query) for name, query in QUERY_CATALOG.items()
+}
+
+
+TRACE_REQUESTS = os.environ.get('TRACE_REQUESTS', '') in ('1', 'true')
+TRACE_SLOW_MS = float(os.environ.get('TRACE_SLOW_MS', '0'))
+TRACE_FINGERPRINT_CACHE_SIZE = 1024
+
+_trace_state = threading.local()
+_query_fingerprints: Dict[str, Tuple[str, str]] = {}
+
+
+class RequestTrace:
+    def __init__(self, request_id: str):
+        self.request_id = request_id
+        self.started = time.perf_counter()
+        self.spans: Dict[str, float] = {}
+        self.queries: Dict[str, Dict[str, Any]] = {}
+
+    def add_span(self, name: str, seconds: float) -> None:
+        self.spans[name] = self.spans.get(name, 0.0) + seconds
+
+    def add_query(self, query: Any, seconds: float, rows: int) -> None:
+        if isinstance(query, bytes):
+            query = query.decode('utf-8')
+        fingerprint, statement = _query_fingerprints.get(query) or fingerprint_query(query)
+        entry = self.queries.get(fingerprint)
+        if entry is None:
+            entry = self.queries[fingerprint] = {
+                'fingerprint': fingerprint, 'statement': statement, 'calls': 0, 'rows': 0, 'ms': 0.0
+            }
+        entry['calls'] += 1
+        entry['rows'] += max(rows, 0)
+        entry['ms'] += seconds * 1000
+        self.add_span('db', seconds)
+
+    def server_timing(self) -> str:
+        return ', '.join(f'{name};dur={seconds * 1000:.1f}' for name, seconds in self.spans.items())
+
+    def to_log(self, function_name: str, event: Dict[str, Any], status: Any) -> Dict[str, Any]:
+        try:
+            action = json.loads(event.get('body') or '{}').get('action', '')
+        except (ValueError, AttributeError):
+            action = ''
+        return {
+            'trace': 'request',
+            'request_id': self.request_id,
+            'function': function_name,
+            'method': event.get('httpMethod'),
+            'action': action,
+            'status': status,
+            **{f'{name}_ms': round(seconds * 1000, 2) for name, seconds in self.spans.items()},
+            'queries': sorted(
+                ({**entry, 'ms': round(entry['ms'], 2)} for entry in self.queries.values()),
+                key=lambda entry: entry['ms'], reverse=True
+            )
+        }
+
+
+def fingerprint_query(query: str) -> Tuple[str, str]:
+    # Параметры передаются через %s, поэтому текст запроса без пробельного шума и есть отпечаток
+    statement = ' '.join(query.split())
+    result = (hashlib.md5(statement.encode('utf-8')).hexdigest()[:12], statement[:160])
+    if len(_query_fingerprints) < TRACE_FINGERPRINT_CACHE_SIZE:
+        _query_fingerprints[query] = result
+    return result
+
+
+class TracingMixin:
+    def execute(self, query, vars=None):
+        trace = getattr(_trace_state, 'current', None)
+        if trace is None:
+            return super().execute(query, vars)
+        started = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            trace.add_query(query, time.perf_counter() - started, self.rowcount)
+
+
+class TracingCursor(TracingMixin, RealDictCursor):
+    pass
+
+
+class TracingTupleCursor(TracingMixin, cursor_type):
+    pass
+
+
+@contextmanager
+def trace_span(name: str):
+    trace = getattr(_trace_state, 'current', None)
+    if trace is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add_span(name, time.perf_counter() - started)
+
+
+def dump_json(payload: Any) -> str:
+    trace = getattr(_trace_state, 'current', None)
+    if trace is None:
+        return to_json(payload)
+    started = time.perf_counter()
+    try:
+        return to_json(payload)
+    finally:
+        trace.add_span('serialize', time.perf_counter() - started)
+
+
+RESPONSE_COMPRESS_MIN_BYTES = int(os.environ.get('RESPONSE_COMPRESS_MIN_BYTES', '1024'))
+RESPONSE_GZIP_LEVEL = 6
+RESPONSE_BROTLI_QUALITY = 5
+
+
+def to_json(payload: Any) -> str:
+    # orjson пишет datetime/date сам, без обратного вызова на каждое значение;
+    # без него stdlib json выдаёт тот же ISO-формат через encode_json_value
+    if orjson is not None:
+        return orjson.dumps(payload, default=encode_json_value).decode('utf-8')
+    return json.dumps(payload, default=encode_json_value, ensure_ascii=False, separators=(',', ':'))
+
+
+def encode_json_value(value: Any) -> Any:
+    if isinstance(value, date):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return float(value)
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+def list_cursor(conn):
+    '''
+    Tuple cursor for list reads: rows are built in C and turned into dicts by
+    fetch_records, instead of RealDictRow filling every column in Python
+    '''
+    return conn.cursor(cursor_factory=TracingTupleCursor if TRACE_REQUESTS else cursor_type)
+
+
+def fetch_records(cursor) -> List[Dict[str, Any]]:
+    rows = cursor.fetchall()
+    if not rows:
+        return []
+    columns = [column.name for column in cursor.description]
+    return [dict(zip(columns, row)) for row in rows]
+
+
+def get_header(event: Dict[str, Any], name: str) -> str:
+    name = name.lower()
+    for key, value in (event.get('headers') or {}).items():
+        if key.lower() == name:
+            return value or ''
+    return ''
+
+
+def accepted_encodings(accept_encoding: str) -> List[str]:
+    encodings = []
+    for part in accept_encoding.split(','):
+        coding, _, params = part.partition(';')
+        quality = params.strip().lower()
+        if quality.startswith('q=') and quality[2:].strip() in ('0', '0.0', '0.00', '0.000'):
+            continue
+        encodings.append(coding.strip().lower())
+    return encodings
+
+
+def compressible(func):
+    @functools.wraps(func)
+    def wrapper(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+        return compress_response(event, func(event, context))
+    
+    return wrapper
+
+
+def compress_response(event: Dict[str, Any], response: Dict[str, Any]) -> Dict[str, Any]:
+    '''
+    Compresses JSON bodies above RESPONSE_COMPRESS_MIN_BYTES with brotli or gzip,
+    whichever the client accepts, and returns them base64-encoded with
+    isBase64Encoded set, as the cloud runtime expects for binary bodies
+    '''
+    body = response.get('body')
+    if response.get('isBase64Encoded') or not isinstance(body, str) or len(body) < RESPONSE_COMPRESS_MIN_BYTES // 2:
+        return response
+    
+    raw = body.encode('utf-8')
+    if len(raw) < RESPONSE_COMPRESS_MIN_BYTES:
+        return response
+    
+    encodings = accepted_encodings(get_header(event, 'Accept-Encoding'))
+    headers = {**response.get('headers', {}), 'Vary': 'Accept-Encoding'}
+    with trace_span('compress'):
+        if brotli is not None and 'br' in encodings:
+            encoding, data = 'br', brotli.compress(raw, quality=RESPONSE_BROTLI_QUALITY)
+        elif 'gzip' in encodings:
+            encoding, data = 'gzip', gzip.compress(raw, compresslevel=RESPONSE_GZIP_LEVEL, mtime=0)
+        else:
+            return {**response, 'headers': headers}
+    
+    return {
+        **response,
+        'headers': {**headers, 'Content-Encoding': encoding},
+        'body': base64.b64encode(data).decode('ascii'),
+        'isBase64Encoded': True
+    }
+
+
+def traced(function_name: str):
+    '''
+    Opt-in per-request tracing: with TRACE_REQUESTS on, times connect, every
+    query by fingerprint, serialization and total, logs one JSON line per request
+    and adds a Server-Timing header; otherwise the handler is returned untouched
+    '''
+    def decorate(func):
+        if not TRACE_REQUESTS:
+            return func
+
+        @functools.wraps(func)
+        def wrapper(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+            trace = RequestTrace(getattr(context, 'request_id', ''))
+            _trace_state.current = trace
+            status: Any = 'error'
+            try:
+                response = func(event, context)
+                status = response.get('statusCode')
+                trace.add_span('total', time.perf_counter() - trace.started)
+                response['headers'] = {
+                    **response.get('headers', {}),
+                    'Server-Timing': trace.server_timing(),
+                    'Timing-Allow-Origin': '*'
+                }
+                return response
+            finally:
+                _trace_state.current = None
+                if 'total' not in trace.spans:
+                    trace.add_span('total', time.perf_counter() - trace.started)
+                if trace.spans['total'] * 1000 >= TRACE_SLOW_MS:
+                    print(json.dumps(trace.to_log(function_name, event, status), ensure_ascii=False), flush=True)
+
+        return wrapper
+    return decorate
+
+
+@traced('chats')
+@compressible
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
     Business: Chat and message management - create chats, send/receive messages
@@ -19,240 +709,857 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'headers': {
                 'Access-Control-Allow-Origin': '*',
                 'Access-Control-Allow-Methods': 'GET, POST, PUT, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-Session-Token',
+                'Access-Control-Allow-Headers': 'Content-Type, X-Session-Token, If-None-Match',
                 'Access-Control-Max-Age': '86400'
             },
             'body': '',
             'isBase64Encoded': False
         }
     
-    db_url = os.environ.get('DATABASE_URL')
-    conn = psycopg2.connect(db_url, cursor_factory=RealDictCursor)
+    body_data = json.loads(event.get('body', '{}')) if event.get('body') else {}
+    action = body_data.get('action', '')
+    
+    min_lsn = None
+    with trace_span('connect'):
+        if method == 'GET' or action in READ_ACTIONS:
+            # Чистые чтения уходят на реплику, если она не отстаёт и уже видит запись клиента (min_lsn)
+            query_params = event.get('queryStringParameters') or {}
+            min_lsn = body_data.get('min_lsn') or query_params.get('min_lsn')
+            conn = get_read_connection(min_lsn)
+        else:
+            conn = get_connection()
     
     try:
-        body_data = json.loads(event.get('body', '{}')) if event.get('body') else {}
-        action = body_data.get('action', '')
-        
-        if method == 'POST':
-            if action == 'create_chat':
-                return handle_create_chat(body_data, conn)
-            elif action == 'send_message':
-                return handle_send_message(body_data, conn)
-            elif action == 'get_messages':
-                return handle_get_messages(body_data, conn)
-            elif action == 'close_chat':
-                return handle_close_chat(body_data, conn)
-            elif action == 'escalate_chat':
-                return handle_escalate_chat(body_data, conn)
-            elif action == 'add_note':
-                return handle_add_note(body_data, conn)
-            elif action == 'get_notes':
-                return handle_get_notes(body_data, conn)
-            elif action == 'add_qc_rating':
-                return handle_add_qc_rating(body_data, conn)
-            elif action == 'get_qc_ratings':
-                return handle_get_qc_ratings(body_data, conn)
-        
-        elif method == 'GET':
-            return handle_get_chats(event, conn)
+        response = route_request(method, action, body_data, event, conn)
+        if min_lsn and conn.replica:
+            response['headers'] = with_min_lsn_reached(response.get('headers', {}))
+        return response
+    finally:
+        release_connection(conn)
+
+
+def route_request(method: str, action: str, body_data: Dict[str, Any], event: Dict[str, Any], conn) -> Dict[str, Any]:
+    if method == 'POST':
+        if action == 'create_chat':
+            return handle_create_chat(body_data, conn)
+        elif action == 'send_message':
+            return handle_send_message(body_data, conn)
+        elif action == 'get_messages':
+            return handle_get_messages(body_data, conn)
+        elif action == 'mark_read':
+            return handle_mark_read(body_data, conn)
+        elif action == 'search_messages':
+            return handle_search_messages(body_data, conn)
+        elif action == 'close_chat':
+            return handle_close_chat(body_data, conn)
+        elif action == 'escalate_chat':
+            return handle_escalate_chat(body_data, conn)
+        elif action == 'add_note':
+            return handle_add_note(body_data, conn)
+        elif action == 'get_notes':
+            return handle_get_notes(body_data, conn)
+        elif action == 'add_qc_rating':
+            return handle_add_qc_rating(body_data, conn)
+        elif action == 'get_qc_ratings':
+            return handle_get_qc_ratings(body_data, conn)
+        elif action == 'get_operator_stats':
+            return handle_get_operator_stats(body_data, conn)
+        elif action == 'wait_for_events':
+            return handle_wait_for_events(body_data, conn)
+        elif action == 'batch':
+            return handle_batch(body_data, conn)
+    
+    elif method == 'GET':
+        return handle_get_chats(event, conn)
+    
+    return {
+        'statusCode': 400,
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+        'body': dump_json({'error': 'Invalid action'}),
+        'isBase64Encoded': False
+    }
+
+
+def handle_create_chat(body_data: Dict[str, Any], conn) -> Dict[str, Any]:
+    client_name = body_data.get('client_name', '')
+    client_email = body_data.get('client_email')
+    department = body_data.get('department') or None
+    
+    if not client_name:
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': dump_json({'error': 'Client name required'}),
+            'isBase64Encoded': False
+        }
+    
+    cursor = conn.cursor()
+    
+    # Найти наименее загруженного оператора со статусом "online"
+    online_operator = pick_operator(cursor, department)
+    
+    if online_operator:
+        # Автоматически назначить оператора и поставить статус "active"
+        cursor.execute(
+            """
+            INSERT INTO chats (client_name, client_email, department, status, assigned_operator_id)
+            VALUES (%s, %s, %s, 'active', %s)
+            RETURNING id, client_name, client_email, department, status, assigned_operator_id, created_at
+            """,
+            (client_name, client_email, department, online_operator['id'])
+        )
+        chat = cursor.fetchone()
+        adjust_operator_load(cursor, online_operator['id'], 1)
+    else:
+        # Если нет свободных операторов онлайн - чат ожидает в очереди
+        cursor.execute(
+            """
+            INSERT INTO chats (client_name, client_email, department, status)
+            VALUES (%s, %s, %s, 'waiting')
+            RETURNING id, client_name, client_email, department, status, assigned_operator_id, created_at
+            """,
+            (client_name, client_email, department)
+        )
+        chat = cursor.fetchone()
+    
+    cursor.execute(
+        """
+        INSERT INTO messages (chat_id, sender_type, message_text)
+        VALUES (%s, 'system', %s)
+        RETURNING id, chat_id, sender_type, message_text, created_at
+        """,
+        (chat['id'], f'Добро пожаловать, {client_name}! Ожидайте подключения оператора...')
+    )
+    update_chat_summary(cursor, cursor.fetchone())
+    
+    notify_chat_event(
+        cursor,
+        {'type': 'chat_created', 'chat_id': chat['id'], 'status': chat['status']},
+        operator_ids=[chat['assigned_operator_id']],
+        queue=chat['status'] == 'waiting'
+    )
+    
+    conn.commit()
+    
+    return {
+        'statusCode': 201,
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+        'body': dump_json(dict(chat)),
+        'isBase64Encoded': False
+    }
+
+
+def pick_operator(cursor, department: Optional[str]) -> Optional[Dict[str, Any]]:
+    # SKIP LOCKED: параллельные create_chat не выберут одного и того же оператора;
+    # операторы без heartbeat дольше PRESENCE_TIMEOUT не получают чаты, даже если ещё не сняты с линии
+    cursor.execute(
+        """
+        SELECT id
+        FROM users
+        WHERE status = 'online' AND is_active = true AND role IN ('operator', 'okk', 'admin')
+          AND active_chat_count < max_active_chats
+          AND (%(department)s::varchar IS NULL OR department = %(department)s)
+          AND last_seen_at > LOCALTIMESTAMP - make_interval(secs => %(presence_timeout)s)
+        ORDER BY active_chat_count ASC, last_assigned_at ASC NULLS FIRST
+        LIMIT 1
+        FOR UPDATE SKIP LOCKED
+        """,
+        {'department': department, 'presence_timeout': PRESENCE_TIMEOUT}
+    )
+    return cursor.fetchone()
+
+
+def adjust_operator_load(cursor, operator_id: int, delta: int) -> None:
+    cursor.execute(
+        """
+        UPDATE users
+        SET active_chat_count = GREATEST(active_chat_count + %(delta)s, 0),
+            last_assigned_at = CASE WHEN %(delta)s > 0 THEN CURRENT_TIMESTAMP ELSE last_assigned_at END
+        WHERE id = %(operator_id)s
+        """,
+        {'operator_id': operator_id, 'delta': delta}
+    )
+
+
+def drain_waiting_queue(cursor, operator_id: int) -> List[int]:
+    '''
+    Assigns the oldest waiting chats of the operator's department (or without
+    a department) to the operator, up to their free capacity
+    '''
+    cursor.execute(
+        """
+        SELECT id, department, max_active_chats - active_chat_count AS capacity
+        FROM users
+        WHERE id = %s AND status = 'online' AND is_active = true AND role IN ('operator', 'okk', 'admin')
+        FOR UPDATE
+        """,
+        (operator_id,)
+    )
+    operator = cursor.fetchone()
+    
+    if not operator or operator['capacity'] <= 0:
+        return []
+    
+    cursor.execute(
+        """
+        WITH picked AS (
+            SELECT id FROM chats
+            WHERE status = 'waiting' AND (department IS NULL OR department = %s)
+            ORDER BY created_at ASC
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED
+        )
+        UPDATE chats c
+        SET status = 'active', assigned_operator_id = %s, updated_at = CURRENT_TIMESTAMP
+        FROM picked
+        WHERE c.id = picked.id
+        RETURNING c.id
+        """,
+        (operator['department'], operator['capacity'], operator_id)
+    )
+    chat_ids = [row['id'] for row in cursor.fetchall()]
+    
+    # Та же маршрутизация есть в drain_waiting_queue из backend/auth/index.py - менять обе копии вместе
+    if chat_ids:
+        adjust_operator_load(cursor, operator_id, len(chat_ids))
+        notify_chat_events(
+            cursor,
+            [{'type': 'chat_assigned', 'chat_id': chat_id, 'status': 'active', 'assigned_operator_id': operator_id}
+             for chat_id in chat_ids],
+            operator_ids=[operator_id]
+        )
+    
+    return chat_ids
+
+
+def handle_send_message(body_data: Dict[str, Any], conn) -> Dict[str, Any]:
+    chat_id = body_data.get('chat_id')
+    sender_type = body_data.get('sender_type', 'client')
+    sender_id = body_data.get('sender_id')
+    message_text = body_data.get('message_text', '')
+    
+    if not chat_id or not message_text:
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': dump_json({'error': 'Chat ID and message text required'}),
+            'isBase64Encoded': False
+        }
+    
+    cursor = conn.cursor()
+    execute_named(cursor, 'message_insert', (chat_id, sender_type, sender_id, message_text))
+    message = cursor.fetchone()
+    
+    chat = update_chat_summary(cursor, message)
+    
+    if chat and sender_type == 'operator' and chat['first_response_at'] == message['created_at']:
+        # Первый ответ оператора в чате - учитываем время первой реакции
+        bump_operator_stats(
+            cursor,
+            sender_id or chat['assigned_operator_id'],
+            message['created_at'].date(),
+            first_responses=1,
+            first_response_seconds=(message['created_at'] - chat['created_at']).total_seconds()
+        )
+    
+    if chat:
+        notify_chat_event(
+            cursor,
+            {'type': 'message', 'chat_id': message['chat_id'], 'message_id': message['id'], 'sender_type': message['sender_type']},
+            operator_ids=[chat['assigned_operator_id']],
+            queue=chat['status'] == 'waiting'
+        )
+    
+    conn.commit()
+    
+    return {
+        'statusCode': 201,
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+        'body': dump_json(with_read_token(message, cursor)),
+        'isBase64Encoded': False
+    }
+
+
+def update_chat_summary(cursor, message: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    # Сводка обновляется в той же транзакции, что и вставка сообщения
+    execute_named(cursor, 'chat_summary_update', (
+        message['id'], message['message_text'], message['created_at'], message['sender_type'], message['chat_id']
+    ))
+    return cursor.fetchone()
+
+
+def bump_operator_stats(cursor, operator_id: Optional[int], day: date, chats_handled: int = 0,
+                        handling_seconds: float = 0, first_responses: int = 0,
+                        first_response_seconds: float = 0) -> None:
+    if not operator_id:
+        return
+    
+    execute_named(
+        cursor, 'operator_stats_bump',
+        (operator_id, day, chats_handled, handling_seconds, first_responses, first_response_seconds)
+    )
+
+
+def bump_score_count(cursor, operator_id: int, day: date, score: int, delta: int) -> None:
+    cursor.execute(
+        """
+        INSERT INTO operator_score_counts (operator_id, day, score, ratings)
+        VALUES (%s, %s, %s, %s)
+        ON CONFLICT (operator_id, day, score) DO UPDATE
+        SET ratings = operator_score_counts.ratings + EXCLUDED.ratings
+        """,
+        (operator_id, day, score, delta)
+    )
+
+
+def notify_chat_event(cursor, event: Dict[str, Any], operator_ids: Optional[List[Any]] = None, queue: bool = False) -> None:
+    # pg_notify доставляется слушателям только после коммита транзакции
+    execute_named(cursor, 'chat_notify', chat_event_notification(event, operator_ids, queue))
+
+
+def notify_chat_events(cursor, events: List[Dict[str, Any]], operator_ids: Optional[List[Any]] = None,
+                       queue: bool = False) -> None:
+    # Все события одним запросом, в том же порядке каналов, что и notify_chat_event по одному
+    channels, payloads = [], []
+    for event in events:
+        payload, event_channels, routed_payload = chat_event_notification(event, operator_ids, queue)
+        channels += [*event_channels, 'chat_events']
+        payloads += [payload] * len(event_channels) + [routed_payload]
+    if channels:
+        execute_named(cursor, 'chat_notify_many', (channels, payloads))
+
+
+def chat_event_notification(event: Dict[str, Any], operator_ids: Optional[List[Any]] = None,
+                            queue: bool = False) -> Tuple[str, List[str], str]:
+    operator_ids = sorted({int(operator_id) for operator_id in operator_ids or [] if operator_id})
+    channels = [f"chat_{event['chat_id']}"]
+    channels += [f'operator_{operator_id}' for operator_id in operator_ids]
+    if queue:
+        channels.append('chat_queue')
+    
+    # Общий канал chat_events слушает шлюз gateway/ и сам раскладывает события по подпискам
+    routed_event = {**event, 'operator_ids': operator_ids, 'queue': queue}
+    return to_json(event), channels, to_json(routed_event)
+
+
+def make_etag(*parts: Any) -> str:
+    digest = hashlib.md5('|'.join(str(part) for part in parts).encode('utf-8')).hexdigest()
+    return f'W/"{digest[:20]}"'
+
+
+def etag_headers(etag: Optional[str]) -> Dict[str, str]:
+    headers = {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}
+    if etag:
+        headers.update({'ETag': etag, 'Cache-Control': 'no-cache', 'Access-Control-Expose-Headers': 'ETag'})
+    return headers
+
+
+def not_modified_response(etag: str, method: str = 'POST') -> Dict[str, Any]:
+    '''
+    Answer for a poll whose version token still matches: a bodiless 304 for GET,
+    a small not_modified body for POST actions, which browsers never revalidate
+    '''
+    if method == 'GET':
+        return {'statusCode': 304, 'headers': etag_headers(etag), 'body': '', 'isBase64Encoded': False}
+    return {
+        'statusCode': 200,
+        'headers': etag_headers(etag),
+        'body': '{"not_modified": true}',
+        'isBase64Encoded': False
+    }
+
+
+def handle_get_messages(body_data: Dict[str, Any], conn) -> Dict[str, Any]:
+    chat_id = body_data.get('chat_id')
+    after_id = body_data.get('after_id', body_data.get('since_id'))
+    before_id = body_data.get('before_id')
+    limit = body_data.get('limit')
+    
+    if not chat_id:
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': dump_json({'error': 'Chat ID required'}),
+            'isBase64Encoded': False
+        }
+    
+    if after_id is not None and before_id is not None:
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': dump_json({'error': 'Use either after_id or before_id'}),
+            'isBase64Encoded': False
+        }
+    
+    # ETag строится из сырых значений, как и в async-пути, чтобы токены совпадали
+    etag_parts = (after_id, before_id, limit)
+    try:
+        after_id = int(after_id) if after_id is not None else None
+        before_id = int(before_id) if before_id is not None else None
+    except (TypeError, ValueError):
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': dump_json({'error': 'Invalid cursor'}),
+            'isBase64Encoded': False
+        }
+    
+    cursor = conn.cursor()
+    
+    # Строка чата переписывается при каждом сообщении, mark_read и архивации, так что её xmin -
+    # версия переписки; читается до самих сообщений, поэтому токен не бывает новее данных
+    execute_named(cursor, 'chat_version', (chat_id,))
+    chat_version = cursor.fetchone()
+    etag = make_etag('messages', chat_id, chat_version['version'], *etag_parts) if chat_version else None
+    if etag and body_data.get('if_none_match') == etag:
+        return not_modified_response(etag)
+    
+    # История архивного чата целиком лежит в chat_archive, живых сообщений у него нет
+    archived = bool(chat_version and chat_version['archived'])
+    rows = list_cursor(conn)
+    
+    # Без курсора и лимита - полная история, как раньше
+    if after_id is None and before_id is None and limit is None:
+        if archived:
+            messages = get_archived_messages(cursor, chat_id)
+        else:
+            execute_named(rows, 'messages_all', (chat_id,))
+            messages = fetch_records(rows)
         
+        return {
+            'statusCode': 200,
+            'headers': etag_headers(etag),
+            'body': dump_json(messages),
+            'isBase64Encoded': False
+        }
+    
+    try:
+        limit = min(int(limit or MESSAGES_PAGE_MAX), MESSAGES_PAGE_MAX)
+    except (TypeError, ValueError):
+        limit = 0
+    
+    if limit <= 0:
         return {
             'statusCode': 400,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Invalid action'}),
+            'body': dump_json({'error': 'Invalid limit'}),
             'isBase64Encoded': False
         }
     
-    finally:
-        conn.close()
+    if after_id is not None:
+        # Новые сообщения после курсора - для опроса
+        if archived:
+            messages = get_archived_messages(cursor, chat_id, after_id=after_id, limit=limit + 1)
+        else:
+            execute_named(rows, 'messages_after', (chat_id, after_id, limit + 1))
+            messages = fetch_records(rows)
+        has_more = len(messages) > limit
+        messages = messages[:limit]
+    else:
+        # Последние сообщения или более старая история перед before_id
+        if archived:
+            messages = get_archived_messages(cursor, chat_id, before_id=before_id, limit=limit + 1)
+        else:
+            execute_named(rows, 'messages_before', (chat_id, before_id, limit + 1))
+            messages = fetch_records(rows)
+        has_more = len(messages) > limit
+        messages = messages[:limit][::-1]
+    
+    next_after_id = messages[-1]['id'] if messages else after_id
+    next_before_id = messages[0]['id'] if messages else before_id
+    
+    return {
+        'statusCode': 200,
+        'headers': etag_headers(etag),
+        'body': dump_json({
+            'messages': messages,
+            'next_after_id': next_after_id,
+            'next_before_id': next_before_id,
+            'has_more': has_more
+        }),
+        'isBase64Encoded': False
+    }
+
+
+def get_archived_messages(cursor, chat_id: Any, after_id: Any = None, before_id: Any = None,
+                          limit: Optional[int] = None) -> List[Dict[str, Any]]:
+    '''
+    Reads a chat moved to chat_archive: returns archived messages in the same
+    order the live queries use (descending for before_id/tail pages)
+    '''
+    cursor.execute("SELECT messages FROM chat_archive WHERE chat_id = %s", (chat_id,))
+    archive = cursor.fetchone()
+    
+    if not archive:
+        return []
+    
+    return slice_archived_messages(archive['messages'], after_id, before_id, limit)
+
+
+def slice_archived_messages(messages: List[Dict[str, Any]], after_id: Any = None, before_id: Any = None,
+                            limit: Optional[int] = None) -> List[Dict[str, Any]]:
+    if after_id is not None:
+        messages = [msg for msg in messages if msg['id'] > int(after_id)]
+    elif limit is not None:
+        messages = [msg for msg in messages if before_id is None or msg['id'] < int(before_id)][::-1]
+    
+    return messages[:limit] if limit is not None else messages
 
 
-def handle_create_chat(body_data: Dict[str, Any], conn) -> Dict[str, Any]:
-    client_name = body_data.get('client_name', '')
-    client_email = body_data.get('client_email')
+def handle_mark_read(body_data: Dict[str, Any], conn) -> Dict[str, Any]:
+    chat_id = body_data.get('chat_id')
+    up_to_id = body_data.get('up_to_id')
     
-    if not client_name:
+    if not chat_id:
         return {
             'statusCode': 400,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Client name required'}),
+            'body': dump_json({'error': 'Chat ID required'}),
             'isBase64Encoded': False
         }
     
     cursor = conn.cursor()
-    
-    # Найти доступного оператора со статусом "online"
+    # Частичный индекс idx_messages_unread_client содержит только непрочитанные сообщения клиента
     cursor.execute(
         """
-        SELECT u.id
-        FROM users u
-        WHERE u.status = 'online' AND u.role IN ('operator', 'okk', 'admin') AND u.is_active = true
-        ORDER BY (
-            SELECT COUNT(*) FROM chats c 
-            WHERE c.assigned_operator_id = u.id AND c.status = 'active'
-        ) ASC
-        LIMIT 1
-        """
+        UPDATE messages
+        SET is_read = true
+        WHERE chat_id = %s AND sender_type = 'client' AND is_read = false
+          AND (%s::integer IS NULL OR id <= %s)
+        """,
+        (chat_id, up_to_id, up_to_id)
     )
-    online_operator = cursor.fetchone()
+    marked = cursor.rowcount
     
-    if online_operator:
-        # Автоматически назначить оператора и поставить статус "active"
+    unread_count = 0
+    if marked:
         cursor.execute(
             """
-            INSERT INTO chats (client_name, client_email, status, assigned_operator_id)
-            VALUES (%s, %s, 'active', %s)
-            RETURNING id, client_name, client_email, status, assigned_operator_id, created_at
+            UPDATE chats
+            SET unread_client_count = GREATEST(unread_client_count - %s, 0),
+                updated_at = CURRENT_TIMESTAMP
+            WHERE id = %s
+            RETURNING unread_client_count, assigned_operator_id
             """,
-            (client_name, client_email, online_operator['id'])
+            (marked, chat_id)
         )
+        chat = cursor.fetchone()
+        if chat:
+            unread_count = chat['unread_client_count']
+            notify_chat_event(
+                cursor,
+                {'type': 'messages_read', 'chat_id': int(chat_id), 'up_to_id': up_to_id, 'unread_count': unread_count},
+                operator_ids=[chat['assigned_operator_id']]
+            )
     else:
-        # Если нет операторов онлайн - чат ожидает
-        cursor.execute(
-            """
-            INSERT INTO chats (client_name, client_email, status)
-            VALUES (%s, %s, 'waiting')
-            RETURNING id, client_name, client_email, status, assigned_operator_id, created_at
-            """,
-            (client_name, client_email)
-        )
-    
-    chat = cursor.fetchone()
-    
-    cursor.execute(
-        """
-        INSERT INTO messages (chat_id, sender_type, message_text)
-        VALUES (%s, 'system', %s)
-        """,
-        (chat['id'], f'Добро пожаловать, {client_name}! Ожидайте подключения оператора...')
-    )
+        cursor.execute("SELECT unread_client_count FROM chats WHERE id = %s", (chat_id,))
+        chat = cursor.fetchone()
+        unread_count = chat['unread_client_count'] if chat else 0
     
     conn.commit()
     
     return {
-        'statusCode': 201,
+        'statusCode': 200,
         'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps(dict(chat), default=str),
+        'body': dump_json({'success': True, 'marked': marked, 'unread_count': unread_count}),
         'isBase64Encoded': False
     }
 
 
-def handle_send_message(body_data: Dict[str, Any], conn) -> Dict[str, Any]:
-    chat_id = body_data.get('chat_id')
-    sender_type = body_data.get('sender_type', 'client')
-    sender_id = body_data.get('sender_id')
-    message_text = body_data.get('message_text', '')
+def handle_get_chats(event: Dict[str, Any], conn) -> Dict[str, Any]:
+    params = event.get('queryStringParameters') or {}
+    statuses = [st for st in (params.get('status') or '').split(',') if st]
+    assigned_operator_id = params.get('assigned_operator_id')
+    created_from = params.get('created_from')
+    created_to = params.get('created_to')
+    changed_since = params.get('changed_since')
+    page_cursor = params.get('cursor')
+    limit = params.get('limit')
     
-    if not chat_id or not message_text:
+    if any(st not in CHAT_STATUSES for st in statuses):
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': dump_json({'error': 'Invalid status'}),
+            'isBase64Encoded': False
+        }
+    
+    try:
+        assigned_operator_id = int(assigned_operator_id) if assigned_operator_id else None
+        created_from = datetime.fromisoformat(created_from) if created_from else None
+        created_to = datetime.fromisoformat(created_to) if created_to else None
+        changed_since = datetime.fromisoformat(changed_since) if changed_since else None
+        if page_cursor:
+            cursor_updated_at, cursor_id = page_cursor.rsplit('|', 1)
+            page_cursor = (datetime.fromisoformat(cursor_updated_at), int(cursor_id))
+        if limit is not None or page_cursor:
+            limit = min(int(limit or CHATS_PAGE_MAX), CHATS_PAGE_MAX)
+            if limit <= 0:
+                raise ValueError(limit)
+    except ValueError:
         return {
             'statusCode': 400,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Chat ID and message text required'}),
+            'body': dump_json({'error': 'Invalid filter or cursor'}),
             'isBase64Encoded': False
         }
     
     cursor = conn.cursor()
-    cursor.execute(
-        """
-        INSERT INTO messages (chat_id, sender_type, sender_id, message_text)
-        VALUES (%s, %s, %s, %s)
-        RETURNING id, chat_id, sender_type, sender_id, message_text, created_at
-        """,
-        (chat_id, sender_type, sender_id, message_text)
-    )
-    message = cursor.fetchone()
     
-    cursor.execute(
-        "UPDATE chats SET updated_at = CURRENT_TIMESTAMP WHERE id = %s",
-        (chat_id,)
-    )
+    if changed_since:
+        # Время начала транзакции (на отстающей реплике - последней проигранной) - с него клиент продолжит changed_since
+        cursor.execute(f"SELECT {WATERMARK_SQL} AS watermark")
+        return get_chat_changes(
+            list_cursor(conn), changed_since, page_cursor, cursor.fetchone()['watermark'],
+            statuses, assigned_operator_id, created_from, created_to
+        )
     
-    conn.commit()
+    cursor.execute(f"SELECT {WATERMARK_SQL} AS watermark, MAX(updated_at) AS last_updated FROM chats")
+    version = cursor.fetchone()
+    watermark = version['watermark']
+    
+    # Пока последнее изменение внутри окна перекрытия, ещё могут закоммититься транзакции
+    # с более ранним updated_at - такой ответ отдаётся без ETag
+    etag = None
+    if version['last_updated'] and watermark - version['last_updated'] > timedelta(seconds=CHANGES_OVERLAP_SECONDS):
+        etag = make_etag('chats', version['last_updated'], sorted(item for item in params.items() if item[0] != 'min_lsn'))
+        request_headers = event.get('headers') or {}
+        if_none_match = request_headers.get('If-None-Match') or request_headers.get('if-none-match') or ''
+        if etag in [tag.strip() for tag in if_none_match.split(',')]:
+            return not_modified_response(etag, 'GET')
+    
+    conditions = []
+    query_params: List[Any] = []
+    
+    if statuses:
+        conditions.append("c.status = ANY(%s)")
+        query_params.append(statuses)
+    if assigned_operator_id:
+        conditions.append("c.assigned_operator_id = %s")
+        query_params.append(assigned_operator_id)
+    if created_from:
+        conditions.append("c.created_at >= %s")
+        query_params.append(created_from)
+    if created_to:
+        conditions.append("c.created_at < %s")
+        query_params.append(created_to)
+    if page_cursor:
+        conditions.append("(c.updated_at, c.id) < (%s, %s)")
+        query_params.extend(page_cursor)
+    
+    where_clause = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+    limit_clause = ''
+    if limit is not None:
+        limit_clause = 'LIMIT %s'
+        query_params.append(limit + 1)
+    
+    rows = list_cursor(conn)
+    if statuses and limit is not None and not (assigned_operator_id or created_from or created_to):
+        # Основной опрос дашборда - страницы по статусам - идёт подготовленными запросами
+        if page_cursor:
+            execute_named(rows, 'chat_list_by_status_after', (statuses, *page_cursor, limit + 1))
+        else:
+            execute_named(rows, 'chat_list_by_status', (statuses, limit + 1))
+    else:
+        rows.execute(
+            f"""
+            SELECT {CHAT_LIST_COLUMNS}
+            FROM chats c
+            LEFT JOIN users u ON c.assigned_operator_id = u.id
+            {where_clause}
+            ORDER BY c.updated_at DESC, c.id DESC
+            {limit_clause}
+            """,
+            query_params
+        )
+    chats = fetch_records(rows)
+    
+    if limit is None:
+        return {
+            'statusCode': 200,
+            'headers': etag_headers(etag),
+            'body': dump_json(chats),
+            'isBase64Encoded': False
+        }
+    
+    has_more = len(chats) > limit
+    chats = chats[:limit]
+    next_cursor = None
+    if has_more:
+        next_cursor = f"{chats[-1]['updated_at'].isoformat()}|{chats[-1]['id']}"
     
     return {
-        'statusCode': 201,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps(dict(message), default=str),
+        'statusCode': 200,
+        'headers': etag_headers(etag),
+        'body': dump_json({
+            'chats': chats,
+            'next_cursor': next_cursor,
+            'has_more': has_more,
+            'watermark': watermark.isoformat()
+        }),
         'isBase64Encoded': False
     }
 
 
-def handle_get_messages(body_data: Dict[str, Any], conn) -> Dict[str, Any]:
-    chat_id = body_data.get('chat_id')
-    
-    if not chat_id:
-        return {
-            'statusCode': 400,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Chat ID required'}),
-            'isBase64Encoded': False
-        }
+def get_chat_changes(cursor, changed_since: datetime, page_cursor: Optional[Tuple[datetime, int]],
+                     watermark: datetime, statuses: List[str], assigned_operator_id: Optional[int],
+                     created_from: Optional[datetime], created_to: Optional[datetime]) -> Dict[str, Any]:
+    # Перекрытие окна ловит транзакции, которые закоммитились позже своего updated_at;
+    # клиент применяет изменения по id, поэтому повторы безопасны. Следующие страницы того же
+    # опроса продолжаются строго после (updated_at, id) последней строки - без перекрытия
+    if page_cursor:
+        condition = "(c.updated_at, c.id) > (%s, %s)"
+        query_params: List[Any] = list(page_cursor)
+    else:
+        condition = "c.updated_at > %s"
+        query_params = [changed_since - timedelta(seconds=CHANGES_OVERLAP_SECONDS)]
+    query_params.append(CHATS_PAGE_MAX + 1)
     
-    cursor = conn.cursor()
     cursor.execute(
-        """
-        SELECT m.id, m.chat_id, m.sender_type, m.sender_id, m.message_text, m.created_at,
-               u.full_name as sender_name
-        FROM messages m
-        LEFT JOIN users u ON m.sender_id = u.id
-        WHERE m.chat_id = %s
-        ORDER BY m.created_at ASC
+        f"""
+        SELECT {CHAT_LIST_COLUMNS}, c.previous_operator_id
+        FROM chats c
+        LEFT JOIN users u ON c.assigned_operator_id = u.id
+        WHERE {condition}
+        ORDER BY c.updated_at ASC, c.id ASC
+        LIMIT %s
         """,
-        (chat_id,)
+        query_params
     )
-    messages = cursor.fetchall()
+    changed = fetch_records(cursor)
+    
+    has_more = len(changed) > CHATS_PAGE_MAX
+    changed = changed[:CHATS_PAGE_MAX]
+    next_cursor = None
+    if has_more:
+        next_cursor = f"{changed[-1]['updated_at'].isoformat()}|{changed[-1]['id']}"
+    
+    chats = []
+    removed_ids = []
+    for chat in changed:
+        previous_operator_id = chat.pop('previous_operator_id')
+        if (created_from and chat['created_at'] < created_from) or (created_to and chat['created_at'] >= created_to):
+            # created_at не меняется: такой чат никогда не был в выборке
+            continue
+        if assigned_operator_id and assigned_operator_id not in (chat['assigned_operator_id'], previous_operator_id):
+            # Чужие чаты не попадают в ответ даже как id. Чат, переданный дальше дважды
+            # между опросами, здесь не виден - его уберёт следующая полная загрузка списка
+            continue
+        if not statuses or chat['status'] in statuses:
+            if not assigned_operator_id or chat['assigned_operator_id'] == assigned_operator_id:
+                chats.append(chat)
+                continue
+        removed_ids.append(chat['id'])
     
     return {
         'statusCode': 200,
         'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps([dict(msg) for msg in messages], default=str),
+        'body': dump_json({
+            'chats': chats,
+            'removed_ids': removed_ids,
+            'next_cursor': next_cursor,
+            'has_more': has_more,
+            'watermark': watermark.isoformat()
+        }),
         'isBase64Encoded': False
     }
 
 
-def handle_get_chats(event: Dict[str, Any], conn) -> Dict[str, Any]:
-    params = event.get('queryStringParameters') or {}
-    status = params.get('status')
+def handle_search_messages(body_data: Dict[str, Any], conn) -> Dict[str, Any]:
+    query = (body_data.get('query') or '').strip()
+    statuses = body_data.get('status') or []
+    operator_id = body_data.get('operator_id')
+    date_from = body_data.get('date_from')
+    date_to = body_data.get('date_to')
     
-    cursor = conn.cursor()
+    if isinstance(statuses, str):
+        statuses = [st for st in statuses.split(',') if st]
     
-    if status:
-        cursor.execute(
-            """
-            SELECT c.id, c.client_name, c.client_email, c.assigned_operator_id, c.status,
-                   c.created_at, c.updated_at,
-                   u.full_name as assigned_operator_name,
-                   (SELECT COUNT(*) FROM messages WHERE chat_id = c.id AND is_read = false AND sender_type = 'client') as unread_count,
-                   (SELECT message_text FROM messages WHERE chat_id = c.id ORDER BY created_at DESC LIMIT 1) as last_message,
-                   (SELECT created_at FROM messages WHERE chat_id = c.id ORDER BY created_at DESC LIMIT 1) as last_message_time
-            FROM chats c
-            LEFT JOIN users u ON c.assigned_operator_id = u.id
-            WHERE c.status = %s
-            ORDER BY c.updated_at DESC
-            """,
-            (status,)
-        )
-    else:
-        cursor.execute(
-            """
-            SELECT c.id, c.client_name, c.client_email, c.assigned_operator_id, c.status,
-                   c.created_at, c.updated_at,
-                   u.full_name as assigned_operator_name,
-                   (SELECT COUNT(*) FROM messages WHERE chat_id = c.id AND is_read = false AND sender_type = 'client') as unread_count,
-                   (SELECT message_text FROM messages WHERE chat_id = c.id ORDER BY created_at DESC LIMIT 1) as last_message,
-                   (SELECT created_at FROM messages WHERE chat_id = c.id ORDER BY created_at DESC LIMIT 1) as last_message_time
-            FROM chats c
-            LEFT JOIN users u ON c.assigned_operator_id = u.id
-            ORDER BY c.updated_at DESC
-            """
+    if not query:
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': dump_json({'error': 'Search query required'}),
+            'isBase64Encoded': False
+        }
+    
+    try:
+        limit = min(int(body_data.get('limit') or SEARCH_PAGE_MAX), SEARCH_PAGE_MAX)
+        offset = int(body_data.get('offset') or 0)
+        operator_id = int(operator_id) if operator_id else None
+        date_from = datetime.fromisoformat(date_from) if date_from else None
+        date_to = datetime.fromisoformat(date_to) if date_to else None
+        if limit <= 0 or not (0 <= offset <= SEARCH_OFFSET_MAX) or any(st not in CHAT_STATUSES for st in statuses):
+            raise ValueError(limit)
+    except (TypeError, ValueError):
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': dump_json({'error': 'Invalid search parameters'}),
+            'isBase64Encoded': False
+        }
+    
+    conditions = ["m.search_vector @@ q.query"]
+    query_params: Dict[str, Any] = {'query': query, 'limit': limit + 1, 'offset': offset}
+    
+    if statuses:
+        conditions.append("c.status = ANY(%(statuses)s)")
+        query_params['statuses'] = statuses
+    if operator_id:
+        conditions.append("c.assigned_operator_id = %(operator_id)s")
+        query_params['operator_id'] = operator_id
+    if date_from:
+        conditions.append("m.created_at >= %(date_from)s")
+        query_params['date_from'] = date_from
+    if date_to:
+        conditions.append("m.created_at < %(date_to)s")
+        query_params['date_to'] = date_to
+    
+    cursor = list_cursor(conn)
+    # Сниппеты строятся только для строк страницы; текст экранируется до вставки <mark>
+    cursor.execute(
+        f"""
+        WITH q AS (
+            SELECT websearch_to_tsquery('russian', %(query)s) AS query
+        ),
+        hits AS (
+            SELECT m.id, m.chat_id, m.sender_type, m.sender_id, m.message_text, m.created_at,
+                   c.client_name, c.status as chat_status, c.assigned_operator_id,
+                   ts_rank_cd(m.search_vector, q.query) AS rank
+            FROM messages m
+            JOIN chats c ON c.id = m.chat_id
+            CROSS JOIN q
+            WHERE {' AND '.join(conditions)}
+            ORDER BY rank DESC, m.id DESC
+            LIMIT %(limit)s OFFSET %(offset)s
         )
+        SELECT h.id, h.chat_id, h.sender_type, h.sender_id, h.created_at,
+               h.client_name, h.chat_status, h.assigned_operator_id, h.rank,
+               ts_headline(
+                   'russian',
+                   replace(replace(replace(h.message_text, '&', '&amp;'), '<', '&lt;'), '>', '&gt;'),
+                   q.query,
+                   'StartSel=<mark>, StopSel=</mark>, MaxWords=30, MinWords=10, MaxFragments=2'
+               ) AS snippet
+        FROM hits h
+        CROSS JOIN q
+        ORDER BY h.rank DESC, h.id DESC
+        """,
+        query_params
+    )
+    results = fetch_records(cursor)
     
-    chats = cursor.fetchall()
+    has_more = len(results) > limit
+    results = results[:limit]
     
     return {
         'statusCode': 200,
         'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps([dict(chat) for chat in chats], default=str),
+        'body': dump_json({
+            'results': results,
+            'has_more': has_more,
+            'next_offset': offset + limit if has_more else None
+        }),
         'isBase64Encoded': False
     }
 
@@ -264,21 +1571,52 @@ def handle_close_chat(body_data: Dict[str, Any], conn) -> Dict[str, Any]:
         return {
             'statusCode': 400,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Chat ID required'}),
+            'body': dump_json({'error': 'Chat ID required'}),
             'isBase64Encoded': False
         }
     
     cursor = conn.cursor()
-    cursor.execute(
-        "UPDATE chats SET status = 'closed', updated_at = CURRENT_TIMESTAMP WHERE id = %s",
-        (chat_id,)
-    )
+    cursor.execute("SELECT assigned_operator_id, status FROM chats WHERE id = %s FOR UPDATE", (chat_id,))
+    chat = cursor.fetchone()
+    
+    if chat:
+        cursor.execute(
+            """
+            UPDATE chats
+            SET status = 'closed', updated_at = CURRENT_TIMESTAMP,
+                closed_at = CASE WHEN status = 'closed' THEN closed_at ELSE CURRENT_TIMESTAMP END
+            WHERE id = %s
+            RETURNING created_at, closed_at
+            """,
+            (chat_id,)
+        )
+        closed = cursor.fetchone()
+        
+        if chat['status'] != 'closed' and chat['assigned_operator_id']:
+            bump_operator_stats(
+                cursor,
+                chat['assigned_operator_id'],
+                closed['closed_at'].date(),
+                chats_handled=1,
+                handling_seconds=(closed['closed_at'] - closed['created_at']).total_seconds()
+            )
+        notify_chat_event(
+            cursor,
+            {'type': 'chat_closed', 'chat_id': int(chat_id), 'status': 'closed'},
+            operator_ids=[chat['assigned_operator_id']]
+        )
+        
+        if chat['status'] == 'active' and chat['assigned_operator_id']:
+            # Освободившееся место сразу занимает следующий чат из очереди
+            adjust_operator_load(cursor, chat['assigned_operator_id'], -1)
+            drain_waiting_queue(cursor, chat['assigned_operator_id'])
+    
     conn.commit()
     
     return {
         'statusCode': 200,
         'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({'success': True}),
+        'body': dump_json({'success': True}),
         'isBase64Encoded': False
     }
 
@@ -291,29 +1629,55 @@ def handle_escalate_chat(body_data: Dict[str, Any], conn) -> Dict[str, Any]:
         return {
             'statusCode': 400,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Chat ID required'}),
+            'body': dump_json({'error': 'Chat ID required'}),
             'isBase64Encoded': False
         }
     
     cursor = conn.cursor()
+    cursor.execute("SELECT assigned_operator_id, status FROM chats WHERE id = %s FOR UPDATE", (chat_id,))
+    previous = cursor.fetchone()
     
     if to_operator_id:
         cursor.execute(
-            "UPDATE chats SET assigned_operator_id = %s, status = 'active', updated_at = CURRENT_TIMESTAMP WHERE id = %s",
+            """
+            UPDATE chats
+            SET previous_operator_id = assigned_operator_id, assigned_operator_id = %s, status = 'active',
+                updated_at = CURRENT_TIMESTAMP
+            WHERE id = %s
+            """,
             (to_operator_id, chat_id)
         )
     else:
         cursor.execute(
-            "UPDATE chats SET assigned_operator_id = NULL, status = 'waiting', updated_at = CURRENT_TIMESTAMP WHERE id = %s",
+            """
+            UPDATE chats
+            SET previous_operator_id = assigned_operator_id, assigned_operator_id = NULL, status = 'waiting',
+                updated_at = CURRENT_TIMESTAMP
+            WHERE id = %s
+            """,
             (chat_id,)
         )
     
+    if previous:
+        if previous['status'] == 'active' and previous['assigned_operator_id']:
+            adjust_operator_load(cursor, previous['assigned_operator_id'], -1)
+        if to_operator_id:
+            adjust_operator_load(cursor, to_operator_id, 1)
+        
+        notify_chat_event(
+            cursor,
+            {'type': 'chat_escalated', 'chat_id': int(chat_id), 'status': 'active' if to_operator_id else 'waiting',
+             'assigned_operator_id': to_operator_id},
+            operator_ids=[previous['assigned_operator_id'], to_operator_id],
+            queue=not to_operator_id
+        )
+    
     conn.commit()
     
     return {
         'statusCode': 200,
         'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({'success': True}),
+        'body': dump_json({'success': True}),
         'isBase64Encoded': False
     }
 
@@ -327,7 +1691,7 @@ def handle_add_note(body_data: Dict[str, Any], conn) -> Dict[str, Any]:
         return {
             'statusCode': 400,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Chat ID, operator ID and note text required'}),
+            'body': dump_json({'error': 'Chat ID, operator ID and note text required'}),
             'isBase64Encoded': False
         }
     
@@ -346,7 +1710,7 @@ def handle_add_note(body_data: Dict[str, Any], conn) -> Dict[str, Any]:
     return {
         'statusCode': 200,
         'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps(dict(note), default=str),
+        'body': dump_json(dict(note)),
         'isBase64Encoded': False
     }
 
@@ -358,28 +1722,50 @@ def handle_get_notes(body_data: Dict[str, Any], conn) -> Dict[str, Any]:
         return {
             'statusCode': 400,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Chat ID required'}),
+            'body': dump_json({'error': 'Chat ID required'}),
             'isBase64Encoded': False
         }
     
     cursor = conn.cursor()
+    # Заметки только добавляются: количество и последний id меняются с каждой новой, в том числе
+    # закоммиченной не по порядку, а архивация переключает признак archived
     cursor.execute(
         """
-        SELECT n.id, n.chat_id, n.operator_id, n.note_text, n.created_at,
-               u.full_name as operator_name
-        FROM chat_notes n
-        JOIN users u ON n.operator_id = u.id
-        WHERE n.chat_id = %s
-        ORDER BY n.created_at DESC
+        SELECT COUNT(*) AS total, MAX(id) AS last_id,
+               EXISTS (SELECT 1 FROM chats WHERE id = %(chat_id)s AND archived_at IS NOT NULL) AS archived
+        FROM chat_notes
+        WHERE chat_id = %(chat_id)s
         """,
-        (chat_id,)
+        {'chat_id': chat_id}
     )
-    notes = cursor.fetchall()
+    version = cursor.fetchone()
+    etag = make_etag('notes', chat_id, version['total'], version['last_id'], version['archived'])
+    if body_data.get('if_none_match') == etag:
+        return not_modified_response(etag)
+    
+    if version['archived']:
+        cursor.execute("SELECT notes FROM chat_archive WHERE chat_id = %s", (chat_id,))
+        archive = cursor.fetchone()
+        notes = archive['notes'] if archive else []
+    else:
+        rows = list_cursor(conn)
+        rows.execute(
+            """
+            SELECT n.id, n.chat_id, n.operator_id, n.note_text, n.created_at,
+                   u.full_name as operator_name
+            FROM chat_notes n
+            JOIN users u ON n.operator_id = u.id
+            WHERE n.chat_id = %s
+            ORDER BY n.created_at DESC
+            """,
+            (chat_id,)
+        )
+        notes = fetch_records(rows)
     
     return {
         'statusCode': 200,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps([dict(note) for note in notes], default=str),
+        'headers': etag_headers(etag),
+        'body': dump_json(notes),
         'isBase64Encoded': False
     }
 
@@ -395,7 +1781,7 @@ def handle_add_qc_rating(body_data: Dict[str, Any], conn) -> Dict[str, Any]:
         return {
             'statusCode': 400,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'All fields required'}),
+            'body': dump_json({'error': 'All fields required'}),
             'isBase64Encoded': False
         }
     
@@ -403,11 +1789,17 @@ def handle_add_qc_rating(body_data: Dict[str, Any], conn) -> Dict[str, Any]:
         return {
             'statusCode': 400,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Score must be between 0 and 100'}),
+            'body': dump_json({'error': 'Score must be between 0 and 100'}),
             'isBase64Encoded': False
         }
     
     cursor = conn.cursor()
+    cursor.execute(
+        "SELECT operator_id, score, created_at FROM qc_ratings WHERE chat_id = %s FOR UPDATE",
+        (chat_id,)
+    )
+    previous = cursor.fetchone()
+    
     cursor.execute(
         """
         INSERT INTO qc_ratings (chat_id, operator_id, qc_user_id, score, comment)
@@ -423,12 +1815,18 @@ def handle_add_qc_rating(body_data: Dict[str, Any], conn) -> Dict[str, Any]:
         (chat_id, operator_id, qc_user_id, score, comment)
     )
     rating = cursor.fetchone()
+    
+    # Переоценка чата переносит оценку в распределении, а не добавляет вторую
+    if previous:
+        bump_score_count(cursor, previous['operator_id'], previous['created_at'].date(), previous['score'], -1)
+    bump_score_count(cursor, rating['operator_id'], rating['created_at'].date(), rating['score'], 1)
+    
     conn.commit()
     
     return {
         'statusCode': 200,
         'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps(dict(rating), default=str),
+        'body': dump_json(dict(rating)),
         'isBase64Encoded': False
     }
 
@@ -436,7 +1834,7 @@ def handle_add_qc_rating(body_data: Dict[str, Any], conn) -> Dict[str, Any]:
 def handle_get_qc_ratings(body_data: Dict[str, Any], conn) -> Dict[str, Any]:
     operator_id = body_data.get('operator_id')
     
-    cursor = conn.cursor()
+    cursor = list_cursor(conn)
     
     if operator_id:
         cursor.execute(
@@ -469,11 +1867,310 @@ def handle_get_qc_ratings(body_data: Dict[str, Any], conn) -> Dict[str, Any]:
             """
         )
     
-    ratings = cursor.fetchall()
+    ratings = fetch_records(cursor)
+    
+    return {
+        'statusCode': 200,
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+        'body': dump_json(ratings),
+        'isBase64Encoded': False
+    }
+
+
+def handle_get_operator_stats(body_data: Dict[str, Any], conn) -> Dict[str, Any]:
+    operator_id = body_data.get('operator_id')
+    date_from = body_data.get('date_from')
+    date_to = body_data.get('date_to')
+    group_by = body_data.get('group_by', 'total')
+    
+    try:
+        operator_id = int(operator_id) if operator_id else None
+        date_from = date.fromisoformat(date_from) if date_from else None
+        date_to = date.fromisoformat(date_to) if date_to else None
+        if group_by not in STATS_GROUPINGS:
+            raise ValueError(group_by)
+    except (TypeError, ValueError):
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': dump_json({'error': 'Invalid stats parameters'}),
+            'isBase64Encoded': False
+        }
+    
+    conditions = ['true']
+    query_params: Dict[str, Any] = {'grain': group_by}
+    if operator_id:
+        conditions.append('operator_id = %(operator_id)s')
+        query_params['operator_id'] = operator_id
+    if date_from:
+        conditions.append('day >= %(date_from)s')
+        query_params['date_from'] = date_from
+    if date_to:
+        conditions.append('day < %(date_to)s')
+        query_params['date_to'] = date_to
+    
+    where_clause = ' AND '.join(conditions)
+    # Для group_by=total все дни попадают в один период '-infinity'
+    period = "'-infinity'::date" if group_by == 'total' else "date_trunc(%(grain)s, day)::date"
+    
+    cursor = list_cursor(conn)
+    # Перцентили считаются по распределению оценок (0-100), а не по сырым строкам qc_ratings
+    cursor.execute(
+        f"""
+        WITH scores AS (
+            SELECT operator_id, {period} AS period, score, SUM(ratings) AS ratings
+            FROM operator_score_counts
+            WHERE {where_clause}
+            GROUP BY 1, 2, 3
+            HAVING SUM(ratings) > 0
+        ),
+        cumulative AS (
+            SELECT operator_id, period, score, ratings,
+                   SUM(ratings) OVER (PARTITION BY operator_id, period ORDER BY score) AS running,
+                   SUM(ratings) OVER (PARTITION BY operator_id, period) AS total
+            FROM scores
+        ),
+        score_stats AS (
+            SELECT operator_id, period,
+                   SUM(ratings)::int AS ratings_count,
+                   ROUND(SUM(score * ratings)::numeric / SUM(ratings), 2) AS avg_score,
+                   MIN(score) FILTER (WHERE running * 10 >= total) AS p10_score,
+                   MIN(score) FILTER (WHERE running * 2 >= total) AS p50_score,
+                   MIN(score) FILTER (WHERE running * 10 >= total * 9) AS p90_score
+            FROM cumulative
+            GROUP BY operator_id, period
+        ),
+        work_stats AS (
+            SELECT operator_id, {period} AS period,
+                   SUM(chats_handled) AS chats_handled,
+                   ROUND((SUM(handling_seconds) / NULLIF(SUM(chats_handled), 0))::numeric, 1) AS avg_handling_seconds,
+                   ROUND((SUM(first_response_seconds) / NULLIF(SUM(first_responses), 0))::numeric, 1) AS avg_first_response_seconds
+            FROM operator_daily_stats
+            WHERE {where_clause}
+            GROUP BY 1, 2
+        )
+        SELECT COALESCE(s.operator_id, w.operator_id) AS operator_id,
+               u.full_name AS operator_name,
+               COALESCE(s.period, w.period) AS period,
+               COALESCE(s.ratings_count, 0) AS ratings_count,
+               s.avg_score, s.p10_score, s.p50_score, s.p90_score,
+               COALESCE(w.chats_handled, 0) AS chats_handled,
+               w.avg_handling_seconds, w.avg_first_response_seconds
+        FROM score_stats s
+        FULL JOIN work_stats w ON s.operator_id = w.operator_id AND s.period = w.period
+        JOIN users u ON u.id = COALESCE(s.operator_id, w.operator_id)
+        ORDER BY period, operator_name
+        """,
+        query_params
+    )
+    stats = fetch_records(cursor)
+    
+    for row in stats:
+        if group_by == 'total':
+            del row['period']
+    
+    return {
+        'statusCode': 200,
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+        'body': dump_json(stats),
+        'isBase64Encoded': False
+    }
+
+
+def parse_wait_params(body_data: Dict[str, Any]) -> Dict[str, Any]:
+    '''
+    Validates wait_for_events parameters and derives the NOTIFY channels to
+    listen on; raises ValueError with the message for the 400 response
+    '''
+    chat_ids = body_data.get('chat_ids') or ([body_data['chat_id']] if body_data.get('chat_id') else [])
+    operator_id = body_data.get('operator_id')
+    after_id = body_data.get('after_id')
+    changed_since = body_data.get('changed_since')
+    
+    try:
+        chat_ids = [int(chat_id) for chat_id in chat_ids]
+        operator_id = int(operator_id) if operator_id else None
+        after_id = int(after_id) if after_id is not None else None
+        timeout = min(max(float(body_data.get('timeout', WAIT_DEFAULT_SECONDS)), 0), WAIT_MAX_SECONDS)
+        changed_since = datetime.fromisoformat(changed_since) if changed_since else None
+    except (TypeError, ValueError):
+        raise ValueError('Invalid wait parameters')
+    
+    params = {
+        'chat_ids': chat_ids,
+        'operator_id': operator_id,
+        'include_queue': bool(body_data.get('include_queue')),
+        'after_id': after_id,
+        'changed_since': changed_since,
+        'timeout': timeout
+    }
+    
+    channels = [f'chat_{chat_id}' for chat_id in chat_ids]
+    if operator_id:
+        channels.append(f'operator_{operator_id}')
+    if params['include_queue']:
+        channels.append('chat_queue')
+    
+    if not channels:
+        raise ValueError('Chat ID, operator ID or include_queue required')
+    
+    return {**params, 'channels': channels}
+
+
+def handle_wait_for_events(body_data: Dict[str, Any], conn) -> Dict[str, Any]:
+    try:
+        params = parse_wait_params(body_data)
+    except ValueError as error:
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': dump_json({'error': str(error)}),
+            'isBase64Encoded': False
+        }
+    
+    if _wait_slots is None or not _wait_slots.acquire(blocking=False):
+        return {
+            'statusCode': 503,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*', 'Retry-After': '1'},
+            'body': dump_json({'error': 'Server busy, retry later'}),
+            'isBase64Encoded': False
+        }
+    
+    chat_ids, operator_id, include_queue = params['chat_ids'], params['operator_id'], params['include_queue']
+    after_id, changed_since = params['after_id'], params['changed_since']
+    events: List[Dict[str, Any]] = []
+    
+    try:
+        conn.autocommit = True
+        cursor = conn.cursor()
+        
+        # Имена каналов собраны из целых чисел, поэтому их можно подставлять в LISTEN
+        for channel in params['channels']:
+            cursor.execute(f'LISTEN {channel}')
+        
+        # События между последним опросом клиента и LISTEN не придут уведомлением - проверяем их сами
+        if chat_ids and after_id is not None:
+            execute_named(cursor, 'wait_missed_message', (chat_ids, after_id))
+            missed = cursor.fetchone()
+            if missed:
+                events.append({'type': 'message', 'chat_id': missed['chat_id'], 'message_id': missed['id'],
+                               'sender_type': missed['sender_type']})
+        
+        if not events and changed_since and (operator_id or include_queue):
+            execute_named(cursor, 'wait_missed_chat', (changed_since, operator_id, include_queue))
+            missed = cursor.fetchone()
+            if missed:
+                events.append({'type': 'chat_changed', 'chat_id': missed['id'], 'status': missed['status']})
+        
+        deadline = time.monotonic() + params['timeout']
+        while not events:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or select.select([conn], [], [], remaining) == ([], [], []):
+                break
+            conn.poll()
+            while conn.notifies:
+                events.append(json.loads(conn.notifies.pop(0).payload))
+    finally:
+        _wait_slots.release()
+        reset_listening(conn)
+    
+    return {
+        'statusCode': 200,
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+        'body': dump_json({'events': events, 'timed_out': not events}),
+        'isBase64Encoded': False
+    }
+
+
+def reset_listening(conn) -> None:
+    if conn.closed:
+        return
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute('UNLISTEN *')
+        conn.notifies.clear()
+        conn.autocommit = False
+    except psycopg2.Error as error:
+        # Исключение из finally заслонило бы исходную ошибку ожидания; соединение с
+        # неснятыми подписками в пул не возвращается
+        print(json.dumps({'function': 'chats', 'error': 'UNLISTEN failed', 'detail': str(error)}, ensure_ascii=False), flush=True)
+        close_quietly(conn)
+
+
+def handle_batch(body_data: Dict[str, Any], conn) -> Dict[str, Any]:
+    items = body_data.get('requests')
+    
+    if not isinstance(items, list) or not items or len(items) > BATCH_MAX_ITEMS:
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': dump_json({'error': f'Requests must be a list of 1 to {BATCH_MAX_ITEMS} items'}),
+            'isBase64Encoded': False
+        }
+    
+    read_only = all(
+        isinstance(item, dict) and item.get('action') in BATCH_READ_ACTIONS for item in items
+    )
+    cursor = conn.cursor()
+    if read_only:
+        # Все чтения батча видят один и тот же снимок базы
+        cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY")
+    
+    results = []
+    try:
+        for item in items:
+            action = item.get('action') if isinstance(item, dict) else None
+            
+            if action in BATCH_READ_ACTIONS or action in BATCH_WRITE_ACTIONS:
+                action_handler = BATCH_READ_ACTIONS.get(action) or BATCH_WRITE_ACTIONS[action]
+                if read_only:
+                    # Ошибка одного чтения откатывается к своей точке сохранения, снимок остальных сохраняется
+                    cursor.execute("SAVEPOINT batch_item")
+                try:
+                    response = action_handler(item, conn)
+                except Exception as error:
+                    # Уже закоммиченные записи и результаты прошлых элементов не теряются
+                    if read_only:
+                        cursor.execute("ROLLBACK TO SAVEPOINT batch_item")
+                    else:
+                        conn.rollback()
+                    message = 'Database error' if isinstance(error, psycopg2.DatabaseError) else 'Internal error'
+                    response = {'statusCode': 500, 'body': dump_json({'error': message})}
+                else:
+                    if read_only:
+                        cursor.execute("RELEASE SAVEPOINT batch_item")
+            else:
+                response = {'statusCode': 400, 'body': dump_json({'error': 'Invalid action'})}
+            
+            # Тела ответов уже сериализованы - склеиваем их без повторного json.loads/dumps
+            results.append(f'{{"statusCode": {response["statusCode"]}, "body": {response["body"]}}}')
+    finally:
+        if read_only:
+            conn.rollback()
     
     return {
         'statusCode': 200,
         'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps([dict(rating) for rating in ratings], default=str),
+        'body': f'{{"results": [{", ".join(results)}]}}',
         'isBase64Encoded': False
-    }
\ No newline at end of file
+    }
+
+
+BATCH_READ_ACTIONS = {
+    'get_chats': lambda item, conn: handle_get_chats({'queryStringParameters': item.get('query') or {}}, conn),
+    'get_messages': handle_get_messages,
+    'get_notes': handle_get_notes,
+    'get_qc_ratings': handle_get_qc_ratings,
+    'get_operator_stats': handle_get_operator_stats,
+    'search_messages': handle_search_messages
+}
+
+BATCH_WRITE_ACTIONS = {
+    'create_chat': handle_create_chat,
+    'send_message': handle_send_message,
+    'mark_read': handle_mark_read,
+    'close_chat': handle_close_chat,
+    'escalate_chat': handle_escalate_chat,
+    'add_note': handle_add_note,
+    'add_qc_rating': handle_add_qc_rating
+}
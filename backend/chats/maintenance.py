@@ -0,0 +1,48 @@
+import argparse
+import os
+import psycopg2
+
+
+def main() -> None:
+    '''
+    Business: Scheduled maintenance for chats storage - creates upcoming monthly
+              messages partitions and moves old closed chats into chat_archive
+    Usage: DATABASE_URL=... python backend/chats/maintenance.py [--archive-after-days N]
+    '''
+    parser = argparse.ArgumentParser(description='Chats storage maintenance')
+    parser.add_argument('--months-ahead', type=int, default=2)
+    parser.add_argument('--archive-after-days', type=int, default=90)
+    parser.add_argument('--batch-size', type=int, default=200)
+    args = parser.parse_args()
+    
+    conn = psycopg2.connect(os.environ.get('DATABASE_URL'))
+    
+    try:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT create_messages_partitions(LOCALTIMESTAMP::date, %s)",
+            (args.months_ahead,)
+        )
+        print(f'partitions created: {cursor.fetchone()[0]}')
+        conn.commit()
+        
+        # Небольшие пачки с коммитом после каждой, чтобы не держать долгие блокировки
+        total = 0
+        while True:
+            cursor.execute(
+                "SELECT archive_closed_chats(%s, %s)",
+                (args.archive_after_days, args.batch_size)
+            )
+            archived = cursor.fetchone()[0]
+            conn.commit()
+            total += archived
+            if archived < args.batch_size:
+                break
+        print(f'chats archived: {total}')
+    
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,604 @@
+import base64
+import functools
+import gzip
+import hashlib
 import json
 import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from collections import OrderedDict
 import psycopg2
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE, TRANSACTION_STATUS_UNKNOWN, connection as connection_type, cursor as cursor_type
 from psycopg2.extras import RealDictCursor
+from psycopg2.errors import InvalidSqlStatementName
+from psycopg2.pool import PoolError
 import bcrypt
-from typing import Dict, Any
+from datetime import date
+from decimal import Decimal
+from typing import Dict, Any, List, Tuple, Optional
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+DB_POOL_MAX = int(os.environ.get('DB_POOL_MAX', '4'))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', '5'))
+DB_POOL_CHECK_AFTER = float(os.environ.get('DB_POOL_CHECK_AFTER', '30'))
+
+_pool_lock = threading.Lock()
+_pool_slots = threading.BoundedSemaphore(DB_POOL_MAX)
+_pool_idle: List[Tuple[Any, float]] = []
+pool_stats: Dict[str, int] = {'hits': 0, 'misses': 0, 'reconnects': 0}
+
+
+def get_connection():
+    '''
+    Checks out a connection from the warm-container pool, opening a new one
+    when nothing is idle and replacing idle connections that went stale
+    '''
+    if not _pool_slots.acquire(timeout=DB_POOL_TIMEOUT):
+        raise PoolError('Connection pool exhausted')
+    
+    try:
+        with _pool_lock:
+            idle = _pool_idle.pop() if _pool_idle else None
+        
+        if idle:
+            conn, released_at = idle
+            if is_connection_alive(conn, released_at):
+                with _pool_lock:
+                    pool_stats['hits'] += 1
+                return conn
+            close_quietly(conn)
+            with _pool_lock:
+                pool_stats['reconnects'] += 1
+        else:
+            with _pool_lock:
+                pool_stats['misses'] += 1
+        
+        return open_connection()
+    except Exception:
+        _pool_slots.release()
+        raise
+
+
+def open_connection():
+    conn = psycopg2.connect(
+        os.environ.get('DATABASE_URL'), connection_factory=CatalogConnection,
+        cursor_factory=TracingCursor if TRACE_REQUESTS else RealDictCursor
+    )
+    # Подписка живёт всё время жизни соединения в пуле
+    with conn.cursor() as cursor:
+        cursor.execute('LISTEN session_invalidated')
+    conn.commit()
+    return conn
+
+
+def release_connection(conn) -> None:
+    try:
+        if not conn.closed:
+            tx_status = conn.get_transaction_status()
+            if tx_status == TRANSACTION_STATUS_UNKNOWN:
+                close_quietly(conn)
+            elif tx_status != TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+        if not conn.closed:
+            with _pool_lock:
+                _pool_idle.append((conn, time.monotonic()))
+    except psycopg2.Error:
+        close_quietly(conn)
+    finally:
+        _pool_slots.release()
+
+
+def is_connection_alive(conn, released_at: float) -> bool:
+    if conn.closed:
+        return False
+    if time.monotonic() - released_at < DB_POOL_CHECK_AFTER:
+        return True
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute('SELECT name FROM pg_prepared_statements')
+            kept = {row['name'] for row in cursor.fetchall()}
+        conn.rollback()
+        # Простоявшая сессия могла пережить DISCARD - забываем то, чего сервер уже не хранит
+        if not conn.prepared <= kept:
+            conn.forget_prepared()
+        return True
+    except psycopg2.Error:
+        return False
+
+
+def close_quietly(conn) -> None:
+    try:
+        conn.close()
+    except psycopg2.Error:
+        pass
+
+
+def get_pool_stats() -> Dict[str, int]:
+    with _pool_lock:
+        return {**pool_stats, 'idle': len(_pool_idle), 'max': DB_POOL_MAX}
+
+
+# Горячие запросы функции: готовятся на соединении при первом использовании, $n - параметры
+QUERY_CATALOG: Dict[str, str] = {
+    'session_user': """
+        SELECT u.id, u.username, u.full_name, u.role, u.status, u.department,
+               EXTRACT(EPOCH FROM s.expires_at - LOCALTIMESTAMP) AS expires_in
+        FROM sessions s
+        JOIN users u ON s.user_id = u.id
+        WHERE s.token_hash = decode($1, 'hex') AND s.expires_at > CURRENT_TIMESTAMP AND u.is_active = true
+    """,
+    'session_renew': """
+        UPDATE sessions SET expires_at = LOCALTIMESTAMP + make_interval(secs => $1)
+        WHERE token_hash = decode($2, 'hex')
+    """
+}
+
+
+DB_PREPARE_STATEMENTS = os.environ.get('DB_PREPARE_STATEMENTS', '1') not in ('0', 'false')
+
+
+class CatalogConnection(connection_type):
+    '''
+    Pooled connection that remembers which QUERY_CATALOG statements its server
+    session has already prepared, and which ones failed to prepare
+    '''
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared: set = set()
+        self.executed: set = set()
+        self.unpreparable: set = set()
+    
+    def forget_prepared(self) -> None:
+        self.prepared.clear()
+        self.executed.clear()
+
+
+def execute_named(cursor, name: str, params: Tuple = ()) -> None:
+    '''
+    Runs a QUERY_CATALOG statement by name: PREPAREd once per pooled connection,
+    then EXECUTEd so Postgres skips parsing and planning. When PREPARE fails, or
+    the first EXECUTE finds the server did not keep the statement, it runs as
+    plain SQL on that connection from then on
+    '''
+    conn = cursor.connection
+    prepared = getattr(conn, 'prepared', None)
+    
+    if DB_PREPARE_STATEMENTS and prepared is not None and name not in conn.unpreparable:
+        if name not in prepared:
+            prepare_statement(cursor, name)
+        if name in prepared:
+            statement = f"EXECUTE {name} ({', '.join(['%s'] * len(params))})" if params else f'EXECUTE {name}'
+            first = name not in conn.executed
+            fresh = conn.autocommit or conn.get_transaction_status() == TRANSACTION_STATUS_IDLE
+            # Точка сохранения нужна только первому EXECUTE после PREPARE внутри начатой транзакции:
+            # дальше сессия уже доказала, что хранит запрос. Если транзакции ещё не было, откат ничего не теряет
+            guarded = first and not fresh
+            try:
+                cursor.execute(f'SAVEPOINT catalog_execute; {statement}' if guarded else statement, params)
+            except InvalidSqlStatementName:
+                if guarded:
+                    cursor.execute('ROLLBACK TO SAVEPOINT catalog_execute')
+                elif not fresh:
+                    # Сессию сбросили (DISCARD ALL) посреди транзакции - её уже не спасти,
+                    # но следующий запрос на этом соединении подготовит всё заново
+                    conn.forget_prepared()
+                    raise
+                elif not conn.autocommit:
+                    conn.rollback()
+                if first:
+                    # PREPARE и EXECUTE попали в разные сессии (пулер в режиме транзакций) -
+                    # дальше это соединение шлёт запрос обычным текстом, начиная с этого вызова
+                    prepared.discard(name)
+                    conn.unpreparable.add(name)
+                else:
+                    conn.forget_prepared()
+            else:
+                if guarded:
+                    # Отдельным курсором, чтобы не затереть результат EXECUTE
+                    with conn.cursor() as release:
+                        release.execute('RELEASE SAVEPOINT catalog_execute')
+                conn.executed.add(name)
+                return
+    
+    cursor.execute(_catalog_fallback[name], {str(i): value for i, value in enumerate(params, 1)} or None)
+
+
+def prepare_statement(cursor, name: str) -> None:
+    conn = cursor.connection
+    # Внутри транзакции неудачный PREPARE откатывается до точки сохранения и не ломает запрос
+    in_transaction = not conn.autocommit
+    if in_transaction:
+        cursor.execute('SAVEPOINT catalog_prepare')
+    try:
+        cursor.execute(f'PREPARE {name} AS {QUERY_CATALOG[name]}')
+    except psycopg2.Error:
+        if in_transaction:
+            cursor.execute('ROLLBACK TO SAVEPOINT catalog_prepare')
+        conn.unpreparable.add(name)
+    else:
+        conn.prepared.add(name)
+    if in_transaction:
+        cursor.execute('RELEASE SAVEPOINT catalog_prepare')
+
+
+# Тот же текст с %(n)s вместо $n - для соединений, где PREPARE недоступен
+_catalog_fallback: Dict[str, str] = {
+    name: re.sub(r'\$(\d+)', r'%(\1)s', query) for name, query in QUERY_CATALOG.items()
+}
+
+
+TRACE_REQUESTS = os.environ.get('TRACE_REQUESTS', '') in ('1', 'true')
+TRACE_SLOW_MS = float(os.environ.get('TRACE_SLOW_MS', '0'))
+TRACE_FINGERPRINT_CACHE_SIZE = 1024
+
+_trace_state = threading.local()
+_query_fingerprints: Dict[str, Tuple[str, str]] = {}
+
+
+class RequestTrace:
+    def __init__(self, request_id: str):
+        self.request_id = request_id
+        self.started = time.perf_counter()
+        self.spans: Dict[str, float] = {}
+        self.queries: Dict[str, Dict[str, Any]] = {}
+
+    def add_span(self, name: str, seconds: float) -> None:
+        self.spans[name] = self.spans.get(name, 0.0) + seconds
+
+    def add_query(self, query: Any, seconds: float, rows: int) -> None:
+        if isinstance(query, bytes):
+            query = query.decode('utf-8')
+        fingerprint, statement = _query_fingerprints.get(query) or fingerprint_query(query)
+        entry = self.queries.get(fingerprint)
+        if entry is None:
+            entry = self.queries[fingerprint] = {
+                'fingerprint': fingerprint, 'statement': statement, 'calls': 0, 'rows': 0, 'ms': 0.0
+            }
+        entry['calls'] += 1
+        entry['rows'] += max(rows, 0)
+        entry['ms'] += seconds * 1000
+        self.add_span('db', seconds)
+
+    def server_timing(self) -> str:
+        return ', '.join(f'{name};dur={seconds * 1000:.1f}' for name, seconds in self.spans.items())
+
+    def to_log(self, function_name: str, event: Dict[str, Any], status: Any) -> Dict[str, Any]:
+        try:
+            action = json.loads(event.get('body') or '{}').get('action', '')
+        except (ValueError, AttributeError):
+            action = ''
+        return {
+            'trace': 'request',
+            'request_id': self.request_id,
+            'function': function_name,
+            'method': event.get('httpMethod'),
+            'action': action,
+            'status': status,
+            **{f'{name}_ms': round(seconds * 1000, 2) for name, seconds in self.spans.items()},
+            'queries': sorted(
+                ({**entry, 'ms': round(entry['ms'], 2)} for entry in self.queries.values()),
+                key=lambda entry: entry['ms'], reverse=True
+            )
+        }
+
+
+def fingerprint_query(query: str) -> Tuple[str, str]:
+    # Параметры передаются через %s, поэтому текст запроса без пробельного шума и есть отпечаток
+    statement = ' '.join(query.split())
+    result = (hashlib.md5(statement.encode('utf-8')).hexdigest()[:12], statement[:160])
+    if len(_query_fingerprints) < TRACE_FINGERPRINT_CACHE_SIZE:
+        _query_fingerprints[query] = result
+    return result
+
+
+class TracingMixin:
+    def execute(self, query, vars=None):
+        trace = getattr(_trace_state, 'current', None)
+        if trace is None:
+            return super().execute(query, vars)
+        started = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            trace.add_query(query, time.perf_counter() - started, self.rowcount)
+
+
+class TracingCursor(TracingMixin, RealDictCursor):
+    pass
+
+
+class TracingTupleCursor(TracingMixin, cursor_type):
+    pass
+
+
+@contextmanager
+def trace_span(name: str):
+    trace = getattr(_trace_state, 'current', None)
+    if trace is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add_span(name, time.perf_counter() - started)
+
+
+def dump_json(payload: Any) -> str:
+    trace = getattr(_trace_state, 'current', None)
+    if trace is None:
+        return to_json(payload)
+    started = time.perf_counter()
+    try:
+        return to_json(payload)
+    finally:
+        trace.add_span('serialize', time.perf_counter() - started)
+
+
+RESPONSE_COMPRESS_MIN_BYTES = int(os.environ.get('RESPONSE_COMPRESS_MIN_BYTES', '1024'))
+RESPONSE_GZIP_LEVEL = 6
+RESPONSE_BROTLI_QUALITY = 5
+
+
+def to_json(payload: Any) -> str:
+    # orjson пишет datetime/date сам, без обратного вызова на каждое значение;
+    # без него stdlib json выдаёт тот же ISO-формат через encode_json_value
+    if orjson is not None:
+        return orjson.dumps(payload, default=encode_json_value).decode('utf-8')
+    return json.dumps(payload, default=encode_json_value, ensure_ascii=False, separators=(',', ':'))
+
+
+def encode_json_value(value: Any) -> Any:
+    if isinstance(value, date):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return float(value)
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+def list_cursor(conn):
+    '''
+    Tuple cursor for list reads: rows are built in C and turned into dicts by
+    fetch_records, instead of RealDictRow filling every column in Python
+    '''
+    return conn.cursor(cursor_factory=TracingTupleCursor if TRACE_REQUESTS else cursor_type)
+
+
+def fetch_records(cursor) -> List[Dict[str, Any]]:
+    rows = cursor.fetchall()
+    if not rows:
+        return []
+    columns = [column.name for column in cursor.description]
+    return [dict(zip(columns, row)) for row in rows]
+
+
+def get_header(event: Dict[str, Any], name: str) -> str:
+    name = name.lower()
+    for key, value in (event.get('headers') or {}).items():
+        if key.lower() == name:
+            return value or ''
+    return ''
+
+
+def accepted_encodings(accept_encoding: str) -> List[str]:
+    encodings = []
+    for part in accept_encoding.split(','):
+        coding, _, params = part.partition(';')
+        quality = params.strip().lower()
+        if quality.startswith('q=') and quality[2:].strip() in ('0', '0.0', '0.00', '0.000'):
+            continue
+        encodings.append(coding.strip().lower())
+    return encodings
+
+
+def compressible(func):
+    @functools.wraps(func)
+    def wrapper(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+        return compress_response(event, func(event, context))
+    
+    return wrapper
+
+
+def compress_response(event: Dict[str, Any], response: Dict[str, Any]) -> Dict[str, Any]:
+    '''
+    Compresses JSON bodies above RESPONSE_COMPRESS_MIN_BYTES with brotli or gzip,
+    whichever the client accepts, and returns them base64-encoded with
+    isBase64Encoded set, as the cloud runtime expects for binary bodies
+    '''
+    body = response.get('body')
+    if response.get('isBase64Encoded') or not isinstance(body, str) or len(body) < RESPONSE_COMPRESS_MIN_BYTES // 2:
+        return response
+    
+    raw = body.encode('utf-8')
+    if len(raw) < RESPONSE_COMPRESS_MIN_BYTES:
+        return response
+    
+    encodings = accepted_encodings(get_header(event, 'Accept-Encoding'))
+    headers = {**response.get('headers', {}), 'Vary': 'Accept-Encoding'}
+    with trace_span('compress'):
+        if brotli is not None and 'br' in encodings:
+            encoding, data = 'br', brotli.compress(raw, quality=RESPONSE_BROTLI_QUALITY)
+        elif 'gzip' in encodings:
+            encoding, data = 'gzip', gzip.compress(raw, compresslevel=RESPONSE_GZIP_LEVEL, mtime=0)
+        else:
+            return {**response, 'headers': headers}
+    
+    return {
+        **response,
+        'headers': {**headers, 'Content-Encoding': encoding},
+        'body': base64.b64encode(data).decode('ascii'),
+        'isBase64Encoded': True
+    }
+
+
+def traced(function_name: str):
+    '''
+    Opt-in per-request tracing: with TRACE_REQUESTS on, times connect, every
+    query by fingerprint, serialization and total, logs one JSON line per request
+    and adds a Server-Timing header; otherwise the handler is returned untouched
+    '''
+    def decorate(func):
+        if not TRACE_REQUESTS:
+            return func
+
+        @functools.wraps(func)
+        def wrapper(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+            trace = RequestTrace(getattr(context, 'request_id', ''))
+            _trace_state.current = trace
+            status: Any = 'error'
+            try:
+                response = func(event, context)
+                status = response.get('statusCode')
+                trace.add_span('total', time.perf_counter() - trace.started)
+                response['headers'] = {
+                    **response.get('headers', {}),
+                    'Server-Timing': trace.server_timing(),
+                    'Timing-Allow-Origin': '*'
+                }
+                return response
+            finally:
+                _trace_state.current = None
+                if 'total' not in trace.spans:
+                    trace.add_span('total', time.perf_counter() - trace.started)
+                if trace.spans['total'] * 1000 >= TRACE_SLOW_MS:
+                    print(json.dumps(trace.to_log(function_name, event, status), ensure_ascii=False), flush=True)
+
+        return wrapper
+    return decorate
+
+
+SESSION_CACHE_TTL = float(os.environ.get('SESSION_CACHE_TTL', '60'))
+SESSION_CACHE_SIZE = int(os.environ.get('SESSION_CACHE_SIZE', '1024'))
+SESSION_TTL_SECONDS = int(os.environ.get('SESSION_TTL_SECONDS', str(7 * 24 * 3600)))
+SESSION_SLIDING = os.environ.get('SESSION_SLIDING', '') in ('1', 'true')
+SESSION_RENEW_INTERVAL = int(os.environ.get('SESSION_RENEW_INTERVAL', '3600'))
+
+_session_cache_lock = threading.Lock()
+_session_cache: 'OrderedDict[str, Tuple[Dict[str, Any], float]]' = OrderedDict()
+
+
+def hash_token(session_token: str) -> str:
+    return hashlib.sha256(session_token.encode('utf-8')).hexdigest()
+
+
+def resolve_session(conn, session_token: str) -> Optional[Dict[str, Any]]:
+    '''
+    Returns the active user behind a session token. Results are cached per
+    container by token hash until the TTL or the session expiry, whichever
+    comes first; logout and user updates evict entries via NOTIFY.
+    With SESSION_SLIDING the expiry is pushed forward at most once per
+    SESSION_RENEW_INTERVAL, on a cache miss
+    '''
+    apply_session_invalidations(conn)
+    token_hash = hash_token(session_token)
+    
+    cached = get_cached_session(token_hash)
+    if cached:
+        return cached
+    
+    cursor = conn.cursor()
+    execute_named(cursor, 'session_user', (token_hash,))
+    result = cursor.fetchone()
+    
+    if not result:
+        return None
+    
+    user = dict(result)
+    expires_in = float(user.pop('expires_in'))
+    
+    if SESSION_SLIDING and expires_in < SESSION_TTL_SECONDS - SESSION_RENEW_INTERVAL:
+        execute_named(cursor, 'session_renew', (SESSION_TTL_SECONDS, token_hash))
+        conn.commit()
+        expires_in = float(SESSION_TTL_SECONDS)
+    
+    cache_session(token_hash, user, expires_in)
+    return user
+
+
+def get_cached_session(token_hash: str) -> Optional[Dict[str, Any]]:
+    with _session_cache_lock:
+        cached = _session_cache.get(token_hash)
+        if cached and cached[1] > time.monotonic():
+            _session_cache.move_to_end(token_hash)
+            return cached[0]
+        _session_cache.pop(token_hash, None)
+    return None
+
+
+def cache_session(token_hash: str, user: Dict[str, Any], expires_in: float) -> None:
+    with _session_cache_lock:
+        _session_cache[token_hash] = (user, time.monotonic() + min(SESSION_CACHE_TTL, expires_in))
+        while len(_session_cache) > SESSION_CACHE_SIZE:
+            _session_cache.popitem(last=False)
+
+
+def invalidate_sessions(token_hash: Optional[str] = None, user_id: Optional[int] = None) -> None:
+    with _session_cache_lock:
+        for key, (user, _) in list(_session_cache.items()):
+            if key == token_hash or (user_id is not None and user['id'] == user_id):
+                del _session_cache[key]
+
+
+def apply_session_invalidations(conn) -> None:
+    # Уведомления уже лежат в сокете соединения, poll() читает их без запроса к базе
+    conn.poll()
+    while conn.notifies:
+        kind, _, value = conn.notifies.pop(0).payload.partition(':')
+        if kind == 'token':
+            invalidate_sessions(token_hash=value)
+        elif kind == 'user':
+            invalidate_sessions(user_id=int(value))
+
+
+def publish_session_invalidation(cursor, payload: str) -> None:
+    cursor.execute("SELECT pg_notify('session_invalidated', %s)", (payload,))
+
+
+BCRYPT_ROUNDS = int(os.environ.get('BCRYPT_ROUNDS', '12'))
+BCRYPT_WORKERS = int(os.environ.get('BCRYPT_WORKERS', '2'))
+BCRYPT_MAX_PENDING = int(os.environ.get('BCRYPT_MAX_PENDING', '8'))
+
+_bcrypt_slots = threading.BoundedSemaphore(BCRYPT_MAX_PENDING)
+_bcrypt_running = threading.BoundedSemaphore(BCRYPT_WORKERS)
+
+
+class PasswordHashingBusy(Exception):
+    pass
+
+
+def run_bcrypt(func, *args):
+    '''
+    Runs a bcrypt call on the calling thread, at most BCRYPT_WORKERS at a time;
+    when BCRYPT_MAX_PENDING calls are already waiting or running it fails fast
+    instead of queueing more CPU work
+    '''
+    if not _bcrypt_slots.acquire(blocking=False):
+        raise PasswordHashingBusy('Password hashing pool is busy')
+    try:
+        # bcrypt отпускает GIL, так что отдельный пул потоков ничего не даёт - вызывающий поток всё равно ждал бы
+        with _bcrypt_running:
+            return func(*args)
+    finally:
+        _bcrypt_slots.release()
+
+
+def hash_password(password: str) -> str:
+    return run_bcrypt(bcrypt.hashpw, password.encode('utf-8'), bcrypt.gensalt(BCRYPT_ROUNDS)).decode('utf-8')
+
+
+@traced('users')
+@compressible
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
     Business: User management for admin - CRUD operations on users
@@ -34,30 +628,21 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         return {
             'statusCode': 401,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Unauthorized'}),
+            'body': dump_json({'error': 'Unauthorized'}),
             'isBase64Encoded': False
         }
     
-    db_url = os.environ.get('DATABASE_URL')
-    conn = psycopg2.connect(db_url, cursor_factory=RealDictCursor)
+    with trace_span('connect'):
+        conn = get_connection()
     
     try:
-        cursor = conn.cursor()
-        cursor.execute(
-            """
-            SELECT u.role FROM sessions s
-            JOIN users u ON s.user_id = u.id
-            WHERE s.session_token = %s AND s.expires_at > CURRENT_TIMESTAMP
-            """,
-            (session_token,)
-        )
-        session_user = cursor.fetchone()
+        session_user = resolve_session(conn, session_token)
         
         if not session_user or session_user['role'] != 'admin':
             return {
                 'statusCode': 403,
                 'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'Access denied - admin only'}),
+                'body': dump_json({'error': 'Access denied - admin only'}),
                 'isBase64Encoded': False
             }
         
@@ -71,29 +656,30 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         return {
             'statusCode': 405,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Method not allowed'}),
+            'body': dump_json({'error': 'Method not allowed'}),
             'isBase64Encoded': False
         }
     
     finally:
-        conn.close()
+        release_connection(conn)
 
 
 def handle_get_users(conn) -> Dict[str, Any]:
-    cursor = conn.cursor()
+    cursor = list_cursor(conn)
     cursor.execute(
         """
-        SELECT id, username, full_name, role, status, department, is_active, created_at, updated_at
+        SELECT id, username, full_name, role, status, department, is_active,
+               active_chat_count, max_active_chats, created_at, updated_at
         FROM users
         ORDER BY created_at DESC
         """
     )
-    users = cursor.fetchall()
+    users = fetch_records(cursor)
     
     return {
         'statusCode': 200,
         'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps([dict(user) for user in users], default=str),
+        'body': dump_json(users),
         'isBase64Encoded': False
     }
 
@@ -111,7 +697,7 @@ def handle_create_user(event: Dict[str, Any], conn) -> Dict[str, Any]:
         return {
             'statusCode': 400,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Username, password, and full_name required'}),
+            'body': dump_json({'error': 'Username, password, and full_name required'}),
             'isBase64Encoded': False
         }
     
@@ -119,11 +705,19 @@ def handle_create_user(event: Dict[str, Any], conn) -> Dict[str, Any]:
         return {
             'statusCode': 400,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Invalid role'}),
+            'body': dump_json({'error': 'Invalid role'}),
             'isBase64Encoded': False
         }
     
-    password_hash = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+    try:
+        password_hash = hash_password(password)
+    except PasswordHashingBusy:
+        return {
+            'statusCode': 503,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*', 'Retry-After': '1'},
+            'body': dump_json({'error': 'Server busy, retry later'}),
+            'isBase64Encoded': False
+        }
     
     cursor = conn.cursor()
     cursor.execute(
@@ -135,12 +729,14 @@ def handle_create_user(event: Dict[str, Any], conn) -> Dict[str, Any]:
         (username, password_hash, full_name, role, department)
     )
     new_user = cursor.fetchone()
+    # Новый сотрудник должен сразу появиться в кэшированном списке операторов
+    publish_session_invalidation(cursor, f"user:{new_user['id']}")
     conn.commit()
     
     return {
         'statusCode': 201,
         'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps(dict(new_user), default=str),
+        'body': dump_json(dict(new_user)),
         'isBase64Encoded': False
     }
 
@@ -155,12 +751,13 @@ def handle_update_user(event: Dict[str, Any], conn) -> Dict[str, Any]:
     department = body_data.get('department')
     is_active = body_data.get('is_active')
     password = body_data.get('password')
+    max_active_chats = body_data.get('max_active_chats')
     
     if not user_id:
         return {
             'statusCode': 400,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'User ID required'}),
+            'body': dump_json({'error': 'User ID required'}),
             'isBase64Encoded': False
         }
     
@@ -182,8 +779,19 @@ def handle_update_user(event: Dict[str, Any], conn) -> Dict[str, Any]:
     if is_active is not None:
         update_fields.append("is_active = %s")
         params.append(is_active)
+    if max_active_chats is not None:
+        update_fields.append("max_active_chats = %s")
+        params.append(max_active_chats)
     if password:
-        password_hash = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+        try:
+            password_hash = hash_password(password)
+        except PasswordHashingBusy:
+            return {
+                'statusCode': 503,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*', 'Retry-After': '1'},
+                'body': dump_json({'error': 'Server busy, retry later'}),
+                'isBase64Encoded': False
+            }
         update_fields.append("password_hash = %s")
         params.append(password_hash)
     
@@ -196,24 +804,29 @@ def handle_update_user(event: Dict[str, Any], conn) -> Dict[str, Any]:
         UPDATE users
         SET {', '.join(update_fields)}
         WHERE id = %s
-        RETURNING id, username, full_name, role, status, department, is_active, updated_at
+        RETURNING id, username, full_name, role, status, department, is_active, max_active_chats, updated_at
         """,
         params
     )
     updated_user = cursor.fetchone()
+    if updated_user:
+        # Роль или активность могли измениться - сбросить кэш сессий во всех контейнерах
+        publish_session_invalidation(cursor, f"user:{updated_user['id']}")
     conn.commit()
+    if updated_user:
+        invalidate_sessions(user_id=updated_user['id'])
     
     if not updated_user:
         return {
             'statusCode': 404,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'User not found'}),
+            'body': dump_json({'error': 'User not found'}),
             'isBase64Encoded': False
         }
     
     return {
         'statusCode': 200,
         'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps(dict(updated_user), default=str),
+        'body': dump_json(dict(updated_user)),
         'isBase64Encoded': False
     }
@@ -0,0 +1,395 @@
+import argparse
+import functools
+import importlib.util
+import json
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, Any, List, Callable
+
+import bcrypt
+import psycopg2
+from psycopg2.extensions import connection as connection_type, cursor as cursor_type
+from psycopg2.extras import RealDictCursor
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+BENCH_PASSWORD = 'bench-password'
+DEFAULT_MIX = 'get_chats=28,get_messages=33,send_message=15,verify=10,login=5,get_notes=5,get_users=2,update_user=2'
+BENCH_ADMIN = 'bench_admin'
+
+_query_counter = threading.local()
+_real_connect = psycopg2.connect
+
+
+@functools.lru_cache(maxsize=None)
+def counting_cursor_class(base: type) -> type:
+    def execute(self, query, vars=None):
+        _query_counter.count = getattr(_query_counter, 'count', 0) + 1
+        return base.execute(self, query, vars)
+    return type(f'Counting{base.__name__}', (base,), {'execute': execute})
+
+
+@functools.lru_cache(maxsize=None)
+def counting_connection_class(base: type) -> type:
+    def cursor(self, *args, **kwargs):
+        # Считаются курсоры любого класса - и словарные по умолчанию, и кортежные list_cursor
+        kwargs['cursor_factory'] = counting_cursor_class(kwargs.get('cursor_factory') or self.cursor_factory or cursor_type)
+        return base.cursor(self, *args, **kwargs)
+    return type(f'Counting{base.__name__}', (base,), {'cursor': cursor})
+
+
+def counting_connect(*args, **kwargs):
+    # Хендлеры открывают соединения через psycopg2.connect - подменяем фабрику соединений для подсчёта запросов
+    kwargs['connection_factory'] = counting_connection_class(kwargs.get('connection_factory') or connection_type)
+    return _real_connect(*args, **kwargs)
+
+
+def load_handler(function_name: str) -> Callable:
+    spec = importlib.util.spec_from_file_location(
+        f'{function_name}_index', ROOT_DIR / 'backend' / function_name / 'index.py'
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.handler
+
+
+def apply_migrations(conn) -> None:
+    cursor = conn.cursor()
+    for path in sorted((ROOT_DIR / 'db_migrations').glob('V*.sql')):
+        print(f'applying {path.name}', file=sys.stderr)
+        cursor.execute(path.read_text(encoding='utf-8'))
+        conn.commit()
+
+
+def seed(conn, operators: int, chats: int, messages_per_chat: int, days: int, bcrypt_rounds: int) -> None:
+    '''
+    Bulk-seeds bench_* operators, chats and messages with set-based SQL, then
+    recomputes the summary and routing counters the handlers normally maintain
+    '''
+    password_hash = bcrypt.hashpw(BENCH_PASSWORD.encode('utf-8'), bcrypt.gensalt(bcrypt_rounds)).decode('utf-8')
+    cursor = conn.cursor()
+
+    cursor.execute(
+        "SELECT create_messages_partitions((LOCALTIMESTAMP - make_interval(days => %s))::date, 2)",
+        (days + 1,)
+    )
+    cursor.execute(
+        """
+        INSERT INTO users (username, password_hash, full_name, role, status, department)
+        SELECT 'bench_op_' || g, %s, 'Bench Operator ' || g, 'operator', 'online', 'Поддержка'
+        FROM generate_series(1, %s) g
+        ON CONFLICT (username) DO NOTHING
+        """,
+        (password_hash, operators)
+    )
+    cursor.execute(
+        """
+        INSERT INTO users (username, password_hash, full_name, role)
+        VALUES (%s, %s, 'Bench Admin', 'admin')
+        ON CONFLICT (username) DO NOTHING
+        """,
+        (BENCH_ADMIN, password_hash)
+    )
+    cursor.execute(
+        """
+        INSERT INTO chats (client_name, status, assigned_operator_id, created_at, updated_at)
+        SELECT 'Bench Client ' || s.g,
+               (ARRAY['waiting', 'active', 'closed', 'closed', 'closed'])[1 + s.g %% 5],
+               CASE WHEN s.g %% 5 <> 0 THEN ops.ids[1 + s.g %% array_length(ops.ids, 1)] END,
+               s.created_at, s.created_at
+        FROM (
+            SELECT g, LOCALTIMESTAMP - random() * make_interval(days => %s) AS created_at
+            FROM generate_series(1, %s) g
+        ) s
+        CROSS JOIN (
+            SELECT array_agg(id) AS ids FROM users WHERE username LIKE 'bench_op_%%'
+        ) ops
+        """,
+        (days, chats)
+    )
+    conn.commit()
+    print(f'seeded {operators} operators and {chats} chats', file=sys.stderr)
+
+    cursor.execute(
+        """
+        INSERT INTO messages (chat_id, sender_type, sender_id, message_text, is_read, created_at)
+        SELECT c.id,
+               CASE WHEN n %% 2 = 1 THEN 'client' ELSE 'operator' END,
+               CASE WHEN n %% 2 = 0 THEN c.assigned_operator_id END,
+               'Сообщение ' || n || ' по заказу номер ' || c.id || ', доставка и оплата',
+               c.status = 'closed',
+               LEAST(c.created_at + n * INTERVAL '30 seconds', LOCALTIMESTAMP)
+        FROM chats c
+        CROSS JOIN generate_series(1, %s) n
+        WHERE c.client_name LIKE 'Bench Client %%'
+        """,
+        (messages_per_chat,)
+    )
+    conn.commit()
+    print(f'seeded {chats * messages_per_chat} messages', file=sys.stderr)
+
+    cursor.execute(
+        """
+        UPDATE chats c
+        SET last_message_id = lm.id, last_message_text = lm.message_text, last_message_at = lm.created_at,
+            updated_at = GREATEST(c.updated_at, lm.created_at),
+            unread_client_count = lm.unread
+        FROM (
+            SELECT DISTINCT ON (chat_id) chat_id, id, message_text, created_at,
+                   COUNT(*) FILTER (WHERE is_read = false AND sender_type = 'client') OVER (PARTITION BY chat_id) AS unread
+            FROM messages
+            ORDER BY chat_id, id DESC
+        ) lm
+        WHERE lm.chat_id = c.id AND c.client_name LIKE 'Bench Client %%'
+        """
+    )
+    cursor.execute(
+        """
+        UPDATE users u
+        SET active_chat_count = COALESCE(
+            (SELECT COUNT(*) FROM chats c WHERE c.assigned_operator_id = u.id AND c.status = 'active'), 0
+        ),
+            max_active_chats = GREATEST(max_active_chats, 1000)
+        WHERE u.username LIKE 'bench_op_%%'
+        """
+    )
+    conn.commit()
+    cursor.execute('ANALYZE')
+    conn.commit()
+
+
+class Context:
+    def __init__(self):
+        self.request_id = str(uuid.uuid4())
+
+
+class Workload:
+    def __init__(self, conn, handlers: Dict[str, Callable]):
+        self.handlers = handlers
+        cursor = conn.cursor()
+        cursor.execute("SELECT id, username FROM users WHERE username LIKE 'bench_op_%%'")
+        self.operators = cursor.fetchall()
+        cursor.execute("SELECT id FROM users WHERE username = %s", (BENCH_ADMIN,))
+        self.admin = cursor.fetchone()
+        cursor.execute(
+            "SELECT id, last_message_id FROM chats WHERE client_name LIKE 'Bench Client %%' AND status <> 'closed'"
+        )
+        self.open_chats = cursor.fetchall()
+        self.tokens: List[str] = []
+        self.tokens_lock = threading.Lock()
+        self.admin_token = None
+
+        if not self.operators or not self.open_chats or not self.admin:
+            raise SystemExit('No bench data found, run with --seed first')
+
+    def call(self, function_name: str, method: str, body: Dict[str, Any] = None,
+             query: Dict[str, str] = None, headers: Dict[str, str] = None) -> Dict[str, Any]:
+        event = {
+            'httpMethod': method,
+            'headers': headers or {},
+            'queryStringParameters': query or {},
+            'body': json.dumps(body) if body is not None else '',
+            'isBase64Encoded': False
+        }
+        return self.handlers[function_name](event, Context())
+
+    def login(self) -> Dict[str, Any]:
+        operator = random.choice(self.operators)
+        response = self.call('auth', 'POST', {
+            'action': 'login', 'username': operator['username'], 'password': BENCH_PASSWORD
+        })
+        if response['statusCode'] == 200:
+            with self.tokens_lock:
+                self.tokens.append(json.loads(response['body'])['session_token'])
+        return response
+
+    def verify(self) -> Dict[str, Any]:
+        if not self.tokens:
+            return self.login()
+        token = random.choice(self.tokens)
+        return self.call('auth', 'POST', {'action': 'verify'}, headers={'X-Session-Token': token})
+
+    def admin_headers(self) -> Dict[str, str]:
+        with self.tokens_lock:
+            if self.admin_token is None:
+                response = self.call('auth', 'POST', {
+                    'action': 'login', 'username': BENCH_ADMIN, 'password': BENCH_PASSWORD
+                })
+                if response['statusCode'] == 200:
+                    self.admin_token = json.loads(response['body'])['session_token']
+            return {'X-Session-Token': self.admin_token or ''}
+
+    def get_users(self) -> Dict[str, Any]:
+        return self.call('users', 'GET', headers=self.admin_headers())
+
+    def update_user(self) -> Dict[str, Any]:
+        operator = random.choice(self.operators)
+        return self.call('users', 'PUT', {
+            'id': operator['id'], 'full_name': 'Bench Operator ' + operator['username'].rpartition('_')[2]
+        }, headers=self.admin_headers())
+
+    def get_chats(self) -> Dict[str, Any]:
+        operator = random.choice(self.operators)
+        return self.call('chats', 'GET', query={
+            'status': 'waiting,active', 'assigned_operator_id': str(operator['id']), 'limit': '50'
+        })
+
+    def get_messages(self) -> Dict[str, Any]:
+        chat = random.choice(self.open_chats)
+        return self.call('chats', 'POST', {
+            'action': 'get_messages', 'chat_id': chat['id'],
+            'after_id': max((chat['last_message_id'] or 0) - 5, 0), 'limit': 50
+        })
+
+    def get_notes(self) -> Dict[str, Any]:
+        chat = random.choice(self.open_chats)
+        return self.call('chats', 'POST', {'action': 'get_notes', 'chat_id': chat['id']})
+
+    def send_message(self) -> Dict[str, Any]:
+        chat = random.choice(self.open_chats)
+        return self.call('chats', 'POST', {
+            'action': 'send_message', 'chat_id': chat['id'], 'sender_type': 'client',
+            'message_text': 'Подскажите, когда будет доставка моего заказа?'
+        })
+
+
+def run_worker(workload: Workload, mix: Dict[str, int], deadline: float) -> Dict[str, Dict[str, List[float]]]:
+    actions = list(mix)
+    weights = [mix[action] for action in actions]
+    samples: Dict[str, Dict[str, List[float]]] = {
+        action: {'latency': [], 'queries': [], 'errors': [], 'busy': []} for action in actions
+    }
+
+    while time.monotonic() < deadline:
+        action = random.choices(actions, weights)[0]
+        _query_counter.count = 0
+        started = time.perf_counter()
+        try:
+            status = getattr(workload, action)()['statusCode']
+        except Exception:
+            status = 500
+        if status == 503:
+            # Отказ переполненного пула bcrypt - отдельный исход, иначе мгновенные 503 завышают пропускную способность
+            samples[action]['busy'].append(1)
+            continue
+        failed = status >= 500
+        samples[action]['latency'].append((time.perf_counter() - started) * 1000)
+        samples[action]['queries'].append(_query_counter.count)
+        samples[action]['errors'].append(1 if failed else 0)
+
+    return samples
+
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(int(round(fraction * (len(sorted_values) - 1))), len(sorted_values) - 1)
+    return round(sorted_values[index], 3)
+
+
+def summarize(results: List[Dict[str, Dict[str, List[float]]]], duration: float) -> Dict[str, Any]:
+    report: Dict[str, Any] = {}
+    total = 0
+    busy_total = 0
+
+    for action in results[0]:
+        latency = sorted(value for result in results for value in result[action]['latency'])
+        queries = [value for result in results for value in result[action]['queries']]
+        errors = sum(value for result in results for value in result[action]['errors'])
+        busy = sum(len(result[action]['busy']) for result in results)
+        total += len(latency)
+        busy_total += busy
+        report[action] = {
+            'count': len(latency),
+            'errors': errors,
+            'busy_503': busy,
+            'throughput_rps': round(len(latency) / duration, 2),
+            'p50_ms': percentile(latency, 0.50),
+            'p95_ms': percentile(latency, 0.95),
+            'p99_ms': percentile(latency, 0.99),
+            'queries_per_request': round(sum(queries) / len(queries), 2) if queries else 0
+        }
+
+    return {'total_requests': total, 'total_busy_503': busy_total, 'throughput_rps': round(total / duration, 2), 'actions': report}
+
+
+def parse_mix(value: str) -> Dict[str, int]:
+    mix = {}
+    for part in value.split(','):
+        action, _, weight = part.partition('=')
+        if not hasattr(Workload, action):
+            raise argparse.ArgumentTypeError(f'unknown action {action}')
+        mix[action] = int(weight or 1)
+    return mix
+
+
+def main() -> None:
+    '''
+    Business: Load generator for the auth, chats and users handlers against a disposable Postgres
+    Usage: BENCH_DATABASE_URL=... python bench/run.py --setup --seed --workers 32 --duration 60
+    '''
+    parser = argparse.ArgumentParser(description='Backend load benchmark')
+    parser.add_argument('--setup', action='store_true', help='apply db_migrations to an empty database')
+    parser.add_argument('--seed', action='store_true')
+    parser.add_argument('--operators', type=int, default=1000)
+    parser.add_argument('--chats', type=int, default=100000)
+    parser.add_argument('--messages-per-chat', type=int, default=20)
+    parser.add_argument('--days', type=int, default=60)
+    parser.add_argument('--bcrypt-rounds', type=int, default=12,
+                        help='cost of the seeded hashes, also used as BCRYPT_ROUNDS so logins do not rehash')
+    parser.add_argument('--workers', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=30)
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix(DEFAULT_MIX))
+    parser.add_argument('--output', default='-')
+    args = parser.parse_args()
+
+    # Отдельная переменная, чтобы случайно не нагрузить боевую DATABASE_URL
+    database_url = os.environ.get('BENCH_DATABASE_URL')
+    if not database_url:
+        raise SystemExit('BENCH_DATABASE_URL is required')
+    os.environ['DATABASE_URL'] = database_url
+    os.environ.setdefault('DB_POOL_MAX', str(args.workers))
+    os.environ.setdefault('BCRYPT_ROUNDS', str(args.bcrypt_rounds))
+
+    conn = _real_connect(database_url, cursor_factory=RealDictCursor)
+    try:
+        if args.setup:
+            apply_migrations(conn)
+        if args.seed:
+            seed(conn, args.operators, args.chats, args.messages_per_chat, args.days, args.bcrypt_rounds)
+        workload = Workload(conn, {})
+    finally:
+        conn.close()
+
+    psycopg2.connect = counting_connect
+    workload.handlers = {name: load_handler(name) for name in ('auth', 'chats', 'users')}
+
+    deadline = time.monotonic() + args.duration
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        futures = [executor.submit(run_worker, workload, args.mix, deadline) for _ in range(args.workers)]
+        results = [future.result() for future in futures]
+    duration = time.monotonic() - started
+
+    report = {
+        'config': {
+            'workers': args.workers, 'duration_s': round(duration, 2), 'mix': args.mix,
+            'operators': len(workload.operators), 'open_chats': len(workload.open_chats)
+        },
+        **summarize(results, duration)
+    }
+
+    output = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output == '-':
+        print(output)
+    else:
+        Path(args.output).write_text(output + '\n', encoding='utf-8')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,2 @@
+-- Индекс для курсорной выборки сообщений чата по id (after_id / before_id)
+CREATE INDEX IF NOT EXISTS idx_messages_chat_id_id ON messages(chat_id, id);
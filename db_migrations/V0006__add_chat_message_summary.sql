@@ -0,0 +1,31 @@
+-- Сводка по последнему сообщению и непрочитанным, чтобы список чатов не считал messages
+ALTER TABLE chats ADD COLUMN IF NOT EXISTS last_message_id INTEGER;
+ALTER TABLE chats ADD COLUMN IF NOT EXISTS last_message_text TEXT;
+ALTER TABLE chats ADD COLUMN IF NOT EXISTS last_message_at TIMESTAMP;
+ALTER TABLE chats ADD COLUMN IF NOT EXISTS unread_client_count INTEGER NOT NULL DEFAULT 0;
+
+-- Заполнение для существующих чатов
+UPDATE chats c
+SET last_message_id = lm.id,
+    last_message_text = lm.message_text,
+    last_message_at = lm.created_at
+FROM (
+    SELECT DISTINCT ON (chat_id) chat_id, id, message_text, created_at
+    FROM messages
+    ORDER BY chat_id, id DESC
+) lm
+WHERE lm.chat_id = c.id;
+
+UPDATE chats c
+SET unread_client_count = u.cnt
+FROM (
+    SELECT chat_id, COUNT(*) AS cnt
+    FROM messages
+    WHERE is_read = false AND sender_type = 'client'
+    GROUP BY chat_id
+) u
+WHERE u.chat_id = c.id;
+
+-- Индексы для выборки списка чатов по updated_at
+CREATE INDEX IF NOT EXISTS idx_chats_updated ON chats(updated_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_chats_status_updated ON chats(status, updated_at DESC, id DESC);
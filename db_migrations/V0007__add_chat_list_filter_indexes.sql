@@ -0,0 +1,3 @@
+-- Индексы для постраничного списка чатов с фильтрами по оператору и дате создания
+CREATE INDEX IF NOT EXISTS idx_chats_operator_updated ON chats(assigned_operator_id, updated_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_chats_created ON chats(created_at);
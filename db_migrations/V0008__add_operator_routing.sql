@@ -0,0 +1,26 @@
+-- Счётчики нагрузки операторов и лимиты одновременных чатов для маршрутизации
+ALTER TABLE users ADD COLUMN IF NOT EXISTS active_chat_count INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE users ADD COLUMN IF NOT EXISTS max_active_chats INTEGER NOT NULL DEFAULT 10;
+ALTER TABLE users ADD COLUMN IF NOT EXISTS last_assigned_at TIMESTAMP;
+
+-- Отдел чата для очередей по отделам (NULL - любой отдел)
+ALTER TABLE chats ADD COLUMN IF NOT EXISTS department VARCHAR(255);
+
+UPDATE users u
+SET active_chat_count = a.cnt
+FROM (
+    SELECT assigned_operator_id, COUNT(*) AS cnt
+    FROM chats
+    WHERE status = 'active' AND assigned_operator_id IS NOT NULL
+    GROUP BY assigned_operator_id
+) a
+WHERE a.assigned_operator_id = u.id;
+
+-- Выбор наименее загруженного оператора онлайн
+CREATE INDEX IF NOT EXISTS idx_users_routing ON users(active_chat_count, last_assigned_at NULLS FIRST)
+    WHERE status = 'online' AND is_active = true AND role IN ('operator', 'okk', 'admin');
+CREATE INDEX IF NOT EXISTS idx_users_routing_department ON users(department, active_chat_count, last_assigned_at NULLS FIRST)
+    WHERE status = 'online' AND is_active = true AND role IN ('operator', 'okk', 'admin');
+
+-- Очередь ожидающих чатов
+CREATE INDEX IF NOT EXISTS idx_chats_waiting_queue ON chats(created_at) WHERE status = 'waiting';
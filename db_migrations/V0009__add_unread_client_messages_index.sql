@@ -0,0 +1,3 @@
+-- Частичный индекс только по непрочитанным сообщениям клиента для mark_read
+CREATE INDEX IF NOT EXISTS idx_messages_unread_client ON messages(chat_id, id)
+    WHERE is_read = false AND sender_type = 'client';
@@ -0,0 +1,5 @@
+-- Полнотекстовый поиск по истории сообщений (русская морфология)
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS search_vector tsvector
+    GENERATED ALWAYS AS (to_tsvector('russian', message_text)) STORED;
+
+CREATE INDEX IF NOT EXISTS idx_messages_search ON messages USING GIN (search_vector);
@@ -0,0 +1,130 @@
+-- Помесячное секционирование messages по created_at
+ALTER TABLE messages RENAME TO messages_unpartitioned;
+ALTER SEQUENCE messages_id_seq OWNED BY NONE;
+
+DROP INDEX IF EXISTS idx_messages_chat;
+DROP INDEX IF EXISTS idx_messages_created;
+DROP INDEX IF EXISTS idx_messages_chat_id_id;
+DROP INDEX IF EXISTS idx_messages_unread_client;
+DROP INDEX IF EXISTS idx_messages_search;
+
+CREATE TABLE messages (
+    id INTEGER NOT NULL DEFAULT nextval('messages_id_seq'),
+    chat_id INTEGER NOT NULL REFERENCES chats(id),
+    sender_type VARCHAR(50) NOT NULL CHECK (sender_type IN ('client', 'operator', 'system')),
+    sender_id INTEGER REFERENCES users(id),
+    message_text TEXT NOT NULL,
+    is_read BOOLEAN NOT NULL DEFAULT false,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    search_vector tsvector GENERATED ALWAYS AS (to_tsvector('russian', message_text)) STORED,
+    PRIMARY KEY (id, created_at)
+) PARTITION BY RANGE (created_at);
+
+ALTER SEQUENCE messages_id_seq OWNED BY messages.id;
+
+-- Создаёт недостающие месячные секции от from_month до текущего месяца + months_ahead
+CREATE OR REPLACE FUNCTION create_messages_partitions(from_month DATE, months_ahead INTEGER)
+RETURNS INTEGER AS $$
+DECLARE
+    month_start DATE := date_trunc('month', from_month)::date;
+    last_month DATE := (date_trunc('month', LOCALTIMESTAMP) + make_interval(months => months_ahead))::date;
+    partition_name TEXT;
+    created INTEGER := 0;
+BEGIN
+    WHILE month_start <= last_month LOOP
+        partition_name := 'messages_' || to_char(month_start, 'YYYY_MM');
+        IF to_regclass(partition_name) IS NULL THEN
+            EXECUTE format(
+                'CREATE TABLE %I PARTITION OF messages FOR VALUES FROM (%L) TO (%L)',
+                partition_name, month_start, (month_start + INTERVAL '1 month')::date
+            );
+            created := created + 1;
+        END IF;
+        month_start := (month_start + INTERVAL '1 month')::date;
+    END LOOP;
+    RETURN created;
+END;
+$$ LANGUAGE plpgsql;
+
+SELECT create_messages_partitions(
+    COALESCE((SELECT MIN(created_at) FROM messages_unpartitioned), LOCALTIMESTAMP)::date,
+    3
+);
+CREATE TABLE IF NOT EXISTS messages_default PARTITION OF messages DEFAULT;
+
+INSERT INTO messages (id, chat_id, sender_type, sender_id, message_text, is_read, created_at)
+SELECT id, chat_id, sender_type, sender_id, message_text, is_read, created_at
+FROM messages_unpartitioned;
+
+DROP TABLE messages_unpartitioned;
+
+CREATE INDEX IF NOT EXISTS idx_messages_chat_id_id ON messages(chat_id, id);
+CREATE INDEX IF NOT EXISTS idx_messages_created ON messages(created_at);
+CREATE INDEX IF NOT EXISTS idx_messages_unread_client ON messages(chat_id, id)
+    WHERE is_read = false AND sender_type = 'client';
+CREATE INDEX IF NOT EXISTS idx_messages_search ON messages USING GIN (search_vector);
+
+-- Архив закрытых чатов: одна компактная строка на чат, история и заметки в JSONB
+ALTER TABLE chats ADD COLUMN IF NOT EXISTS archived_at TIMESTAMP;
+
+CREATE TABLE IF NOT EXISTS chat_archive (
+    chat_id INTEGER PRIMARY KEY REFERENCES chats(id),
+    messages JSONB NOT NULL,
+    notes JSONB NOT NULL,
+    archived_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_chats_archive_candidates ON chats(updated_at)
+    WHERE status = 'closed' AND archived_at IS NULL;
+
+-- Переносит до batch_size чатов, закрытых более older_than_days дней назад, в chat_archive
+CREATE OR REPLACE FUNCTION archive_closed_chats(older_than_days INTEGER, batch_size INTEGER)
+RETURNS INTEGER AS $$
+DECLARE
+    archived INTEGER;
+BEGIN
+    WITH picked AS (
+        SELECT id FROM chats
+        WHERE status = 'closed' AND archived_at IS NULL
+          AND updated_at < LOCALTIMESTAMP - make_interval(days => older_than_days)
+        ORDER BY updated_at
+        LIMIT batch_size
+        FOR UPDATE SKIP LOCKED
+    ),
+    archived_rows AS (
+        INSERT INTO chat_archive (chat_id, messages, notes)
+        SELECT p.id,
+               COALESCE((
+                   SELECT jsonb_agg(
+                       (to_jsonb(m) - 'search_vector') || jsonb_build_object('sender_name', u.full_name)
+                       ORDER BY m.id
+                   )
+                   FROM messages m
+                   LEFT JOIN users u ON m.sender_id = u.id
+                   WHERE m.chat_id = p.id
+               ), '[]'::jsonb),
+               COALESCE((
+                   SELECT jsonb_agg(
+                       to_jsonb(n) || jsonb_build_object('operator_name', u.full_name)
+                       ORDER BY n.created_at DESC
+                   )
+                   FROM chat_notes n
+                   JOIN users u ON n.operator_id = u.id
+                   WHERE n.chat_id = p.id
+               ), '[]'::jsonb)
+        FROM picked p
+        RETURNING chat_id
+    ),
+    deleted_messages AS (
+        DELETE FROM messages WHERE chat_id IN (SELECT chat_id FROM archived_rows)
+    ),
+    deleted_notes AS (
+        DELETE FROM chat_notes WHERE chat_id IN (SELECT chat_id FROM archived_rows)
+    )
+    UPDATE chats SET archived_at = LOCALTIMESTAMP
+    WHERE id IN (SELECT chat_id FROM archived_rows);
+
+    GET DIAGNOSTICS archived = ROW_COUNT;
+    RETURN archived;
+END;
+$$ LANGUAGE plpgsql;
@@ -0,0 +1,64 @@
+-- Время первого ответа оператора и закрытия чата
+ALTER TABLE chats ADD COLUMN IF NOT EXISTS first_response_at TIMESTAMP;
+ALTER TABLE chats ADD COLUMN IF NOT EXISTS closed_at TIMESTAMP;
+
+UPDATE chats c
+SET first_response_at = f.first_response_at
+FROM (
+    SELECT chat_id, MIN(created_at) AS first_response_at
+    FROM messages
+    WHERE sender_type = 'operator'
+    GROUP BY chat_id
+) f
+WHERE f.chat_id = c.id AND c.first_response_at IS NULL;
+
+UPDATE chats SET closed_at = updated_at WHERE status = 'closed' AND closed_at IS NULL;
+
+-- Дневные агрегаты по операторам, обновляются инкрементально из backend/chats
+CREATE TABLE IF NOT EXISTS operator_daily_stats (
+    operator_id INTEGER NOT NULL REFERENCES users(id),
+    day DATE NOT NULL,
+    chats_handled INTEGER NOT NULL DEFAULT 0,
+    handling_seconds DOUBLE PRECISION NOT NULL DEFAULT 0,
+    first_responses INTEGER NOT NULL DEFAULT 0,
+    first_response_seconds DOUBLE PRECISION NOT NULL DEFAULT 0,
+    PRIMARY KEY (operator_id, day)
+);
+
+-- Распределение оценок QC по дням: из него считаются среднее и перцентили
+CREATE TABLE IF NOT EXISTS operator_score_counts (
+    operator_id INTEGER NOT NULL REFERENCES users(id),
+    day DATE NOT NULL,
+    score INTEGER NOT NULL CHECK (score >= 0 AND score <= 100),
+    ratings INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (operator_id, day, score)
+);
+
+CREATE INDEX IF NOT EXISTS idx_operator_daily_stats_day ON operator_daily_stats(day);
+CREATE INDEX IF NOT EXISTS idx_operator_score_counts_day ON operator_score_counts(day);
+
+-- Заполнение по уже накопленным данным
+INSERT INTO operator_score_counts (operator_id, day, score, ratings)
+SELECT operator_id, created_at::date, score, COUNT(*)
+FROM qc_ratings
+GROUP BY operator_id, created_at::date, score
+ON CONFLICT (operator_id, day, score) DO NOTHING;
+
+INSERT INTO operator_daily_stats (operator_id, day, chats_handled, handling_seconds)
+SELECT assigned_operator_id, closed_at::date, COUNT(*),
+       SUM(EXTRACT(EPOCH FROM closed_at - created_at))
+FROM chats
+WHERE status = 'closed' AND assigned_operator_id IS NOT NULL
+GROUP BY assigned_operator_id, closed_at::date
+ON CONFLICT (operator_id, day) DO NOTHING;
+
+INSERT INTO operator_daily_stats (operator_id, day, first_responses, first_response_seconds)
+SELECT m.sender_id, c.first_response_at::date, COUNT(*),
+       SUM(EXTRACT(EPOCH FROM c.first_response_at - c.created_at))
+FROM chats c
+JOIN messages m ON m.chat_id = c.id AND m.sender_type = 'operator' AND m.created_at = c.first_response_at
+WHERE m.sender_id IS NOT NULL
+GROUP BY m.sender_id, c.first_response_at::date
+ON CONFLICT (operator_id, day) DO UPDATE
+SET first_responses = operator_daily_stats.first_responses + EXCLUDED.first_responses,
+    first_response_seconds = operator_daily_stats.first_response_seconds + EXCLUDED.first_response_seconds;
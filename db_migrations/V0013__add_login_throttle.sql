@@ -0,0 +1,7 @@
+-- Счётчики неудачных входов по логину и IP; проверяются до bcrypt
+CREATE TABLE IF NOT EXISTS login_throttle (
+    throttle_key VARCHAR(300) PRIMARY KEY,
+    failures INTEGER NOT NULL DEFAULT 0,
+    window_started_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    locked_until TIMESTAMP
+);
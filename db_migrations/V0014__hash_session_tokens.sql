@@ -0,0 +1,15 @@
+-- Вместо самого токена храним SHA-256 (32 байта): индекс меньше, а утечка таблицы не даёт рабочих токенов
+ALTER TABLE sessions ADD COLUMN IF NOT EXISTS token_hash BYTEA;
+
+UPDATE sessions SET token_hash = sha256(convert_to(session_token, 'UTF8')) WHERE token_hash IS NULL;
+
+ALTER TABLE sessions ALTER COLUMN token_hash SET NOT NULL;
+CREATE UNIQUE INDEX IF NOT EXISTS idx_sessions_token_hash ON sessions(token_hash);
+
+DROP INDEX IF EXISTS idx_sessions_token;
+ALTER TABLE sessions DROP COLUMN IF EXISTS session_token;
+
+-- Лимит сессий на пользователя выбирает самые новые, сборщик мусора удаляет по expires_at
+DROP INDEX IF EXISTS idx_sessions_user_id;
+CREATE INDEX IF NOT EXISTS idx_sessions_user_created ON sessions(user_id, created_at DESC);
+CREATE INDEX IF NOT EXISTS idx_sessions_expires ON sessions(expires_at);
@@ -0,0 +1,29 @@
+-- Время последнего heartbeat. Колонка не индексируется, чтобы частые обновления оставались HOT;
+-- таблица users небольшая, и проход по ней при снятии зависших операторов дешёвый
+ALTER TABLE users ADD COLUMN IF NOT EXISTS last_seen_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP;
+
+-- Переводит в offline сотрудников без heartbeat дольше timeout_seconds и рассылает те же
+-- уведомления, что и update_status: событие для шлюза и сброс кэша сессий/ростера
+CREATE OR REPLACE FUNCTION demote_stale_operators(timeout_seconds INTEGER)
+RETURNS INTEGER AS $$
+DECLARE
+    demoted_id INTEGER;
+    demoted INTEGER := 0;
+BEGIN
+    FOR demoted_id IN
+        UPDATE users
+        SET status = 'offline', updated_at = CURRENT_TIMESTAMP
+        WHERE status <> 'offline' AND role IN ('operator', 'okk', 'admin')
+          AND last_seen_at < LOCALTIMESTAMP - make_interval(secs => timeout_seconds)
+        RETURNING id
+    LOOP
+        PERFORM pg_notify(
+            'chat_events',
+            json_build_object('type', 'operator_status', 'operator_id', demoted_id, 'status', 'offline')::text
+        );
+        PERFORM pg_notify('session_invalidated', 'user:' || demoted_id);
+        demoted := demoted + 1;
+    END LOOP;
+    RETURN demoted;
+END;
+$$ LANGUAGE plpgsql;
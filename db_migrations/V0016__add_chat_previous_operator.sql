@@ -0,0 +1,3 @@
+-- Оператор, у которого чат забрали при эскалации или возврате в очередь. По нему changed_since
+-- отдаёт прежнему оператору id ушедшего чата, не раскрывая изменения чужих чатов
+ALTER TABLE chats ADD COLUMN IF NOT EXISTS previous_operator_id INTEGER REFERENCES users(id);
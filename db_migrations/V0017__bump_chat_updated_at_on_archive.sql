@@ -0,0 +1,51 @@
+-- Архивация сдвигает updated_at: ETag списка чатов и changed_since замечают переход чата в архив
+CREATE OR REPLACE FUNCTION archive_closed_chats(older_than_days INTEGER, batch_size INTEGER)
+RETURNS INTEGER AS $$
+DECLARE
+    archived INTEGER;
+BEGIN
+    WITH picked AS (
+        SELECT id FROM chats
+        WHERE status = 'closed' AND archived_at IS NULL
+          AND updated_at < LOCALTIMESTAMP - make_interval(days => older_than_days)
+        ORDER BY updated_at
+        LIMIT batch_size
+        FOR UPDATE SKIP LOCKED
+    ),
+    archived_rows AS (
+        INSERT INTO chat_archive (chat_id, messages, notes)
+        SELECT p.id,
+               COALESCE((
+                   SELECT jsonb_agg(
+                       (to_jsonb(m) - 'search_vector') || jsonb_build_object('sender_name', u.full_name)
+                       ORDER BY m.id
+                   )
+                   FROM messages m
+                   LEFT JOIN users u ON m.sender_id = u.id
+                   WHERE m.chat_id = p.id
+               ), '[]'::jsonb),
+               COALESCE((
+                   SELECT jsonb_agg(
+                       to_jsonb(n) || jsonb_build_object('operator_name', u.full_name)
+                       ORDER BY n.created_at DESC
+                   )
+                   FROM chat_notes n
+                   JOIN users u ON n.operator_id = u.id
+                   WHERE n.chat_id = p.id
+               ), '[]'::jsonb)
+        FROM picked p
+        RETURNING chat_id
+    ),
+    deleted_messages AS (
+        DELETE FROM messages WHERE chat_id IN (SELECT chat_id FROM archived_rows)
+    ),
+    deleted_notes AS (
+        DELETE FROM chat_notes WHERE chat_id IN (SELECT chat_id FROM archived_rows)
+    )
+    UPDATE chats SET archived_at = LOCALTIMESTAMP, updated_at = CURRENT_TIMESTAMP
+    WHERE id IN (SELECT chat_id FROM archived_rows);
+
+    GET DIAGNOSTICS archived = ROW_COUNT;
+    RETURN archived;
+END;
+$$ LANGUAGE plpgsql;
@@ -0,0 +1,314 @@
+import asyncio
+import base64
+import importlib.util
+import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, Optional, Set
+
+import psycopg2
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+from aiohttp import web, WSMsgType
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent / 'backend'
+GATEWAY_QUEUE_SIZE = int(os.environ.get('GATEWAY_QUEUE_SIZE', '256'))
+GATEWAY_HEARTBEAT = float(os.environ.get('GATEWAY_HEARTBEAT', '15'))
+GATEWAY_WORKERS = int(os.environ.get('GATEWAY_WORKERS', '8'))
+GATEWAY_ASYNC = os.environ.get('GATEWAY_ASYNC', '') in ('1', 'true')
+GATEWAY_RECONNECT_MIN = float(os.environ.get('GATEWAY_RECONNECT_MIN', '0.5'))
+GATEWAY_RECONNECT_MAX = float(os.environ.get('GATEWAY_RECONNECT_MAX', '30'))
+
+
+def load_handler(function_name: str):
+    '''
+    Imports backend/<function_name>/index.py under a unique module name,
+    so the gateway runs exactly the same handler code as the cloud function.
+    With GATEWAY_ASYNC on, functions that ship async_index.py are served by
+    its coroutine handler instead
+    '''
+    path = BACKEND_DIR / function_name / 'async_index.py'
+    if not (GATEWAY_ASYNC and path.exists()):
+        path = path.with_name('index.py')
+    spec = importlib.util.spec_from_file_location(f'{function_name}_{path.stem}', path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module.handler
+
+
+class Subscriber:
+    def __init__(self, chat_id: Optional[int], operator_id: Optional[int], queue: bool):
+        self.chat_id = chat_id
+        self.operator_id = operator_id
+        self.queue = queue
+        self.events: asyncio.Queue = asyncio.Queue(maxsize=GATEWAY_QUEUE_SIZE)
+        self.overflowed = asyncio.Event()
+
+    def push(self, event: str) -> None:
+        # Медленный клиент не тормозит остальных: при переполнении очереди он отключается
+        # и после переподключения догоняет историю через get_messages / changed_since
+        try:
+            self.events.put_nowait(event)
+        except asyncio.QueueFull:
+            self.overflowed.set()
+
+
+class EventHub:
+    def __init__(self):
+        self.by_chat: Dict[int, Set[Subscriber]] = {}
+        self.by_operator: Dict[int, Set[Subscriber]] = {}
+        self.queue_watchers: Set[Subscriber] = set()
+        self.dashboards: Set[Subscriber] = set()
+        self.conn = None
+        self.fd: Optional[int] = None
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.reconnecting: Optional[asyncio.Task] = None
+
+    def subscribe(self, subscriber: Subscriber) -> None:
+        if subscriber.chat_id:
+            self.by_chat.setdefault(subscriber.chat_id, set()).add(subscriber)
+        if subscriber.operator_id:
+            self.by_operator.setdefault(subscriber.operator_id, set()).add(subscriber)
+        if subscriber.queue:
+            self.queue_watchers.add(subscriber)
+        if subscriber.operator_id or subscriber.queue:
+            self.dashboards.add(subscriber)
+
+    def unsubscribe(self, subscriber: Subscriber) -> None:
+        if subscriber.chat_id:
+            self.by_chat.get(subscriber.chat_id, set()).discard(subscriber)
+            if not self.by_chat.get(subscriber.chat_id):
+                self.by_chat.pop(subscriber.chat_id, None)
+        if subscriber.operator_id:
+            self.by_operator.get(subscriber.operator_id, set()).discard(subscriber)
+            if not self.by_operator.get(subscriber.operator_id):
+                self.by_operator.pop(subscriber.operator_id, None)
+        self.queue_watchers.discard(subscriber)
+        self.dashboards.discard(subscriber)
+
+    def publish(self, payload: str) -> None:
+        event = json.loads(payload)
+
+        if event.get('type') == 'operator_status':
+            targets = set(self.dashboards)
+        else:
+            targets = set(self.by_chat.get(event.get('chat_id'), ()))
+            for operator_id in event.pop('operator_ids', []):
+                targets |= self.by_operator.get(operator_id, set())
+            if event.pop('queue', False):
+                targets |= self.queue_watchers
+
+        data = json.dumps(event)
+        for subscriber in targets:
+            subscriber.push(data)
+
+    def resync(self) -> None:
+        # Уведомления за время обрыва потеряны: каждый подписчик перечитывает своё состояние
+        # через get_messages / changed_since
+        data = json.dumps({'type': 'resync'})
+        targets = set(self.queue_watchers) | self.dashboards
+        for subscribers in self.by_chat.values():
+            targets |= subscribers
+        for subscriber in targets:
+            subscriber.push(data)
+
+    def start(self, loop: asyncio.AbstractEventLoop) -> None:
+        self.loop = loop
+        self.connect()
+
+    def connect(self) -> None:
+        # Одно LISTEN-соединение на весь процесс, уведомления читаются через add_reader
+        conn = psycopg2.connect(os.environ.get('DATABASE_URL'))
+        try:
+            conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+            conn.cursor().execute('LISTEN chat_events')
+        except psycopg2.Error:
+            conn.close()
+            raise
+        self.conn = conn
+        self.fd = conn.fileno()
+        self.loop.add_reader(self.fd, self.drain)
+
+    def drain(self) -> None:
+        try:
+            self.conn.poll()
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            # Без снятия reader цикл событий крутился бы на закрытом сокете
+            self.disconnect()
+            self.reconnecting = self.loop.create_task(self.reconnect())
+            return
+        while self.conn.notifies:
+            self.publish(self.conn.notifies.pop(0).payload)
+
+    def disconnect(self) -> None:
+        if self.conn is None:
+            return
+        # Сокет запоминается при подключении: fileno() закрытого соединения уже недоступен
+        self.loop.remove_reader(self.fd)
+        self.conn.close()
+        self.conn = None
+
+    async def reconnect(self) -> None:
+        delay = GATEWAY_RECONNECT_MIN
+        while True:
+            await asyncio.sleep(delay)
+            try:
+                self.connect()
+            except psycopg2.OperationalError:
+                delay = min(delay * 2, GATEWAY_RECONNECT_MAX)
+                continue
+            self.reconnecting = None
+            self.resync()
+            return
+
+    def stop(self, loop: asyncio.AbstractEventLoop) -> None:
+        if self.reconnecting is not None:
+            self.reconnecting.cancel()
+        self.disconnect()
+
+
+def parse_subscription(request: web.Request) -> Subscriber:
+    try:
+        chat_id = int(request.query['chat_id']) if request.query.get('chat_id') else None
+        operator_id = int(request.query['operator_id']) if request.query.get('operator_id') else None
+    except ValueError:
+        raise web.HTTPBadRequest(text=json.dumps({'error': 'Invalid subscription'}), content_type='application/json')
+
+    queue = request.query.get('queue') in ('1', 'true')
+    if not chat_id and not operator_id and not queue:
+        raise web.HTTPBadRequest(
+            text=json.dumps({'error': 'chat_id, operator_id or queue required'}),
+            content_type='application/json'
+        )
+    return Subscriber(chat_id, operator_id, queue)
+
+
+async def next_event(subscriber: Subscriber) -> Optional[str]:
+    get_event = asyncio.ensure_future(subscriber.events.get())
+    overflow = asyncio.ensure_future(subscriber.overflowed.wait())
+    done, _ = await asyncio.wait(
+        {get_event, overflow}, timeout=GATEWAY_HEARTBEAT, return_when=asyncio.FIRST_COMPLETED
+    )
+    overflow.cancel()
+    if get_event in done:
+        return get_event.result()
+    get_event.cancel()
+    if overflow in done:
+        raise ConnectionResetError('Subscriber send queue overflowed')
+    return None
+
+
+async def handle_websocket(request: web.Request) -> web.WebSocketResponse:
+    subscriber = parse_subscription(request)
+    ws = web.WebSocketResponse(heartbeat=GATEWAY_HEARTBEAT)
+    await ws.prepare(request)
+    hub: EventHub = request.app['hub']
+    hub.subscribe(subscriber)
+
+    async def read_loop():
+        async for msg in ws:
+            if msg.type in (WSMsgType.ERROR, WSMsgType.CLOSE):
+                break
+
+    reader = asyncio.ensure_future(read_loop())
+    try:
+        while not ws.closed and not reader.done():
+            event = await next_event(subscriber)
+            if event is not None:
+                await ws.send_str(event)
+    except ConnectionResetError:
+        await ws.close(code=1013, message=b'slow consumer')
+    finally:
+        hub.unsubscribe(subscriber)
+        reader.cancel()
+    return ws
+
+
+async def handle_sse(request: web.Request) -> web.StreamResponse:
+    subscriber = parse_subscription(request)
+    response = web.StreamResponse(headers={
+        'Content-Type': 'text/event-stream',
+        'Cache-Control': 'no-cache',
+        'Access-Control-Allow-Origin': '*'
+    })
+    await response.prepare(request)
+    hub: EventHub = request.app['hub']
+    hub.subscribe(subscriber)
+
+    try:
+        while True:
+            event = await next_event(subscriber)
+            if event is None:
+                await response.write(b': ping\n\n')
+            else:
+                await response.write(f'data: {event}\n\n'.encode('utf-8'))
+    except (ConnectionResetError, asyncio.CancelledError):
+        pass
+    finally:
+        hub.unsubscribe(subscriber)
+    return response
+
+
+async def handle_api(request: web.Request) -> web.Response:
+    '''
+    Proxies a plain HTTP request to a backend handler - awaited directly when it
+    is a coroutine, otherwise in a worker thread - building the same event dict
+    the cloud runtime passes in
+    '''
+    handler = request.app['handlers'].get(request.match_info['function'])
+    if handler is None:
+        raise web.HTTPNotFound()
+
+    event = {
+        'httpMethod': request.method,
+        'headers': dict(request.headers),
+        'queryStringParameters': dict(request.query),
+        'body': await request.text(),
+        'isBase64Encoded': False,
+        'requestContext': {'identity': {'sourceIp': request.remote}}
+    }
+    context = type('Context', (), {'request_id': request.headers.get('X-Request-Id', '')})()
+    if asyncio.iscoroutinefunction(handler):
+        result = await handler(event, context)
+    else:
+        result = await asyncio.get_running_loop().run_in_executor(None, handler, event, context)
+
+    body = result.get('body', '')
+    if result.get('isBase64Encoded'):
+        body = base64.b64decode(body)
+    return web.Response(status=result['statusCode'], headers=result.get('headers', {}), body=body)
+
+
+async def on_startup(app: web.Application) -> None:
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=GATEWAY_WORKERS))
+    app['hub'].start(loop)
+
+
+async def on_cleanup(app: web.Application) -> None:
+    app['hub'].stop(asyncio.get_running_loop())
+    for handler in app['handlers'].values():
+        if asyncio.iscoroutinefunction(handler):
+            await sys.modules[handler.__module__].close()
+
+
+def create_app() -> web.Application:
+    app = web.Application()
+    app['hub'] = EventHub()
+    app['handlers'] = {name: load_handler(name) for name in ('auth', 'chats', 'users')}
+    app.router.add_get('/ws', handle_websocket)
+    app.router.add_get('/events', handle_sse)
+    app.router.add_route('*', '/api/{function}', handle_api)
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+
+if __name__ == '__main__':
+    web.run_app(
+        create_app(),
+        host=os.environ.get('GATEWAY_HOST', '0.0.0.0'),
+        port=int(os.environ.get('GATEWAY_PORT', '8080'))
+    )
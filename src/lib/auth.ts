@@ -1,3 +1,5 @@
+import { postConditional } from './conditional';
+
 const AUTH_API = 'https://functions.poehali.dev/a2ac04f7-91da-414c-ac5d-cb2d8fa5292d';
 const USERS_API = 'https://functions.poehali.dev/1aabd452-d487-4be4-bc06-21ef796424d3';
 
@@ -108,20 +110,36 @@ export const authService = {
     }
   },
 
-  async getOperators(): Promise<User[]> {
+  async heartbeat(): Promise<User['status'] | null> {
+    const token = localStorage.getItem('session_token');
+    if (!token) {
+      return null;
+    }
+
     const response = await fetch(AUTH_API, {
       method: 'POST',
       headers: {
         'Content-Type': 'application/json',
+        'X-Session-Token': token,
       },
-      body: JSON.stringify({ action: 'get_operators' }),
+      body: JSON.stringify({ action: 'heartbeat' }),
     });
 
     if (!response.ok) {
-      throw new Error('Failed to fetch operators');
+      return null;
     }
 
-    return response.json();
+    const data = await response.json();
+    const user = this.getCurrentUser();
+    if (user && user.status !== data.status) {
+      user.status = data.status;
+      localStorage.setItem('user', JSON.stringify(user));
+    }
+    return data.status;
+  },
+
+  async getOperators(): Promise<User[]> {
+    return postConditional<User[]>(AUTH_API, { action: 'get_operators' }, 'Failed to fetch operators');
   },
 };
 
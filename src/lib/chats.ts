@@ -1,3 +1,5 @@
+import { postConditional } from './conditional';
+
 const CHATS_API = 'https://functions.poehali.dev/737f5054-182e-45da-bbb5-f17df2becc92';
 
 export interface Chat {
@@ -23,11 +25,29 @@ export interface Message {
   message_text: string;
   is_read: boolean;
   created_at: string;
+  read_lsn?: string;
+}
+
+// Позиция WAL последнего отправленного сообщения: чтения с ней не попадут на реплику,
+// которая это сообщение ещё не получила
+let readLsn: string | undefined;
+
+// Реплика ответила, уже проиграв эту позицию, а назад она не откатывается - токен больше не нужен.
+// Более новый токен от отправки, случившейся во время запроса, не сбрасывается
+function settleReadLsn(sentLsn: string | undefined, response: Response) {
+  if (sentLsn && sentLsn === readLsn && response.headers.get('X-Min-Lsn-Reached')) {
+    readLsn = undefined;
+  }
 }
 
 export const chatsService = {
   async getChats(status?: string): Promise<Chat[]> {
-    const url = status ? `${CHATS_API}?status=${status}` : CHATS_API;
+    const params = new URLSearchParams();
+    const sentLsn = readLsn;
+    if (status) params.set('status', status);
+    if (sentLsn) params.set('min_lsn', sentLsn);
+    const query = params.toString();
+    const url = query ? `${CHATS_API}?${query}` : CHATS_API;
     const response = await fetch(url, {
       method: 'GET',
       headers: { 'Content-Type': 'application/json' },
@@ -36,6 +56,7 @@ export const chatsService = {
     if (!response.ok) {
       throw new Error('Failed to fetch chats');
     }
+    settleReadLsn(sentLsn, response);
 
     return response.json();
   },
@@ -60,20 +81,13 @@ export const chatsService = {
   },
 
   async getMessages(chatId: number): Promise<Message[]> {
-    const response = await fetch(CHATS_API, {
-      method: 'POST',
-      headers: { 'Content-Type': 'application/json' },
-      body: JSON.stringify({
-        action: 'get_messages',
-        chat_id: chatId,
-      }),
-    });
-
-    if (!response.ok) {
-      throw new Error('Failed to fetch messages');
-    }
-
-    return response.json();
+    const sentLsn = readLsn;
+    return postConditional<Message[]>(
+      CHATS_API,
+      { action: 'get_messages', chat_id: chatId, ...(sentLsn ? { min_lsn: sentLsn } : {}) },
+      'Failed to fetch messages',
+      (response) => settleReadLsn(sentLsn, response)
+    );
   },
 
   async sendMessage(
@@ -99,7 +113,11 @@ export const chatsService = {
       throw new Error(error.error || 'Failed to send message');
     }
 
-    return response.json();
+    const message: Message = await response.json();
+    if (message.read_lsn) {
+      readLsn = message.read_lsn;
+    }
+    return message;
   },
 
   async closeChat(chatId: number): Promise<void> {
@@ -153,20 +171,11 @@ export const chatsService = {
   },
 
   async getNotes(chatId: number): Promise<any[]> {
-    const response = await fetch(CHATS_API, {
-      method: 'POST',
-      headers: { 'Content-Type': 'application/json' },
-      body: JSON.stringify({
-        action: 'get_notes',
-        chat_id: chatId,
-      }),
-    });
-
-    if (!response.ok) {
-      throw new Error('Failed to fetch notes');
-    }
-
-    return response.json();
+    return postConditional<any[]>(
+      CHATS_API,
+      { action: 'get_notes', chat_id: chatId },
+      'Failed to fetch notes'
+    );
   },
 
   async addQCRating(
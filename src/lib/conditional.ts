@@ -0,0 +1,35 @@
+const conditionalCache = new Map<string, { etag: string; data: unknown }>();
+
+// POST-опросы с If-None-Match в теле: если данные не менялись, сервер отвечает
+// { not_modified: true } и возвращается результат прошлого запроса
+export async function postConditional<T>(
+  url: string,
+  payload: Record<string, unknown>,
+  errorMessage: string,
+  onResponse?: (response: Response) => void
+): Promise<T> {
+  const key = `${url}|${JSON.stringify(payload)}`;
+  const cached = conditionalCache.get(key);
+
+  const response = await fetch(url, {
+    method: 'POST',
+    headers: { 'Content-Type': 'application/json' },
+    body: JSON.stringify(cached ? { ...payload, if_none_match: cached.etag } : payload),
+  });
+
+  if (!response.ok) {
+    throw new Error(errorMessage);
+  }
+  onResponse?.(response);
+
+  const data = await response.json();
+  if (cached && data.not_modified) {
+    return cached.data as T;
+  }
+
+  const etag = response.headers.get('ETag');
+  if (etag) {
+    conditionalCache.set(key, { etag, data });
+  }
+  return data;
+}
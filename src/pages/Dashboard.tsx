@@ -82,6 +82,22 @@ const Dashboard = () => {
     loadOperators();
   }, []);
 
+  useEffect(() => {
+    const sendHeartbeat = async () => {
+      try {
+        const status = await authService.heartbeat();
+        if (status) {
+          setUserStatus(status);
+        }
+      } catch (error) {
+        console.error('Failed to send heartbeat:', error);
+      }
+    };
+    sendHeartbeat();
+    const interval = setInterval(sendHeartbeat, 30000);
+    return () => clearInterval(interval);
+  }, []);
+
   const loadOperators = async () => {
     try {
       const ops = await authService.getOperators();